@@ -1,11 +1,21 @@
-from flask import Flask, jsonify, request, render_template, session, redirect, url_for
+from flask import Flask, jsonify, request, render_template, session, redirect, url_for, Response, stream_with_context, g
 from functools import wraps
 from pivideo_manager import PiVideoManager
+import control_plane
 from datetime import datetime
 import os
+import json
+import time
+import hmac
 
 homeurl="/pimanager"
 
+# Event streams are closed after this many seconds, the browser reconnects on its own
+events_stream_lifetime = 300
+
+# Bearer token for scraping /metrics without a session, unset means admins only
+metrics_token = os.environ.get('METRICS_TOKEN')
+
 app = Flask(__name__,static_url_path=homeurl+'/static')
 app.secret_key = os.environ.get('SECRET_KEY', 'default_fallback_key')
 
@@ -22,7 +32,57 @@ def datetimeformat(value, format="%Y-%m-%d %H:%M:%S"):
             return value  # If parsing fails, return original value
     return "Never"
 
-manager = PiVideoManager()
+@app.template_filter('temperatureformat')
+def temperatureformat(value):
+    return f"{value:.1f}'C" if value is not None else "N/A"
+
+@app.template_filter('ramformat')
+def ramformat(value):
+    return f"{value} MB" if value is not None else "N/A"
+
+@app.template_filter('bytesformat')
+def bytesformat(value):
+    """Human readable size, like df -h."""
+    if value is None:
+        return "N/A"
+    for unit in ("", "K", "M", "G", "T"):
+        if value < 1024 or unit == "T":
+            return f"{value:.0f}{unit}" if value >= 10 or unit == "" else f"{value:.1f}{unit}"
+        value /= 1024
+
+@app.template_filter('lagformat')
+def lagformat(device):
+    if device.get("lag") is not None:
+        text = f"{device['lag']:.2f} ms"
+        if device.get("lag_jitter") is not None:
+            text += f" ±{device['lag_jitter']:.2f}"
+        if device.get("lag_loss"):
+            text += f" ({device['lag_loss']:.0%} lost)"
+        return text
+    if device.get("lag_error") == PiVideoManager.LAG_NO_MASTER:
+        return "no master detected"
+    if device.get("lag_error") == PiVideoManager.LAG_NO_RESPONSE:
+        return "Ping failed or no response"
+    return "N/A"
+
+# Devices are handled by the control plane process shared by every worker
+manager = control_plane.connect()
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.monotonic()
+
+@app.after_request
+def record_request(response):
+    """Reports the request's duration to the control plane, which holds the metrics of every worker."""
+    started = g.get('request_started')
+    if request.url_rule is not None and started is not None:
+        try:
+            manager.record_http_request(request.url_rule.rule, request.method, response.status_code,
+                                        time.monotonic() - started)
+        except Exception as e:
+            print(f"Could not record request metrics: {e}")
+    return response
 
 # Decorator to require admin login
 def login_required(f):
@@ -52,13 +112,7 @@ def roothome():
 @admin_required
 def home():
     """Home page showing device list."""
-    
-    setups = manager.get_setups()
-    for setup in setups:
-        print("setup",setup)
-        setup["devices"] = manager.get_all_devices_in_iprange(setup["iprange"])
-    
-    return render_template('index.html', setups=setups,homeurl=homeurl)
+    return render_template('index.html', setups=manager.get_setups_with_devices(),homeurl=homeurl)
 
 
 
@@ -155,11 +209,31 @@ def delete_device():
 @app.route(homeurl+'/api/scan', methods=['POST'])
 @login_required
 def scan_network():
-    """API endpoint to trigger IP scan."""
+    """API endpoint to start a background IP scan, incremental unless "full" is set."""
     ip_range = request.json.get('ip_range')
-    
-    manager.scan_ip_range(ip_range)
-    return jsonify({"message": "Scan completed."})
+
+    if not ip_range:
+        return jsonify({"error": "Missing ip_range field"}), 400
+
+    job_id = manager.start_scan(ip_range, incremental=not request.json.get('full'))
+    return jsonify({"message": "Scan started.", "job_id": job_id})
+
+@app.route(homeurl+'/api/scan/<job_id>', methods=['GET'])
+@login_required
+def scan_status(job_id):
+    """API endpoint to get the progress of a scan."""
+    job = manager.get_scan_job(job_id)
+    if not job:
+        return jsonify({"error": "Scan not found"}), 404
+    return jsonify(job)
+
+@app.route(homeurl+'/api/scan/<job_id>/cancel', methods=['POST'])
+@login_required
+def cancel_scan(job_id):
+    """API endpoint to cancel a running scan."""
+    if manager.cancel_scan(job_id):
+        return jsonify({"message": "Scan cancelled."})
+    return jsonify({"error": "Scan not running"}), 404
 
 @app.route(homeurl+'/api/delete_setup', methods=['POST'])
 @login_required
@@ -190,18 +264,102 @@ def update_device():
 @app.route(homeurl+'/api/device_info/<ip>/<mac>', methods=['GET'])
 @login_required
 def get_device_info(ip,mac):
-    """API endpoint to fetch detailed information of a specific device."""
-    device_info = manager.update_client(ip,mac)
-    device = render_template('partials/device.html', device=device_info)
-    if device:
-        return device
-    return jsonify({"error": "Device not found"}), 404
+    """API endpoint to fetch detailed information of a specific device.
+
+    Served from the stored device state; the background poller is asked to
+    refresh the device right away instead of connecting to it here.
+    """
+    device_info = manager.get_device_state(mac)
+    if not device_info:
+        return jsonify({"error": "Device not found"}), 404
+    manager.request_poll(mac)
+    return render_template('partials/device.html', device=device_info)
+
+def device_event_payload(event):
+    """What the dashboard needs to patch a device row: display values, flags and new rows' HTML."""
+    device = event["device"]
+    payload = {"type": event["type"], "mac": event["mac"], "setup_id": device.get("setup_id")}
+    if event["type"] == "added":
+        payload["html"] = render_template('partials/device.html', device=device)
+    elif event["type"] == "changed":
+        payload["display"] = {
+            "name": device["name"] or "",
+            "model": device["model"],
+            "ip": device["ip"],
+            "temperature": temperatureformat(device["temperature"]),
+            "ram": ramformat(device["ram"]),
+            "storage": "T:" + bytesformat(device["storage_total"]) + " / R:" + bytesformat(device["storage_free"])
+                       if device["storage_total"] is not None else "N/A",
+            "lag": lagformat(device),
+            "last_connection": datetimeformat(device["last_connection"]),
+        }
+        payload["missing"] = bool(device["missing"])
+        payload["paused"] = bool(device["paused"])
+        payload["muted"] = bool(device["muted"])
+        payload["rebooting"] = device["reboot_started"] is not None
+    return payload
+
+@app.route(homeurl+'/api/events', methods=['GET'])
+@login_required
+@admin_required
+def device_events():
+    """Server-sent events stream of device changes, as the manager learns them."""
+    def stream():
+        subscription = manager.subscribe_events()
+        started = time.monotonic()
+        try:
+            yield "retry: 3000\n\n"
+            while time.monotonic() - started < events_stream_lifetime:
+                events = manager.get_events(subscription, 15)
+                if events is None:
+                    break  # Subscription expired, the browser reconnects
+                if not events:
+                    yield ": keepalive\n\n"
+                for event in events:
+                    yield f"event: device\ndata: {json.dumps(device_event_payload(event))}\n\n"
+        finally:
+            manager.unsubscribe_events(subscription)
+
+    return Response(
+        stream_with_context(stream()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+@app.route('/metrics')
+@app.route(homeurl+'/metrics')
+def metrics():
+    """Prometheus metrics, for a bearer METRICS_TOKEN or a logged in admin."""
+    authorization = request.headers.get('Authorization', '')
+    authorized = session.get('role') == "admin"
+    if metrics_token and authorization.startswith('Bearer '):
+        authorized = hmac.compare_digest(authorization[len('Bearer '):], metrics_token)
+    if not authorized:
+        return Response("Unauthorized\n", status=401, mimetype="text/plain")
+    return Response(manager.metrics(), mimetype="text/plain; version=0.0.4")
+
+@app.route(homeurl+'/api/telemetry', methods=['GET'])
+@login_required
+@admin_required
+def get_telemetry():
+    """API endpoint to fetch the telemetry history of a device (mac) or setup (iprange)."""
+    try:
+        history = manager.get_telemetry(
+            mac=request.args.get('mac'),
+            iprange=request.args.get('iprange'),
+            start=request.args.get('start', type=float),
+            end=request.args.get('end', type=float),
+            resolution=request.args.get('resolution'),
+        )
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify(history)
 
 @app.route(homeurl+'/api/show_screen/<ip>/<mac>', methods=['GET'])
 @login_required
 def show_screen_info(ip,mac):
     """API endpoint to make a device show info on screeen."""
-    device_info = manager.update_client(ip,mac)
+    device_info = manager.get_device_state(mac)
     if device_info:
         name="None"
         if device_info["name"]:
@@ -213,9 +371,8 @@ def show_screen_info(ip,mac):
 @app.route(homeurl+'/api/reboot/<ip>', methods=['GET'])
 @login_required
 def reboot_device(ip):
-    """API endpoint to make a device reboot."""
-  
-    manager.reboot_device(ip)
+    """API endpoint to make a device reboot, the device row shows when it's back."""
+    manager.start_reboot([ip])
     return jsonify({"message": "Action sent successfully."})
 
 @app.route(homeurl+'/api/playback/<ip>/<action>', methods=['GET'])
@@ -229,8 +386,8 @@ def playback_control(ip,action):
 @login_required
 def playbackall_control(iprange,action):
     """API endpoint to make a control playback."""
-    manager.playbackall_control(iprange.replace("_","/"),action)
-    return jsonify({"message": "Action sent successfully."})
+    result = manager.playbackall_control(iprange.replace("_","/"),action)
+    return jsonify({"message": "Action sent successfully.", "result": result.as_dict()})
 
 @app.route(homeurl+'/api/add_setup', methods=['POST'])
 @login_required
@@ -0,0 +1,485 @@
+"""
+Benchmarks the manager's hot paths against a simulated fleet of players, so
+performance regressions show up without a real installation.
+
+Every simulated Pi is a paramiko SSH server in this process, listening on
+its own loopback address (127.77.x.y, Linux routes all of 127.0.0.0/8 to
+the loopback interface) on a shared port. It answers the commands the
+manager sends (the probe, vcgencmd, df, free, ping, dbus-send, pactl,
+reboot, ...) with canned output, after a configurable latency and failing a
+configurable fraction of them.
+
+    python benchmark.py --sizes 10,100,500 --latency 0.005 --failure-rate 0.01
+
+For each fleet size it reports wall time, devices per second and the p50 and
+p99 of the per-device times (per-run times for scans).
+"""
+import argparse
+import contextlib
+import io
+import ipaddress
+import logging
+import math
+import os
+import random
+import re
+import selectors
+import socket
+import sqlite3
+import struct
+import tempfile
+import threading
+import time
+import uuid
+
+import paramiko
+
+from pivideo_manager import PiVideoManager
+
+NETWORK = "127.77.0.0"
+BENCHMARKS = ("scan", "collect", "playbackall", "reboot")
+
+
+class FakePi:
+    """State of one simulated player and the answers to the manager's commands."""
+
+    def __init__(self, fleet, ip, index):
+        self.fleet = fleet
+        self.ip = ip
+        # None for a board without eth0
+        self.mac = "b8:27:eb:{:02x}:{:02x}:{:02x}".format(index >> 16 & 255, index >> 8 & 255, index & 255)
+        self.boot_id = str(uuid.uuid4())
+        self.down_until = 0
+        self.stalled = False  # Never answers the clock exchange of a synchronized command
+        self.transports = []
+        self.lock = threading.Lock()
+
+    @property
+    def down(self):
+        return time.monotonic() < self.down_until
+
+    def run(self, channel, command, acknowledged):
+        """Answer command on channel, like sshd running it through a shell would."""
+        try:
+            # Output or a close sent before the exec request's reply makes the client fail the request
+            acknowledged.wait(5)
+            time.sleep(self.fleet.command_latency())
+            if command.startswith("read -t") and " go " in command:
+                self.run_synchronized(channel, command)
+                return
+            if random.random() < self.fleet.failure_rate:
+                channel.sendall_stderr(b"simulated failure\n")
+                channel.send_exit_status(1)
+                return
+            output, status = self.respond(command)
+            if output:
+                channel.sendall(output.encode())
+            channel.send_exit_status(status)
+        except Exception:
+            pass  # The manager went away or the device rebooted under it
+        finally:
+            channel.close()
+
+    def run_synchronized(self, channel, command):
+        """The two phase script of PiVideoManager.run_synchronized: clock on ping, run on go."""
+        stdin = channel.makefile("r")
+        if self.stalled:
+            stdin.read()  # Until the manager gives up and closes the channel
+            return
+        if stdin.readline().strip() != "ping":
+            channel.send_exit_status(124)
+            return
+        channel.sendall(f"{time.time():.9f}\n".encode())
+        # Like the script's read -t, give up on the trigger after its timeout
+        channel.settimeout(float(re.search(r"read -t (\d+) go", command).group(1)))
+        try:
+            go = stdin.readline().strip()
+        except socket.timeout:
+            go = None
+        if go != "go":
+            channel.send_exit_status(124)
+            return
+        channel.sendall(f"{time.time():.9f}\n".encode())
+        failed = random.random() < self.fleet.failure_rate
+        channel.send_exit_status(1 if failed else 0)
+
+    def respond(self, command):
+        """(stdout, exit status) of command."""
+        if "sudo reboot" in command:
+            output = self.boot_id + "\n" if "boot_id" in command else ""
+            threading.Timer(0.05, self.reboot).start()
+            return output, 0
+        if "echo ready" in command:
+            return f"{self.boot_id}\nready\n", 0
+        if "temperature=" in command:
+            return self.probe(command), 0
+        if "player=omxplayer" in command:
+            return "player=omxplayer\naudio=pulse\n", 0
+        # The per-metric getters, for what the probe left out
+        command = command.strip()
+        if command.startswith("vcgencmd measure_temp"):
+            return self.temperature() + "\n", 0
+        if command.startswith("df "):
+            return self.storage() + "\n", 0
+        if command.startswith("free "):
+            return self.ram() + "\n", 0
+        if command.startswith("ping "):
+            return self.ping(command), 0
+        if command.startswith("cat") and "device-tree/model" in command:
+            return self.model() + "\x00", 0
+        if command.startswith("cat") and "eth0/address" in command:
+            return (self.mac + "\n", 0) if self.mac else ("", 1)
+        # dbus-send, pactl, amixer, pkill, ...: nothing to print
+        return "", 0
+
+    def probe(self, command):
+        # Like vcgencmd or df now and then on a real Pi, a metric comes back
+        # empty so the manager falls back to its getter for it
+        def metric(output):
+            return "" if random.random() < self.fleet.failure_rate else output
+
+        lines = [
+            f"temperature={metric(self.temperature())}",
+            f"storage={metric(self.storage())}",
+            f"boot_id={self.boot_id}",
+        ]
+        known = re.search(r"!= '([^']*)'", command)
+        if "model=" in command and (known is None or known.group(1) != self.boot_id):
+            lines += [f"model={metric(self.model())}", f"mac={metric(self.mac or '')}", f"ram={metric(self.ram())}"]
+        if "lag=" in command:
+            lines.append("lag=" + self.ping(command))
+        return "\n".join(lines) + "\n"
+
+    def temperature(self):
+        return f"temp={random.uniform(45, 65):.1f}'C"
+
+    def storage(self):
+        return f"/dev/root {31 * 2**30} {15 * 2**30} {14 * 2**30} 52% /"
+
+    def model(self):
+        return "Raspberry Pi 4 Model B Rev 1.4"
+
+    def ram(self):
+        return "3794"
+
+    def ping(self, command):
+        """Round trip times printed by the manager's lag command, some lost at the failure rate."""
+        samples = int(re.search(r"-c (\d+)", command).group(1))
+        interval = re.search(r"-i ([0-9.]+)", command)
+        # ping waits between echo requests, which is most of what a lag measurement costs
+        time.sleep((samples - 1) * float(interval.group(1)) if interval else 0)
+        times = [f"{random.gauss(0.45, 0.08):.3f}" for _ in range(samples)
+                 if random.random() >= self.fleet.failure_rate]
+        return " ".join(times)
+
+    def reboot(self):
+        """Drop every connection and stay unreachable for the fleet's boot time."""
+        with self.lock:
+            self.down_until = time.monotonic() + self.fleet.boot_time
+            self.boot_id = str(uuid.uuid4())
+            transports, self.transports = self.transports, []
+        for transport in transports:
+            transport.close()
+
+
+class FakeSSHServer(paramiko.ServerInterface):
+    """paramiko server side of one connection to a FakePi."""
+
+    def __init__(self, device):
+        self.device = device
+
+    def get_allowed_auths(self, username):
+        return "password"
+
+    def check_auth_password(self, username, password):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_channel_request(self, kind, chanid):
+        return paramiko.OPEN_SUCCEEDED if kind == "session" else paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_exec_request(self, channel, command):
+        acknowledged = channel.transport.acknowledgement(channel.remote_chanid)
+        threading.Thread(target=self.device.run, args=(channel, command.decode(), acknowledged), daemon=True).start()
+        return True
+
+
+class FakeTransport(paramiko.Transport):
+    """Server transport that tells when the exec request of a channel has been answered."""
+
+    def __init__(self, sock):
+        super().__init__(sock)
+        self.acknowledged = {}  # client's channel id -> Event
+        self.acknowledged_lock = threading.Lock()
+
+    def acknowledgement(self, chanid):
+        with self.acknowledged_lock:
+            return self.acknowledged.setdefault(chanid, threading.Event())
+
+    def _send_user_message(self, data):
+        super()._send_user_message(data)
+        raw = data.asbytes()
+        if raw[:1] == paramiko.common.cMSG_CHANNEL_SUCCESS:
+            with self.acknowledged_lock:
+                event = self.acknowledged.pop(struct.unpack(">I", raw[1:5])[0], None)
+            if event:
+                event.set()
+
+
+class FakeFleet:
+    """
+    count simulated players on consecutive loopback addresses, all accepting
+    SSH on the same port from a single thread. Use as a context manager.
+    """
+
+    def __init__(self, count, latency=0.005, failure_rate=0.0, boot_time=1.0):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.boot_time = boot_time
+        self.network = fleet_network(count)
+        hosts = (str(ip) for ip in self.network.hosts() if ip.packed[-1] not in {1, 245, 255})
+        self.devices = {}
+        for index, ip in enumerate(hosts):
+            if index == count:
+                break
+            self.devices[ip] = FakePi(self, ip, index)
+        self.host_key = paramiko.RSAKey.generate(2048)
+        self.selector = selectors.DefaultSelector()
+        self.port = None
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def command_latency(self):
+        return random.uniform(0.5, 1.5) * self.latency
+
+    def start(self):
+        for ip, device in self.devices.items():
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.bind((ip, self.port or 0))
+            sock.listen(64)
+            sock.setblocking(False)
+            self.port = sock.getsockname()[1]
+            self.selector.register(sock, selectors.EVENT_READ, device)
+        self.thread = threading.Thread(target=self.accept_loop, daemon=True)
+        self.thread.start()
+        return self
+
+    def accept_loop(self):
+        while not self.stopped.is_set():
+            for key, _ in self.selector.select(timeout=0.2):
+                try:
+                    conn, _ = key.fileobj.accept()
+                except OSError:
+                    continue
+                device = key.data
+                if device.down:
+                    conn.close()
+                    continue
+                conn.setblocking(True)
+                transport = FakeTransport(conn)
+                transport.add_server_key(self.host_key)
+                with device.lock:
+                    device.transports.append(transport)
+                try:
+                    transport.start_server(server=FakeSSHServer(device))
+                except Exception:
+                    transport.close()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread:
+            self.thread.join()
+        for key in list(self.selector.get_map().values()):
+            key.fileobj.close()
+        self.selector.close()
+        for device in self.devices.values():
+            for transport in device.transports:
+                transport.close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def fleet_network(count):
+    """Smallest network under NETWORK with room for count devices."""
+    for prefix in range(24, 8, -1):
+        network = ipaddress.ip_network(f"{NETWORK}/{prefix}")
+        if sum(1 for ip in network.hosts() if ip.packed[-1] not in {1, 245, 255}) >= count:
+            return network
+    raise ValueError(f"Too many devices: {count}")
+
+
+def make_manager(directory, fleet, reboot_probe_interval):
+    """A PiVideoManager with its own database, pointed at the fleet's SSH port."""
+    db_file = os.path.join(directory, "benchmark.db")
+    # An existing users table skips the interactive admin prompt
+    conn = sqlite3.connect(db_file)
+    conn.execute("CREATE TABLE users (id INTEGER PRIMARY KEY AUTOINCREMENT, user TEXT UNIQUE, password TEXT, setup TEXT)")
+    conn.execute("INSERT INTO users (user, password, setup) VALUES ('admin', 'admin', 'admin')")
+    conn.commit()
+    conn.close()
+
+    manager_class = type("BenchmarkManager", (PiVideoManager,), {
+        "db_file": db_file,
+        "ssh_port": fleet.port,
+        "agent_key": None,  # Only SSH is simulated
+        "reboot_probe_interval": reboot_probe_interval,
+        "message_cache_dir": os.path.join(directory, "message_cache"),
+    })
+    return manager_class()
+
+
+def percentile(values, percent):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[max(math.ceil(percent / 100 * len(values)) - 1, 0)]
+
+
+class Report:
+    """Rows of the results table."""
+
+    def __init__(self):
+        self.rows = []
+
+    def add(self, devices, name, wall, samples, failed=0, extra=""):
+        self.rows.append((devices, name, wall, devices / wall if wall else 0,
+                          percentile(samples, 50), percentile(samples, 99), failed, extra))
+        print(self.format(self.rows[-1]), flush=True)
+
+    @staticmethod
+    def header():
+        return f"{'devices':>7}  {'benchmark':<18} {'wall s':>8} {'dev/s':>8} {'p50 ms':>8} {'p99 ms':>8} {'failed':>6}"
+
+    @staticmethod
+    def format(row):
+        devices, name, wall, throughput, p50, p99, failed, extra = row
+
+        def ms(value):
+            return f"{value * 1000:8.1f}" if value is not None else f"{'-':>8}"
+
+        return f"{devices:>7}  {name:<18} {wall:8.2f} {throughput:8.1f} {ms(p50)} {ms(p99)} {failed:>6}  {extra}".rstrip()
+
+
+@contextlib.contextmanager
+def quiet(enabled):
+    """Silence the manager's progress prints (from every thread) unless verbose."""
+    if not enabled:
+        yield
+        return
+    with contextlib.redirect_stdout(io.StringIO()):
+        yield
+
+
+def timed(function, verbose):
+    with quiet(not verbose):
+        start = time.monotonic()
+        value = function()
+        return value, time.monotonic() - start
+
+
+def run_size(count, args, report):
+    with tempfile.TemporaryDirectory() as directory, FakeFleet(
+        count, args.latency, args.failure_rate, args.boot_time
+    ) as fleet:
+        with quiet(not args.verbose):
+            manager = make_manager(directory, fleet, args.reboot_probe_interval)
+        iprange = str(fleet.network)
+        timed(lambda: manager.create_setup("benchmark", iprange, "benchmark"), args.verbose)
+        ips = list(fleet.devices)
+
+        # Devices have to be known (and have a master) for everything else
+        _, wall = timed(lambda: manager.scan_ip_range(iprange), args.verbose)
+        known = len(manager.get_all_devices_in_iprange(iprange))
+        report.add(count, "scan (first)", wall, [wall], count - known)
+        timed(lambda: manager.set_master_device(ips[0]), args.verbose)
+
+        if "scan" in args.benchmarks:
+            for incremental in (False, True):
+                walls = []
+                for _ in range(args.repeat):
+                    _, wall = timed(lambda: manager.scan_ip_range(iprange, incremental=incremental), args.verbose)
+                    walls.append(wall)
+                missing = sum(1 for d in manager.get_all_devices_in_iprange(iprange) if d["missing"])
+                name = "scan incremental" if incremental else "scan full"
+                report.add(count, name, sum(walls) / len(walls), walls, missing)
+
+        if "collect" in args.benchmarks:
+            def collect(ip):
+                with manager.device_connection(ip) as client:
+                    if client is None:
+                        raise ConnectionError("could not connect")
+                    return manager.collect_device_info(ip, client)
+
+            for _ in range(args.repeat):
+                result, wall = timed(lambda: manager.run_on_devices(ips, collect), args.verbose)
+                report.add(count, "collect_device_info", wall, list(result.durations.values()), len(result.failed))
+
+        if "playbackall" in args.benchmarks:
+            for synchronized in (True, False):
+                for _ in range(args.repeat):
+                    result, wall = timed(
+                        lambda: manager.playbackall_control(iprange, "mute", synchronized=synchronized), args.verbose
+                    )
+                    spread = f"spread {result.spread:.1f} ms" if result.spread is not None else ""
+                    name = "playbackall sync" if synchronized else "playbackall"
+                    report.add(count, name, wall, list(result.durations.values()), len(result.failed), spread)
+
+        if "reboot" in args.benchmarks:
+            batch_size = args.reboot_batch or max(5, count // 10)
+            result, wall = timed(lambda: manager.reboot_setup("benchmark", batch_size), args.verbose)
+            # Devices left out after a failed batch have no time to report
+            rebooted = [result.durations[ip] for ip in result.results]
+            report.add(count, "reboot_setup", wall, rebooted, len(result.failed), f"batches of {batch_size}")
+
+        timed(manager.close_connections, args.verbose)
+
+
+def raise_file_limit():
+    """Every device needs a listening socket and both ends of a connection."""
+    try:
+        import resource
+    except ImportError:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != resource.RLIM_INFINITY and (hard == resource.RLIM_INFINITY or soft < hard):
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard if hard != resource.RLIM_INFINITY else 65536, hard))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark pivideo_manager against a simulated fleet")
+    parser.add_argument("--sizes", default="10,100,500", help="comma separated fleet sizes")
+    parser.add_argument("--benchmarks", default=",".join(BENCHMARKS),
+                        help=f"comma separated, any of {', '.join(BENCHMARKS)}")
+    parser.add_argument("--repeat", type=int, default=3, help="runs of each benchmark (reboot runs once)")
+    parser.add_argument("--latency", type=float, default=0.005, help="mean seconds a device takes per command")
+    parser.add_argument("--failure-rate", type=float, default=0.0,
+                        help="fraction of commands (and pings) that fail")
+    parser.add_argument("--boot-time", type=float, default=1.0, help="seconds a device is unreachable after reboot")
+    parser.add_argument("--reboot-batch", type=int, help="devices rebooted at once (default a tenth of the fleet)")
+    parser.add_argument("--reboot-probe-interval", type=float, default=0.2)
+    parser.add_argument("--seed", type=int, help="random seed, for repeatable latencies and failures")
+    parser.add_argument("--verbose", action="store_true", help="show the manager's own output")
+    args = parser.parse_args()
+    args.benchmarks = [name.strip() for name in args.benchmarks.split(",") if name.strip()]
+    unknown = set(args.benchmarks) - set(BENCHMARKS)
+    if unknown:
+        parser.error(f"unknown benchmarks: {', '.join(sorted(unknown))}")
+    if args.seed is not None:
+        random.seed(args.seed)
+
+    if not args.verbose:
+        # Port sweeps close connections before the SSH banner, which paramiko logs as errors
+        logging.getLogger("paramiko").setLevel(logging.CRITICAL)
+    raise_file_limit()
+    report = Report()
+    print(Report.header())
+    for count in (int(size) for size in args.sizes.split(",")):
+        run_size(count, args, report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,266 @@
+"""
+Control plane: a single long-lived process owning the PiVideoManager, so
+SSH connections, caches, the telemetry poller and actions in flight are
+shared by every gunicorn worker instead of being built once per worker.
+
+Workers (and scripts like reboot_setup.py) talk to it over a local unix
+socket with connect(), which returns an object with the manager's methods.
+If no control plane is running, connect() starts one in the background.
+To run it yourself (e.g. as a service, before starting gunicorn):
+
+    python control_plane.py
+"""
+import os
+import queue
+import secrets
+import signal
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from multiprocessing.managers import BaseManager
+
+from metrics import REGISTRY
+
+SOCKET = os.environ.get("PIVIDEO_CONTROL_SOCKET", os.path.abspath("pivideo_control.sock"))
+
+# Manager methods callable through the control plane
+MANAGER_METHODS = (
+    "check_login", "create_setup", "delete_setup", "get_setups", "get_setups_with_devices",
+    "get_setup_by_friendlyurl", "get_device_by_mac", "get_device_state", "request_poll",
+    "set_master_device", "update_device_name_and_master", "sort_devices",
+    "start_scan", "get_scan_job", "cancel_scan", "get_telemetry",
+    "show_txt_message_on_screen", "start_reboot", "reboot_setup",
+    "playback_control", "playbackall_control", "metrics",
+)
+
+HTTP_REQUEST_SECONDS = REGISTRY.histogram(
+    "pivideo_http_request_seconds", "Dashboard and API requests by route, from every worker",
+    ["route", "method", "status"],
+)
+
+
+class ControlService:
+    """
+    What the control plane serves: the manager's methods, plus device event
+    subscriptions, which can't cross processes as queues so clients poll them.
+    """
+
+    # Subscriptions nobody asked for events in this long are dropped (their worker went away)
+    subscription_timeout = 120
+
+    def __init__(self, manager):
+        self.manager = manager
+        self.subscriptions = {}  # id -> [events queue, last poll]
+        self.lock = threading.Lock()
+
+    def __getattr__(self, name):
+        if name in MANAGER_METHODS:
+            return getattr(self.manager, name)
+        raise AttributeError(name)
+
+    def record_http_request(self, route, method, status, seconds):
+        """Workers report their requests here so metrics cover all of them."""
+        HTTP_REQUEST_SECONDS.observe(seconds, route=route, method=method, status=status)
+
+    def subscribe_events(self):
+        """Start collecting device events for a client, returns the subscription id."""
+        self.expire_subscriptions()
+        subscription = uuid.uuid4().hex
+        with self.lock:
+            self.subscriptions[subscription] = [self.manager.events.subscribe(), time.monotonic()]
+        return subscription
+
+    def get_events(self, subscription, timeout=15):
+        """Events of a subscription, waiting up to timeout seconds for the first one. None if it expired."""
+        with self.lock:
+            entry = self.subscriptions.get(subscription)
+            if entry is None:
+                return None
+            entry[1] = time.monotonic()
+        events = entry[0]
+        try:
+            collected = [events.get(timeout=timeout)]
+        except queue.Empty:
+            return []
+        while True:
+            try:
+                collected.append(events.get_nowait())
+            except queue.Empty:
+                return collected
+
+    def unsubscribe_events(self, subscription):
+        with self.lock:
+            entry = self.subscriptions.pop(subscription, None)
+        if entry:
+            self.manager.events.unsubscribe(entry[0])
+
+    def expire_subscriptions(self):
+        now = time.monotonic()
+        with self.lock:
+            expired = [key for key, (_, polled) in self.subscriptions.items()
+                       if now - polled > self.subscription_timeout]
+        for subscription in expired:
+            self.unsubscribe_events(subscription)
+
+
+class ControlPlane(BaseManager):
+    pass
+
+
+SERVICE_METHODS = MANAGER_METHODS + ("record_http_request", "subscribe_events", "get_events", "unsubscribe_events")
+ControlPlane.register("service", exposed=SERVICE_METHODS)
+
+
+class ControlPlaneClient:
+    """
+    Calls the control plane's methods as if it were a PiVideoManager. If the
+    connection drops (e.g. the control plane restarted) it reconnects, starting
+    a new control plane if needed, and tries the call once more if it was never
+    sent; a call lost while running raises, and the next one reconnects.
+    """
+
+    def __init__(self, address=SOCKET, authkey=None, spawn=True):
+        self.address = address
+        self.authkey = authkey or load_authkey(address)
+        self.spawn = spawn
+        self.lock = threading.Lock()
+        self.service = None
+
+    def connect(self):
+        with self.lock:
+            if self.service is None:
+                self.service = open_service(self.address, self.authkey, self.spawn)
+            return self.service
+
+    def call(self, name, *args, **kwargs):
+        service = self.connect()
+        try:
+            return service._callmethod(name, args, kwargs)
+        except (BrokenPipeError, ConnectionRefusedError, FileNotFoundError):
+            # The request never got to the control plane (e.g. it restarted), so it can be sent again
+            self.drop(service)
+            return self.connect()._callmethod(name, args, kwargs)
+        except (ConnectionError, EOFError):
+            # The control plane went away after getting the request, which may have run: a pause
+            # toggle must not run twice, so only the next call reconnects
+            self.drop(service)
+            raise
+
+    def drop(self, service):
+        # multiprocessing keeps one connection per thread and address, forget the dead one
+        if hasattr(service._tls, "connection"):
+            del service._tls.connection
+        with self.lock:
+            if self.service is service:
+                self.service = None
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return lambda *args, **kwargs: self.call(name, *args, **kwargs)
+
+
+def open_service(address, authkey, spawn=True, spawn_timeout=30):
+    """Proxy to the running control plane's service, starting the control plane if spawn and it isn't running."""
+    deadline = time.monotonic() + spawn_timeout
+    spawned = False
+    while True:
+        plane = ControlPlane(address=address, authkey=authkey)
+        try:
+            plane.connect()
+            return plane.service()
+        except (FileNotFoundError, ConnectionRefusedError):
+            if not spawn or time.monotonic() > deadline:
+                raise
+        if not spawned:
+            print(f"Starting control plane on {address}")
+            subprocess.Popen([sys.executable, os.path.abspath(__file__), address], start_new_session=True)
+            spawned = True
+        time.sleep(0.2)
+
+
+def connect(address=SOCKET, authkey=None, spawn=True):
+    """Client for the control plane at address (see ControlPlaneClient)."""
+    return ControlPlaneClient(address, authkey, spawn)
+
+
+def load_authkey(address=SOCKET):
+    """
+    Key clients and control plane authenticate each other with: PIVIDEO_CONTROL_KEY,
+    or a random one created next to the socket, only readable by its owner.
+    """
+    key = os.environ.get("PIVIDEO_CONTROL_KEY")
+    if key:
+        return key.encode()
+    path = address + ".key"
+    if not os.path.exists(path):
+        # Written aside and linked into place, so nobody reads a half written key
+        temporary = f"{path}.{os.getpid()}.{threading.get_ident()}"
+        fd = os.open(temporary, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, "w") as f:
+            f.write(secrets.token_hex(32))
+        try:
+            os.link(temporary, path)
+        except FileExistsError:
+            pass  # Another process made one first
+        finally:
+            os.unlink(temporary)
+    with open(path) as f:
+        return f.read().strip().encode()
+
+
+def acquire_lock(address):
+    """Lock file held while a control plane serves address, None if another one does."""
+    import fcntl
+
+    lock_file = open(address + ".lock", "w")
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock_file.close()
+        return None
+    return lock_file
+
+
+def serve(address=SOCKET, authkey=None):
+    """Run the control plane until interrupted. Returns False if one already serves address."""
+    from pivideo_manager import PiVideoManager
+
+    lock_file = acquire_lock(address)
+    if lock_file is None:
+        print(f"A control plane is already running on {address}")
+        return False
+    # Left behind by a control plane that didn't shut down cleanly
+    if os.path.exists(address):
+        os.unlink(address)
+
+    authkey = authkey or load_authkey(address)
+    manager = PiVideoManager()
+    manager.start_poller()
+    service = ControlService(manager)
+    ControlPlane.register("service", callable=lambda: service, exposed=SERVICE_METHODS)
+
+    plane = ControlPlane(address=address, authkey=authkey)
+    # Requests are pickles, the socket must never be reachable by other users, not even briefly
+    umask = os.umask(0o077)
+    try:
+        server = plane.get_server()
+    finally:
+        os.umask(umask)
+    print(f"Control plane listening on {address}")
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server.serve_forever()
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    finally:
+        # The socket file itself is removed by the listener on exit
+        manager.close_connections()
+        lock_file.close()
+    return True
+
+
+if __name__ == "__main__":
+    serve(sys.argv[1] if len(sys.argv) > 1 else SOCKET)
@@ -1,6 +1,6 @@
 import paramiko
+import select
 import time
-import platform
 import ipaddress
 import subprocess
 import sqlite3
@@ -9,86 +9,1294 @@ import concurrent.futures
 import threading
 import unicodedata
 import re
+import asyncio
+import uuid
+import os
+import socket
+import hashlib
+import tempfile
+import queue
+from collections import OrderedDict
+from contextlib import contextmanager
+from playback_agent import (
+    GROUP as AGENT_GROUP, PORT as AGENT_PORT, OMXPLAYER_COMMANDS, PULSE_COMMANDS, ALSA_COMMAND,
+    pack_message, unpack_message,
+)
+from metrics import REGISTRY
+
+SSH_CONNECT_SECONDS = REGISTRY.histogram(
+    "pivideo_ssh_connect_seconds", "Time to get an SSH connection to a device (pooled, connected or failed)",
+    ["outcome"],
+)
+REMOTE_COMMAND_SECONDS = REGISTRY.histogram(
+    "pivideo_remote_command_seconds", "Remote commands by kind, from start to exit (ok, failed or error)",
+    ["kind", "outcome"],
+)
+SCAN_STAGE_SECONDS = REGISTRY.histogram("pivideo_scan_stage_seconds", "Time spent in each stage of a scan", ["stage"])
+SCANS = REGISTRY.counter("pivideo_scans_total", "Scans run, by mode and outcome", ["mode", "outcome"])
+DB_SECONDS = REGISTRY.histogram("pivideo_db_seconds", "SQLite reads and write transactions", ["operation"])
+DB_ERRORS = REGISTRY.counter("pivideo_db_errors_total", "SQLite operations that failed", ["operation"])
+DEVICES = REGISTRY.gauge("pivideo_devices", "Devices per setup and state (online, missing or rebooting)",
+                         ["setup", "state"])
+DEVICE_TEMPERATURE = REGISTRY.gauge("pivideo_device_temperature_celsius", "Last temperature read from a device",
+                                    ["setup", "device", "ip", "mac"])
+DEVICE_LAG = REGISTRY.gauge("pivideo_device_lag_milliseconds", "Last lag measured from a device to its master",
+                            ["setup", "device", "ip", "mac"])
+DEVICE_LAG_LOSS = REGISTRY.gauge("pivideo_device_lag_loss_ratio", "Pings to the master lost in the last lag burst",
+                                 ["setup", "device", "ip", "mac"])
+
+
+class Database:
+    """
+    Shared SQLite access for the manager.
+
+    Every thread keeps its own persistent connection (recreated after a fork,
+    so gunicorn workers never share one), the database runs in WAL mode so
+    readers never wait behind a writer, and a busy timeout makes concurrent
+    writers queue instead of failing with "database is locked". Statements are
+    kept as constant strings so sqlite3's statement cache reuses them.
+    """
+
+    def __init__(self, path, timeout=30, cached_statements=256):
+        self.path = path
+        self.timeout = timeout
+        self.cached_statements = cached_statements
+        self.local = threading.local()
+        self.generation = 0  # bumped on every commit made through this object that changed rows
+        self.cache = {}  # (key, thread) -> (version, created, value)
+        self.cache_lock = threading.Lock()
+
+    def connection(self):
+        """Return this thread's connection, opening it on first use."""
+        conn = getattr(self.local, "conn", None)
+        if conn is None or self.local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=self.timeout, cached_statements=self.cached_statements)
+            conn.row_factory = sqlite3.Row  # Enables dictionary-like access
+            conn.execute("PRAGMA journal_mode = WAL")
+            conn.execute(f"PRAGMA busy_timeout = {int(self.timeout * 1000)}")
+            conn.execute("PRAGMA synchronous = NORMAL")
+            conn.execute("PRAGMA foreign_keys = ON")
+            self.local.conn = conn
+            self.local.pid = os.getpid()
+        return conn
+
+    @contextmanager
+    def transaction(self, immediate=False):
+        """Yield a cursor; everything done with it is committed together or rolled back.
+
+        With immediate=True the write lock is taken up front, which also makes
+        schema changes (DDL) part of the transaction.
+        """
+        conn = self.connection()
+        cursor = conn.cursor()
+        start = time.monotonic()
+        changes = conn.total_changes
+        if immediate:
+            cursor.execute("BEGIN IMMEDIATE")
+        try:
+            yield cursor
+            conn.commit()
+            # Transactions that wrote nothing leave caches valid
+            if conn.total_changes != changes:
+                self.generation += 1
+        except Exception:
+            conn.rollback()
+            DB_ERRORS.inc(operation="write")
+            raise
+        finally:
+            cursor.close()
+            DB_SECONDS.observe(time.monotonic() - start, operation="write")
+
+    def execute(self, sql, params=()):
+        """Run a single write statement and commit it. Returns the number of rows changed."""
+        with self.transaction() as cursor:
+            cursor.execute(sql, params)
+            return cursor.rowcount
+
+    def executemany(self, sql, rows):
+        with self.transaction() as cursor:
+            cursor.executemany(sql, rows)
+            return cursor.rowcount
+
+    def fetchone(self, sql, params=()):
+        """Return the first row as a dictionary, or None."""
+        with self.timed_read():
+            row = self.connection().execute(sql, params).fetchone()
+        return dict(row) if row else None
+
+    def fetchall(self, sql, params=()):
+        """Return every row as a list of dictionaries."""
+        with self.timed_read():
+            rows = self.connection().execute(sql, params).fetchall()
+        return [dict(row) for row in rows]
+
+    @contextmanager
+    def timed_read(self):
+        start = time.monotonic()
+        try:
+            yield
+        except Exception:
+            DB_ERRORS.inc(operation="read")
+            raise
+        finally:
+            DB_SECONDS.observe(time.monotonic() - start, operation="read")
+
+    def version(self):
+        """
+        A value that changes whenever anything is committed to the database,
+        whether by this process or by another one (e.g. another gunicorn worker).
+        """
+        # data_version is per connection and only moves on commits from other connections
+        data_version = self.connection().execute("PRAGMA data_version").fetchone()[0]
+        return (os.getpid(), threading.get_ident(), data_version, self.generation)
+
+    def cached(self, key, compute, ttl=5):
+        """
+        Return compute() cached for ttl seconds, or until the database changes.
+
+        Versions are only comparable on the same connection, so every thread
+        keeps its own entry instead of invalidating the others'.
+        """
+        version = self.version()
+        key = (key, threading.get_ident())
+        with self.cache_lock:
+            entry = self.cache.get(key)
+        if entry and entry[0] == version and time.monotonic() - entry[1] < ttl:
+            return entry[2]
+
+        value = compute()
+        with self.cache_lock:
+            self.cache[key] = (version, time.monotonic(), value)
+        return value
+
+    def close(self):
+        """Close the calling thread's connection."""
+        conn = getattr(self.local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self.local.conn = None
+
+
+class SSHConnectionPool:
+    """
+    Keeps SSH connections to devices open between calls so each action only
+    pays for a channel open instead of a full TCP + SSH handshake.
+
+    Connections are keyed by IP, can be bound to a MAC address (so a device
+    that moved to a new IP drops its stale connection), are kept alive with
+    SSH keepalives, checked for liveness before being handed out, evicted
+    after idle_timeout seconds and capped at max_size (least recently used
+    connections are closed first). Connections borrowed with get(borrow=True)
+    are never closed by the pool until they are given back with release(), the
+    pool grows past max_size instead and shrinks again as they come back.
+    """
+
+    def __init__(self, connect, max_size=256, idle_timeout=300, keepalive=30):
+        self.connect = connect  # callable(ip) -> paramiko.SSHClient or None
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.keepalive = keepalive
+
+        self.clients = OrderedDict()  # ip -> [client, last_used]
+        self.macs = {}  # mac -> ip
+        self.borrowed = {}  # ip -> number of borrowers using its connection
+        self.lock = threading.Lock()
+        self.ip_locks = {}  # ip -> lock, avoids two threads connecting to the same device
+        self.reaper = None
+
+    def is_alive(self, client):
+        """Check that the underlying transport is still usable."""
+        transport = client.get_transport()
+        if transport is None or not transport.is_active():
+            return False
+        try:
+            transport.send_ignore()
+            return True
+        except Exception:
+            return False
+
+    def get(self, ip, borrow=False):
+        """Return a live connection to ip, reconnecting if needed. With borrow, release(ip) it when done."""
+        with self.lock:
+            ip_lock = self.ip_locks.setdefault(ip, threading.Lock())
+
+        with ip_lock:
+            with self.lock:
+                entry = self.clients.get(ip)
+
+            if entry:
+                if self.is_alive(entry[0]):
+                    with self.lock:
+                        entry[1] = time.monotonic()
+                        if ip in self.clients:
+                            self.clients.move_to_end(ip)
+                        if borrow:
+                            self.borrowed[ip] = self.borrowed.get(ip, 0) + 1
+                    return entry[0]
+                print(f"Connection to {ip} is dead, reconnecting")
+                self.discard(ip)
+
+            client = self.connect(ip)
+            if client is None:
+                return None
+
+            transport = client.get_transport()
+            if transport is not None and self.keepalive:
+                transport.set_keepalive(self.keepalive)
+
+            with self.lock:
+                self.clients[ip] = [client, time.monotonic()]
+                self.clients.move_to_end(ip)
+                if borrow:
+                    self.borrowed[ip] = self.borrowed.get(ip, 0) + 1
+            self.trim()
+
+            self.start_reaper()
+            return client
+
+    def release(self, ip):
+        """Give back a connection borrowed with get(ip, borrow=True)."""
+        with self.lock:
+            count = self.borrowed.get(ip, 0) - 1
+            if count > 0:
+                self.borrowed[ip] = count
+            else:
+                self.borrowed.pop(ip, None)
+        self.trim()
+
+    def trim(self):
+        """Close least recently used connections nobody is using until the pool is back to max_size."""
+        evicted = []
+        with self.lock:
+            for ip in list(self.clients):
+                if len(self.clients) <= self.max_size:
+                    break
+                if not self.borrowed.get(ip):
+                    evicted.append(self.clients.pop(ip)[0])
+        for client in evicted:
+            client.close()
+
+    def bind_mac(self, ip, mac):
+        """Remember which device lives at ip, closing its connection at a previous IP."""
+        if not mac:
+            return
+        with self.lock:
+            old_ip = self.macs.get(mac)
+            self.macs[mac] = ip
+        if old_ip and old_ip != ip:
+            self.discard(old_ip)
+
+    def discard(self, ip):
+        """Close and forget the connection to ip."""
+        with self.lock:
+            entry = self.clients.pop(ip, None)
+        if entry:
+            try:
+                entry[0].close()
+            except Exception:
+                pass
+
+    def evict_idle(self):
+        """Close connections that have not been used for idle_timeout seconds."""
+        now = time.monotonic()
+        with self.lock:
+            idle = [ip for ip, (_, last_used) in self.clients.items()
+                    if now - last_used > self.idle_timeout and not self.borrowed.get(ip)]
+        for ip in idle:
+            print(f"Closing idle connection to {ip}")
+            self.discard(ip)
+
+    def start_reaper(self):
+        """Start the background thread that evicts idle connections."""
+        with self.lock:
+            if self.reaper is not None and self.reaper.is_alive():
+                return
+            self.reaper = threading.Thread(target=self.reap, daemon=True)
+            self.reaper.start()
+
+    def reap(self):
+        while True:
+            time.sleep(max(1, min(self.keepalive or 30, self.idle_timeout)))
+            self.evict_idle()
+            with self.lock:
+                if not self.clients:
+                    self.reaper = None
+                    return
+
+    def items(self):
+        with self.lock:
+            return [(ip, entry[0]) for ip, entry in self.clients.items()]
+
+    def __len__(self):
+        return len(self.clients)
+
+    def __contains__(self, ip):
+        return ip in self.clients
+
+    def close_all(self):
+        """Close every pooled connection."""
+        with self.lock:
+            clients = list(self.clients.items())
+            self.clients.clear()
+            self.macs.clear()
+        for ip, (client, _) in clients:
+            client.close()
+            print(f"Closed connection to {ip}")
+
+
+class FleetResult:
+    """
+    Aggregated outcome of running an action on many devices: the value each
+    device returned, the error of the ones that failed and how long each took.
+    """
+
+    def __init__(self):
+        self.results = {}  # ip -> value returned by the action
+        self.errors = {}  # ip -> error message
+        self.durations = {}  # ip -> seconds
+        self.skews = {}  # ip -> ms the action ran after the shared deadline (synchronized actions)
+        self.elapsed = 0
+
+    def add(self, ip, value, duration):
+        self.results[ip] = value
+        self.durations[ip] = duration
+
+    def fail(self, ip, error, duration):
+        self.errors[ip] = error
+        self.durations[ip] = duration
+
+    @property
+    def ok(self):
+        return [ip for ip, value in self.results.items() if value is not False]
+
+    @property
+    def failed(self):
+        return list(self.errors) + [ip for ip, value in self.results.items() if value is False]
+
+    @property
+    def slowest(self):
+        if not self.durations:
+            return None
+        return max(self.durations, key=self.durations.get)
+
+    @property
+    def spread(self):
+        """ms between the first and the last device to act in a synchronized action."""
+        if not self.skews:
+            return None
+        return max(self.skews.values()) - min(self.skews.values())
+
+    def __bool__(self):
+        return not self.failed
+
+    def as_dict(self):
+        return {
+            "ok": self.ok,
+            "failed": self.failed,
+            "errors": self.errors,
+            "durations": {ip: round(d, 3) for ip, d in self.durations.items()},
+            "skews": {ip: round(skew, 2) for ip, skew in self.skews.items()},
+            "spread": round(self.spread, 2) if self.spread is not None else None,
+            "elapsed": round(self.elapsed, 3),
+        }
+
+
+class InFlightCalls:
+    """
+    Lets identical calls made at the same time share one run: the first caller
+    runs it and the others, e.g. another dashboard clicking the same button,
+    wait for and get its result instead of repeating the work.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}  # key -> Future of the running call
+
+    def run(self, key, function):
+        with self.lock:
+            future = self.calls.get(key)
+            owner = future is None
+            if owner:
+                future = self.calls[key] = concurrent.futures.Future()
+        if owner:
+            try:
+                future.set_result(function())
+            except BaseException as e:
+                future.set_exception(e)
+            finally:
+                with self.lock:
+                    del self.calls[key]
+        return future.result()
+
+
+class RemoteResult:
+    """
+    Outcome of one command run on a device: exit status (None if it never
+    finished), its output, how long it took and, when it didn't complete,
+    why (couldn't connect, deadline passed, cancelled, connection lost).
+    """
+
+    def __init__(self, ip, command, exit_status=None, stdout="", stderr="", duration=0, error=None):
+        self.ip = ip
+        self.command = command
+        self.exit_status = exit_status
+        self.stdout = stdout
+        self.stderr = stderr
+        self.duration = duration
+        self.error = error
+
+    @property
+    def ok(self):
+        return self.error is None and self.exit_status == 0
+
+    def __bool__(self):
+        return self.ok
+
+    def as_dict(self):
+        return {
+            "ip": self.ip,
+            "exit_status": self.exit_status,
+            "stdout": self.stdout,
+            "stderr": self.stderr,
+            "duration": round(self.duration, 3),
+            "error": self.error,
+        }
+
+
+class RemoteCommand:
+    """
+    A command started on a device. wait() blocks on the SSH channel itself
+    until the command exits or its deadline passes, there is no polling, so
+    results are back as soon as the device answers. cancel() may be called
+    from any thread and makes wait() return right away.
+    """
+
+    def __init__(self, ip, command, channel, release=None):
+        self.ip = ip
+        self.command = command
+        self.channel = channel
+        self.release = release  # Called once the command is over, gives its connection back to the pool
+        self.started = time.monotonic()
+        self.cancelled = False
+        self.buffer = b""  # Output read by read_line() and not returned yet
+
+    def cancel(self):
+        self.cancelled = True
+        self.channel.close()
+        self.done()
+
+    def done(self):
+        release, self.release = self.release, None
+        if release:
+            release()
+
+    def read_line(self, timeout=None):
+        """Read one line of output, None if the command ended or timeout passed first."""
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        while b"\n" not in self.buffer:
+            self.channel.settimeout(max(deadline - time.monotonic(), 0.001) if deadline is not None else None)
+            try:
+                data = self.channel.recv(32768)
+            except socket.timeout:
+                return None
+            if not data:
+                return None
+            self.buffer += data
+        line, self.buffer = self.buffer.split(b"\n", 1)
+        return line.decode(errors="replace")
+
+    def send(self, data, close=False):
+        """Write data to the command's stdin, closing it afterwards if close is set."""
+        self.channel.sendall(data)
+        if close:
+            self.channel.shutdown_write()
+
+    def wait(self, timeout=None, since=None):
+        """
+        Wait for the command to finish, at most timeout seconds from since (a
+        time.monotonic(), by default its start), and return a RemoteResult.
+        """
+        deadline = (since or self.started) + timeout if timeout is not None else None
+
+        def remaining():
+            return max(deadline - time.monotonic(), 0.001) if deadline is not None else None
+
+        stdout, stderr = [self.buffer], []
+        self.buffer = b""
+        error = None
+        try:
+            for receive, chunks in ((self.channel.recv, stdout), (self.channel.recv_stderr, stderr)):
+                while True:
+                    self.channel.settimeout(remaining())
+                    data = receive(32768)
+                    if not data:
+                        break
+                    chunks.append(data)
+            if not self.channel.status_event.wait(remaining()):
+                error = "timed out"
+        except socket.timeout:
+            error = "timed out"
+        except Exception as e:
+            error = str(e)
+
+        if self.cancelled:
+            error = "cancelled"
+        elif error is None and not self.channel.exit_status_ready():
+            error = "connection lost"
+        if error:
+            self.channel.close()
+
+        result = RemoteResult(
+            self.ip,
+            self.command,
+            exit_status=None if error else self.channel.recv_exit_status(),
+            stdout=b"".join(stdout).decode(errors="replace"),
+            stderr=b"".join(stderr).decode(errors="replace"),
+            duration=time.monotonic() - self.started,
+            error=error,
+        )
+        self.done()
+        return result
+
+
+class PlaybackAgentClient:
+    """
+    Sends playback commands to the playback agents of many devices in one UDP
+    multicast packet and collects their acks. Devices that haven't acked after
+    ack_timeout seconds get the command again (same id, so agents that did run
+    it only ack again), up to retries times.
+    """
+
+    def __init__(self, key, group, port, interface="0.0.0.0", ack_timeout=0.2, retries=2):
+        self.key = key
+        self.group = group
+        self.port = port
+        self.interface = interface
+        self.ack_timeout = ack_timeout
+        self.retries = retries
+
+    def send(self, command, macs):
+        """Send command to the agents of macs, returns {mac: ack} for the ones that answered."""
+        return self.exchange({"type": "command", "command": command}, macs)
+
+    def hello(self, macs):
+        """Ask the agents of macs to answer without running anything, returns {mac: ack} for the ones that did."""
+        return self.exchange({"type": "hello"}, macs)
+
+    def exchange(self, message, macs):
+        pending = set(macs)
+        acks = {}
+        if not pending:
+            return acks
+
+        message = {**message, "id": uuid.uuid4().hex, "ts": time.time()}
+        start = time.monotonic()
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        try:
+            sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton(self.interface))
+            sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)
+            for attempt in range(self.retries + 1):
+                sock.sendto(pack_message({**message, "targets": sorted(pending)}, self.key), (self.group, self.port))
+                deadline = time.monotonic() + self.ack_timeout
+                while pending:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0 or not select.select([sock], [], [], remaining)[0]:
+                        break
+                    ack = unpack_message(sock.recv(65536), self.key)
+                    if not ack or ack.get("type") != "ack" or ack.get("id") != message["id"]:
+                        continue
+                    if ack.get("mac") in pending:
+                        pending.discard(ack["mac"])
+                        acks[ack["mac"]] = {**ack, "latency": time.monotonic() - start}
+                if not pending:
+                    break
+        except OSError as e:
+            print(f"Could not reach playback agents: {e}")
+        finally:
+            sock.close()
+        return acks
+
+
+class ScanJob:
+    """
+    A scan of one IP range running in a background thread.
+
+    Progress lives in memory in the process running the scan and is flushed
+    to the scan_jobs table (at most every flush_interval seconds), so any
+    gunicorn worker can report it. Cancellation goes the other way: the flag
+    is set in the table and picked up by the running scan.
+    """
+
+    flush_interval = 0.5
+
+    def __init__(self, manager, ip_range):
+        self.manager = manager
+        self.id = uuid.uuid4().hex
+        self.ip_range = ip_range
+        self.status = "queued"
+        self.total = 0  # hosts to probe
+        self.probed = 0
+        self.candidates = 0  # hosts that answered on the SSH port
+        self.collected = 0
+        self.found = 0  # devices identified by MAC
+        self.missing = 0
+        self.error = None
+        self.started = time.time()
+        self.finished = None
+        self.cancel_requested = False
+        self.lock = threading.Lock()
+        self.last_flush = 0
+        self.last_cancel_check = 0
+
+    def progress(self, **counters):
+        """Increment the given counters and flush them if it's been a while."""
+        with self.lock:
+            for name, value in counters.items():
+                setattr(self, name, getattr(self, name) + value)
+        self.flush()
+
+    def set(self, **fields):
+        with self.lock:
+            for name, value in fields.items():
+                setattr(self, name, value)
+        self.flush(force=True)
+
+    def flush(self, force=False):
+        now = time.monotonic()
+        if not force and now - self.last_flush < self.flush_interval:
+            return
+        self.last_flush = now
+        self.manager.save_scan_job(self)
+
+    def cancelled(self):
+        """True once a cancel was requested, checking the table from time to time."""
+        if self.cancel_requested:
+            return True
+        now = time.monotonic()
+        if now - self.last_cancel_check >= self.flush_interval:
+            self.last_cancel_check = now
+            job = self.manager.get_scan_job(self.id)
+            self.cancel_requested = bool(job and job["cancel_requested"])
+        return self.cancel_requested
+
+    def eta(self):
+        """Seconds left, extrapolated from the work done so far."""
+        work = self.total + self.candidates
+        done = self.probed + self.collected
+        if self.status != "running" or not done or not work:
+            return None
+        elapsed = time.time() - self.started
+        return round(elapsed / done * (work - done), 1)
+
+
+class TelemetryPoller:
+    """
+    Refreshes every device in the background so the dashboard can read device
+    state from the database instead of waiting on SSH.
+
+    Each device gets its own interval: devices that run hot, lag or just
+    changed are polled every min_interval, stable ones back off gradually to
+    max_interval, and missing ones back off exponentially up to
+    max_missing_interval. Only one process polls at a time (a lock file next to
+    the database), so several gunicorn workers don't multiply the load; other
+    processes ask for an early refresh through the poll_requests table.
+    """
+
+    tick_interval = 1
+    base_interval = 60
+    min_interval = 15
+    max_interval = 300
+    max_missing_interval = 1800
+    hot_temperature = 70  # celsius
+    laggy_lag = 20  # ms
+    changed_temperature = 3  # celsius between two polls
+    changed_lag = 10  # ms between two polls
+
+    def __init__(self, manager):
+        self.manager = manager
+        self.state = {}  # mac -> last device row seen
+        self.intervals = {}  # mac -> current interval
+        self.failures = {}  # mac -> consecutive polls the device was missing
+        self.next_poll = {}  # mac -> timestamp
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.lock_file = None
+
+    def start(self):
+        if self.thread is not None and self.thread.is_alive():
+            return
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def acquire_lock(self):
+        """True if this process is (or just became) the one polling."""
+        if self.lock_file is not None:
+            return True
+        try:
+            import fcntl
+        except ImportError:
+            return True  # No flock on this platform, every process polls
+        lock_file = open(self.manager.db_file + ".poller.lock", "w")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+        self.lock_file = lock_file
+        return True
+
+    def run(self):
+        while not self.stop_event.is_set():
+            if not self.acquire_lock():
+                # Another process polls; try again later in case it goes away
+                self.stop_event.wait(30)
+                continue
+            try:
+                self.tick()
+            except Exception as e:
+                print(f"Telemetry poller error: {e}")
+            self.stop_event.wait(self.tick_interval)
+
+    def tick(self):
+        """Poll every device that is due or was asked for."""
+        now = time.time()
+        requested = self.manager.pop_poll_requests()
+        devices = self.manager.db.fetchall(
+            "SELECT * FROM devices WHERE setup_id IS NOT NULL AND ip IS NOT NULL"
+        )
+        # Every device of a setup pings the same master, resolve them once per tick
+        masters = {device["setup_id"]: device["ip"] for device in devices if device["master"]}
+        due = {}
+        for device in devices:
+            mac = device["mac"]
+            self.state.setdefault(mac, device)
+            if mac in requested or self.next_poll.get(mac, 0) <= now:
+                due[device["ip"]] = device
+        if due:
+            self.manager.run_on_devices(
+                list(due), lambda ip: self.poll_device(due[ip], masters.get(due[ip]["setup_id"], ""))
+            )
+        self.manager.discover_agents(devices)
+
+    def poll_device(self, device, master_ip=None):
+        mac = device["mac"]
+        previous = self.state.get(mac, device)
+        current = self.manager.update_client(device["ip"], mac, master_ip) or device
+        self.state[mac] = current
+        self.next_poll[mac] = time.time() + self.interval(mac, previous, current)
+        return not current.get("missing")
+
+    def interval(self, mac, previous, current):
+        """Seconds until the next poll of a device, given its last two states."""
+        if current.get("missing"):
+            failures = self.failures[mac] = self.failures.get(mac, 0) + 1
+            return min(self.base_interval * 2 ** (failures - 1), self.max_missing_interval)
+        self.failures[mac] = 0
+
+        temperature = current.get("temperature")
+        lag = current.get("lag")
+        hot = temperature is not None and temperature >= self.hot_temperature
+        laggy = (lag is not None and lag >= self.laggy_lag) or current.get("lag_error") == self.manager.LAG_NO_RESPONSE
+        changed = (
+            previous.get("missing")
+            or self.differs(previous.get("temperature"), temperature, self.changed_temperature)
+            or self.differs(previous.get("lag"), lag, self.changed_lag)
+        )
+
+        if hot or laggy or changed:
+            interval = self.min_interval
+        else:
+            interval = min(self.intervals.get(mac, self.base_interval) * 1.5, self.max_interval)
+        self.intervals[mac] = interval
+        return interval
+
+    def differs(self, old, new, threshold):
+        if old is None or new is None:
+            return old is not new
+        return abs(new - old) >= threshold
+
+
+class DeviceEventHub:
+    """
+    Watches the devices table and fans out what changed to every subscriber.
+
+    One thread per process checks the database version every check_interval
+    seconds and only reads the table when something was committed, by this
+    process or another one, so any number of open dashboards cost one query.
+    Subscribers get a queue of events: {"type": "added" | "changed" | "removed",
+    "mac": ..., "changes": {...}, "device": {...}}.
+    """
+
+    check_interval = 1
+
+    def __init__(self, manager):
+        self.manager = manager
+        self.subscribers = set()
+        self.lock = threading.Lock()
+        self.snapshot = None  # mac -> device row
+        self.version = None
+        self.thread = None
+
+    def subscribe(self):
+        events = queue.Queue(maxsize=1000)
+        with self.lock:
+            self.subscribers.add(events)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+        return events
+
+    def unsubscribe(self, events):
+        with self.lock:
+            self.subscribers.discard(events)
+
+    def run(self):
+        while True:
+            with self.lock:
+                if not self.subscribers:
+                    # Nobody listening, forget the snapshot so a new watcher starts fresh
+                    self.thread = None
+                    self.snapshot = None
+                    self.version = None
+                    return
+            try:
+                version = self.manager.db.version()
+                if version != self.version:
+                    self.version = version
+                    self.publish(self.diff())
+            except Exception as e:
+                print(f"Device event error: {e}")
+            time.sleep(self.check_interval)
+
+    def diff(self):
+        """Events describing how the devices table changed since the last call."""
+        rows = {device["mac"]: device for device in self.manager.db.fetchall("SELECT * FROM devices")}
+        previous, self.snapshot = self.snapshot, rows
+        if previous is None:
+            return []
+
+        events = []
+        for mac, device in rows.items():
+            old = previous.get(mac)
+            if old is None:
+                events.append({"type": "added", "mac": mac, "changes": device, "device": device})
+                continue
+            changes = {key: value for key, value in device.items() if old.get(key) != value}
+            if changes:
+                events.append({"type": "changed", "mac": mac, "changes": changes, "device": device})
+        for mac in previous.keys() - rows.keys():
+            events.append({"type": "removed", "mac": mac, "changes": {}, "device": previous[mac]})
+        return events
+
+    def publish(self, events):
+        with self.lock:
+            subscribers = list(self.subscribers)
+        for events_queue in subscribers:
+            for event in events:
+                try:
+                    events_queue.put_nowait(event)
+                except queue.Full:
+                    pass  # A stalled client misses updates rather than growing memory
+
 
 class PiVideoManager:
 
     username = "pi"
     password = "raspberry"
     db_file = "data.db"
+    schema_version = 9
+
+    # Why a device has no lag value
+    LAG_NO_MASTER = "no_master"
+    LAG_NO_RESPONSE = "no_response"
+    ssh_port = 22
+
+    # Telemetry history: seconds each resolution is kept, raw samples roll up
+    # into 1 minute and 1 hour buckets as they are recorded
+    telemetry_retention = {
+        "raw": 24 * 3600,
+        "1m": 14 * 24 * 3600,
+        "1h": 400 * 24 * 3600,
+    }
+    telemetry_prune_interval = 3600
+
+    # Host discovery: how long a TCP connect to the SSH port may take and how
+    # many connects are in flight at once during a sweep
+    discovery_timeout = 0.5
+    discovery_concurrency = 256
+
+    # Fleet-wide actions: how many devices are driven at once and how long
+    # a single device may take before it is reported as failed
+    fleet_concurrency = 64
+    device_timeout = 30
+    # Threads shared by all fleet actions, kept between them so each keeps its
+    # database connection; enough for the poller, a scan and a fleet action at once
+    fleet_threads = 256
+
+    # Deadline for a single remote command unless the caller gives its own
+    remote_timeout = 30
+    # Deadline for the telemetry probe and each of the per-metric getters
+    probe_timeout = 15
+
+    # SSH connections kept open, raised to the device count of the largest
+    # setup so a fleet action never closes connections it is about to reuse
+    connection_pool_size = 256
+
+    # Rolling reboots: devices reboot reboot_batch_size at a time and the next
+    # batch starts once every device of the current one is back, meaning SSH
+    # answers with a new boot id and the player is running again
+    reboot_batch_size = 5
+    reboot_ready_timeout = 180
+    reboot_probe_interval = 2
+    # Brackets keep the pattern from matching the shell running pgrep
+    player_process_pattern = "[o]mxplayer|[v]lc"
+    boot_id_file = "/proc/sys/kernel/random/boot_id"
+
+    # Synchronized fleet actions fire this many seconds after the last device
+    # is prepared, giving every device time to be waiting for the trigger
+    sync_fire_delay = 0.2
+
+    # Finds out which player (omxplayer-sync or VLC) and audio stack (PulseAudio
+    # or plain ALSA, with its card/control pairs) a device runs. No player is
+    # reported while none runs (e.g. right after boot), so nothing is stored
+    # and the next command detects again
+    backend_probe_command = (
+        "if pgrep omxplayer >/dev/null && ls /tmp/omxplayerdbus.* >/dev/null 2>&1; then echo player=omxplayer; "
+        "elif pgrep -x vlc >/dev/null; then echo player=vlc; fi; "
+        "if sudo -u pi pactl info >/dev/null 2>&1; then echo audio=pulse; else echo audio=alsa; fi; "
+        "for card in $(aplay -l 2>/dev/null | grep '^card' | awk '{print $2}' | sed 's/://' | sort -u); do "
+        "amixer -c \"$card\" scontrols | awk -F\"'\" -v card=\"$card\" '{print \"alsa=\" card \"/\" $2}'; "
+        "done"
+    )
+
+    omxplayer_commands = OMXPLAYER_COMMANDS
+    pulse_commands = PULSE_COMMANDS
+
+    # Optional playback agents (playback_agent.py on the players): commands go
+    # to a whole setup in one signed multicast packet. Off unless agent_key, the
+    # key shared with the agents, is set. Only devices whose agent answered the
+    # poller's hello get commands that way, the rest go straight to SSH; devices
+    # without an agent are asked again every agent_recheck_interval seconds.
+    agent_key = os.environ.get("PIVIDEO_AGENT_KEY")
+    agent_group = AGENT_GROUP
+    agent_port = AGENT_PORT
+    agent_interface = "0.0.0.0"
+    agent_ack_timeout = 0.2
+    agent_retries = 2
+    agent_recheck_interval = 600
+
+    # Lag to the master is measured as a burst of pings in one remote command,
+    # lag_sample_interval seconds apart (the shortest interval ping allows
+    # without root)
+    lag_samples = 5
+    lag_sample_interval = 0.2
+
+    # On-screen messages are rendered once here with ffmpeg, cached by content
+    # hash in message_cache_dir and copied to devices that don't have them yet
+    message_cache_dir = "message_cache"
+    message_remote_dir = ".pivideo_messages"
+    message_seconds = 5
+    message_filter = "color=black:s=320x240"
+    message_drawtext = "fontcolor=white:fontsize=24:x=(w-text_w)/2:y=(h-text_h)/2"
+
+    # Gathers every metric in a single remote invocation, one key=value per line.
+    # Facts never change for a board, so once stored they are only read again
+    # when the boot id differs from the one they were read in (see run_probe)
+    facts_probe_command = (
+        "echo \"model=$(tr -d '\\000' < /proc/device-tree/model 2>/dev/null)\"; "
+        "echo \"mac=$(cat /sys/class/net/eth0/address 2>/dev/null)\"; "
+        "echo \"ram=$(free -m | awk '/^Mem:/ {print $2}')\"; "
+    )
+    metrics_probe_command = (
+        "echo \"temperature=$(vcgencmd measure_temp 2>/dev/null)\"; "
+        "echo \"storage=$(df -B1 / | tail -n 1)\"; "
+    )
 
     def __init__(self):
         """Initialize the PiVideoManager and setup the database."""
-        self.connections = {}
+        self.connections = SSHConnectionPool(self.open_connection, max_size=self.connection_pool_size)
         self.device_info = {}
+        self.db = Database(self.db_file)
+        self.telemetry_pruned = {}  # device id -> last time its history was pruned
+        self.poller = TelemetryPoller(self)
+        self.events = DeviceEventHub(self)
+        self.agents = PlaybackAgentClient(
+            self.agent_key.encode(), self.agent_group, self.agent_port,
+            self.agent_interface, self.agent_ack_timeout, self.agent_retries,
+        ) if self.agent_key else None
+        self.agent_macs = set()  # MACs of the devices whose agent answered
+        self.agent_checked = {}  # mac -> when its agent was last asked for
+        self.in_flight = InFlightCalls()
+        self.executor = concurrent.futures.ThreadPoolExecutor(self.fleet_threads, thread_name_prefix="fleet")
+        self.scan_lock = threading.Lock()
+        self.rebooting = set()  # IPs a rolling reboot of this process is handling
+        self.reboot_lock = threading.Lock()
         
         self.setup_database()
+        self.size_connection_pool()
 
     def setup_database(self):
         """Create the necessary database tables if they do not exist."""
-        conn = sqlite3.connect(self.db_file)
-        cursor = conn.cursor()
-
-        # Create devices table with additional fields
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS devices (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                iprange TEXT,
-                name TEXT UNIQUE,
-                ip TEXT UNIQUE,
-                model TEXT,
-                mac TEXT UNIQUE,
-                temperature TEXT,
-                ram TEXT,
-                storage TEXT,
-                lag TEXT,
-                master BOOLEAN DEFAULT FALSE,
-                missing BOOLEAN DEFAULT FALSE,
-                sort INTEGER DEFAULT 0,
-                last_connection TEXT
-            )
-        ''')
-
-        # Create setup table
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS setup (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                name TEXT,
-                friendlyurl TEXT,
-                iprange TEXT,
-                creation_date TEXT,
-                last_update TEXT
-            )
-        ''')
-
-        # Check if admin table exists
-        cursor.execute("""
-            SELECT count(*) 
-            FROM sqlite_master 
-            WHERE type='table' AND name='users'
-        """)
-        table_exists = cursor.fetchone()[0]
+        with self.db.transaction() as cursor:
+            # Create devices table with additional fields
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS devices (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    iprange TEXT,
+                    name TEXT UNIQUE,
+                    ip TEXT UNIQUE,
+                    model TEXT,
+                    mac TEXT UNIQUE,
+                    temperature TEXT,
+                    ram TEXT,
+                    storage TEXT,
+                    lag TEXT,
+                    master BOOLEAN DEFAULT FALSE,
+                    missing BOOLEAN DEFAULT FALSE,
+                    sort INTEGER DEFAULT 0,
+                    last_connection TEXT
+                )
+            ''')
 
-        if not table_exists:
-            # Create admin table if it doesn't exist
+            # Create setup table
             cursor.execute('''
-                CREATE TABLE users (
+                CREATE TABLE IF NOT EXISTS setup (
                     id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user TEXT UNIQUE,
-                    password TEXT,
-                    setup TEXT
+                    name TEXT,
+                    friendlyurl TEXT,
+                    iprange TEXT,
+                    creation_date TEXT,
+                    last_update TEXT
                 )
             ''')
-            
-            user = input("Set an admin user: ")
-            password = input("Set an admin password: ")
 
-            # Insert admin credentials
+            # Create scan jobs table, progress of background scans
             cursor.execute('''
-                INSERT INTO users (user, password, setup) VALUES (?, ?,?)
-            ''', (user, password,"admin"))
-        
-        conn.commit()
-        conn.close()
+                CREATE TABLE IF NOT EXISTS scan_jobs (
+                    id TEXT PRIMARY KEY,
+                    iprange TEXT,
+                    status TEXT,
+                    total INTEGER DEFAULT 0,
+                    probed INTEGER DEFAULT 0,
+                    candidates INTEGER DEFAULT 0,
+                    collected INTEGER DEFAULT 0,
+                    found INTEGER DEFAULT 0,
+                    missing INTEGER DEFAULT 0,
+                    eta REAL,
+                    error TEXT,
+                    cancel_requested BOOLEAN DEFAULT FALSE,
+                    started REAL,
+                    finished REAL,
+                    updated REAL
+                )
+            ''')
+
+            # Check if admin table exists
+            cursor.execute("""
+                SELECT count(*) 
+                FROM sqlite_master 
+                WHERE type='table' AND name='users'
+            """)
+            table_exists = cursor.fetchone()[0]
+
+            if not table_exists:
+                # Create admin table if it doesn't exist
+                cursor.execute('''
+                    CREATE TABLE users (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        user TEXT UNIQUE,
+                        password TEXT,
+                        setup TEXT
+                    )
+                ''')
+            
+                user = input("Set an admin user: ")
+                password = input("Set an admin password: ")
+
+                # Insert admin credentials
+                cursor.execute('''
+                    INSERT INTO users (user, password, setup) VALUES (?, ?,?)
+                ''', (user, password,"admin"))
+
+        self.upgrade_schema()
+
+    def upgrade_schema(self):
+        """
+        Brings an existing database up to schema_version, one step at a time.
+        The version is kept in PRAGMA user_version; the write lock is held for
+        the whole upgrade so several workers starting at once upgrade only once.
+        """
+        # Rebuilding a table must not cascade deletes into the tables referencing it
+        conn = self.db.connection()
+        conn.execute("PRAGMA foreign_keys = OFF")
+        try:
+            self.apply_schema_upgrades()
+        finally:
+            conn.execute("PRAGMA foreign_keys = ON")
+
+    def apply_schema_upgrades(self):
+        with self.db.transaction(immediate=True) as cursor:
+            version = cursor.execute("PRAGMA user_version").fetchone()[0]
+
+            if version < 1:
+                # Devices belong to a setup through a foreign key instead of the iprange text
+                columns = [row[1] for row in cursor.execute("PRAGMA table_info(devices)")]
+                if "setup_id" not in columns:
+                    cursor.execute("ALTER TABLE devices ADD COLUMN setup_id INTEGER REFERENCES setup(id) ON DELETE CASCADE")
+                cursor.execute('''
+                    UPDATE devices
+                    SET setup_id = (SELECT id FROM setup WHERE setup.iprange = devices.iprange)
+                    WHERE setup_id IS NULL
+                ''')
+                self.create_device_indexes(cursor)
+                cursor.execute("CREATE INDEX IF NOT EXISTS idx_setup_friendlyurl ON setup (friendlyurl)")
+                cursor.execute("CREATE INDEX IF NOT EXISTS idx_setup_name ON setup (name)")
+                cursor.execute("CREATE INDEX IF NOT EXISTS idx_setup_iprange ON setup (iprange)")
+
+            if version < 2:
+                # Append-only telemetry history plus its rollups, one row per device and time
+                cursor.execute('''
+                    CREATE TABLE IF NOT EXISTS telemetry (
+                        device_id INTEGER REFERENCES devices(id) ON DELETE CASCADE,
+                        ts INTEGER,
+                        temperature REAL,
+                        lag REAL,
+                        storage_free INTEGER,
+                        PRIMARY KEY (device_id, ts)
+                    ) WITHOUT ROWID
+                ''')
+                for table in ("telemetry_1m", "telemetry_1h"):
+                    cursor.execute(f'''
+                        CREATE TABLE IF NOT EXISTS {table} (
+                            device_id INTEGER REFERENCES devices(id) ON DELETE CASCADE,
+                            bucket INTEGER,
+                            temperature_samples INTEGER DEFAULT 0,
+                            temperature_sum REAL DEFAULT 0,
+                            temperature_max REAL,
+                            lag_samples INTEGER DEFAULT 0,
+                            lag_sum REAL DEFAULT 0,
+                            lag_max REAL,
+                            storage_free INTEGER,
+                            PRIMARY KEY (device_id, bucket)
+                        ) WITHOUT ROWID
+                    ''')
+
+            if version < 3:
+                # Telemetry columns become numbers: celsius, MB, bytes and milliseconds
+                # plus an error code for the lag. SQLite can't change column types,
+                # so the table is rebuilt and the old strings converted.
+                cursor.execute('''
+                    CREATE TABLE devices_new (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        iprange TEXT,
+                        setup_id INTEGER REFERENCES setup(id) ON DELETE CASCADE,
+                        name TEXT UNIQUE,
+                        ip TEXT UNIQUE,
+                        model TEXT,
+                        mac TEXT UNIQUE,
+                        temperature REAL,
+                        ram INTEGER,
+                        storage_total INTEGER,
+                        storage_free INTEGER,
+                        lag REAL,
+                        lag_error TEXT,
+                        master BOOLEAN DEFAULT FALSE,
+                        missing BOOLEAN DEFAULT FALSE,
+                        sort INTEGER DEFAULT 0,
+                        last_connection TEXT
+                    )
+                ''')
+                rows = []
+                for device in cursor.execute("SELECT * FROM devices").fetchall():
+                    device = dict(device)
+                    total, free = self.parse_storage_text(device.get("storage"))
+                    lag = self.parse_number(device.get("lag"))
+                    lag_error = None
+                    if lag is None and device.get("lag"):
+                        lag_error = self.LAG_NO_MASTER if "master" in device["lag"] else self.LAG_NO_RESPONSE
+                    ram = self.parse_number(device.get("ram"))
+                    rows.append((
+                        device["id"], device["iprange"], device["setup_id"], device["name"], device["ip"],
+                        device["model"], device["mac"], self.parse_number(device.get("temperature")),
+                        int(ram) if ram is not None else None, total, free, lag, lag_error,
+                        device["master"], device["missing"], device["sort"], device["last_connection"],
+                    ))
+                cursor.executemany('''
+                    INSERT INTO devices_new (id, iprange, setup_id, name, ip, model, mac, temperature, ram,
+                                             storage_total, storage_free, lag, lag_error, master, missing,
+                                             sort, last_connection)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ''', rows)
+                cursor.execute("DROP TABLE devices")
+                cursor.execute("ALTER TABLE devices_new RENAME TO devices")
+                self.create_device_indexes(cursor)
+
+            if version < 4:
+                # Refreshes asked for by any process, picked up by the one running the poller
+                cursor.execute('''
+                    CREATE TABLE IF NOT EXISTS poll_requests (
+                        mac TEXT PRIMARY KEY,
+                        requested REAL
+                    )
+                ''')
+
+            if version < 5:
+                # Last playback state set from the manager, pushed to dashboards
+                columns = [row[1] for row in cursor.execute("PRAGMA table_info(devices)")]
+                if "paused" not in columns:
+                    cursor.execute("ALTER TABLE devices ADD COLUMN paused BOOLEAN DEFAULT FALSE")
+                if "muted" not in columns:
+                    cursor.execute("ALTER TABLE devices ADD COLUMN muted BOOLEAN DEFAULT FALSE")
+
+            if version < 6:
+                # Lag is the average of a ping burst, keep the rest of its statistics
+                columns = [row[1] for row in cursor.execute("PRAGMA table_info(devices)")]
+                for column in ("lag_min", "lag_max", "lag_jitter", "lag_loss"):
+                    if column not in columns:
+                        cursor.execute(f"ALTER TABLE devices ADD COLUMN {column} REAL")
+
+            if version < 7:
+                # Player and audio stack of each device, detected on first playback command
+                columns = [row[1] for row in cursor.execute("PRAGMA table_info(devices)")]
+                for column in ("player", "audio", "alsa_controls"):
+                    if column not in columns:
+                        cursor.execute(f"ALTER TABLE devices ADD COLUMN {column} TEXT")
+
+            if version < 8:
+                # When a reboot started (NULL when not rebooting) and how long the last one took
+                columns = [row[1] for row in cursor.execute("PRAGMA table_info(devices)")]
+                if "reboot_started" not in columns:
+                    cursor.execute("ALTER TABLE devices ADD COLUMN reboot_started REAL")
+                if "time_to_ready" not in columns:
+                    cursor.execute("ALTER TABLE devices ADD COLUMN time_to_ready REAL")
+
+            if version < 9:
+                # Boot the stored model/MAC/RAM were read in, they're only read again after it changes
+                columns = [row[1] for row in cursor.execute("PRAGMA table_info(devices)")]
+                if "boot_id" not in columns:
+                    cursor.execute("ALTER TABLE devices ADD COLUMN boot_id TEXT")
+
+            if version < self.schema_version:
+                print(f"Database upgraded from schema version {version} to {self.schema_version}")
+                cursor.execute(f"PRAGMA user_version = {self.schema_version}")
+
+    def create_device_indexes(self, cursor):
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_devices_setup_sort ON devices (setup_id, sort)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_devices_iprange_sort ON devices (iprange, sort)")
+        # Only masters are indexed, one or two rows per setup
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_devices_master ON devices (setup_id) WHERE master = 1")
+
+    def size_connection_pool(self, at_least=0):
+        """Make room in the connection pool for every device of the largest setup, and at least at_least."""
+        largest = self.db.fetchone(
+            "SELECT count(*) AS devices FROM devices WHERE setup_id IS NOT NULL "
+            "GROUP BY setup_id ORDER BY devices DESC LIMIT 1"
+        )
+        self.connections.max_size = max(self.connection_pool_size, largest["devices"] if largest else 0, at_least)
 
     def generate_friendly_url(self,text):
         """
@@ -115,12 +1323,7 @@ class PiVideoManager:
         return text
 
     def check_login(self,username,password):
-        conn = sqlite3.connect(self.db_file)
-        conn.row_factory = sqlite3.Row  # Enables dictionary-like access
-        cursor = conn.cursor()
-        cursor.execute('SELECT * FROM users WHERE user = ? AND password = ?', (username, password))
-        user = cursor.fetchone()
-        conn.close()
+        user = self.db.fetchone('SELECT * FROM users WHERE user = ? AND password = ?', (username, password))
         if user:
             if user["setup"]:
                 return user["setup"]
@@ -128,7 +1331,7 @@ class PiVideoManager:
                 return False
         else:
             return False
-        
+
     def create_setup(self, name, iprange, password):
         print("create_setup password",password)
         # Validate CIDR notation
@@ -137,13 +1340,13 @@ class PiVideoManager:
         except ValueError:
             return False  # Invalid CIDR format
 
-        conn = sqlite3.connect(self.db_file)
-        cursor = conn.cursor()
-
         friendlyname = self.generate_friendly_url(name)
 
-        cursor.execute('SELECT COUNT(*) FROM setup WHERE iprange = ?', (iprange,))
-        if cursor.fetchone()[0] == 0:
+        with self.db.transaction() as cursor:
+            cursor.execute('SELECT COUNT(*) FROM setup WHERE iprange = ?', (iprange,))
+            if cursor.fetchone()[0] > 0:
+                return False  # Entry already exists
+
             cursor.execute(
                 'INSERT INTO setup (name, iprange, friendlyurl, creation_date, last_update) VALUES (?, ?, ?, ?,?)',
                 (name, iprange, friendlyname, datetime.now().isoformat(), datetime.now().isoformat())
@@ -153,168 +1356,324 @@ class PiVideoManager:
                 'INSERT INTO users (user, password, setup) VALUES (?, ?, ?)',
                 (friendlyname, password,friendlyname)
             )
-            conn.commit()
-            conn.close()
-            return True  # Successfully added to the database
-
-        conn.close()
-        return False  # Entry already exists
+        return True  # Successfully added to the database
 
     def save_device(self, info,iprange=""):
         """Add or update a device in the database based on the MAC address."""
-        conn = sqlite3.connect(self.db_file)
-        cursor = conn.cursor()
         print("gonna save device",iprange,info)
-        # Check if the device with the given MAC address exists
-        cursor.execute("SELECT COUNT(*) FROM devices WHERE mac = ?", (info.get("mac"),))
-        exists = cursor.fetchone()[0] > 0
-        
-        if exists:
-            # If the device exists, update its values
-            info["missing"] = False
-            update_fields = ', '.join(f"{key} = ?" for key in info if key != "mac")
-            values = [info[key] for key in info if key != "mac"]
-            values.append(info["mac"])  # Add mac for WHERE clause
-
-            cursor.execute(f"UPDATE devices SET {update_fields} WHERE mac = ?", values)
-            print(f"Device with MAC {info['mac']} updated successfully.")
-        else:
-            info["iprange"]=iprange
-            # If the device does not exist, insert it
-            columns = ', '.join(info.keys())
-            placeholders = ', '.join(['?' for _ in info])
-            values = list(info.values())
+        self.save_devices([info], iprange)
+
+    def save_devices(self, infos, iprange="", missing_macs=(), seen_macs=()):
+        """
+        Add or update many devices in a single transaction, keyed by MAC address.
+
+        New devices are inserted into the setup of iprange; known ones get their
+        collected fields updated and their missing flag cleared. A device that
+        took over an IP still recorded for another device frees it first.
+        Devices in missing_macs are flagged as missing in the same transaction,
+        and devices in seen_macs (confirmed without collecting telemetry) get
+        their missing flag cleared and last connection updated. A device whose
+        boot id changed forgets its playback backend.
+        """
+        if not infos and not missing_macs and not seen_macs:
+            return
+
+        # executemany needs the same columns on every row
+        batches = {}
+        for info in infos:
+            batches.setdefault(tuple(key for key in info if key != "mac"), []).append(info)
+
+        with self.db.transaction() as cursor:
+            cursor.execute("SELECT id FROM setup WHERE iprange = ?", (iprange,))
+            setup = cursor.fetchone()
+            setup_id = setup[0] if setup else None
+
+            cursor.executemany(
+                "UPDATE devices SET ip = NULL WHERE ip = ? AND mac != ?",
+                [(info["ip"], info.get("mac")) for info in infos if info.get("ip")]
+            )
 
-            cursor.execute(f"INSERT INTO devices ({columns}) VALUES ({placeholders})", values)
-            print(f"Device {info.get('name', 'Unknown')} added successfully.")
+            for keys, rows in batches.items():
+                columns = ["mac", *keys, "missing", "iprange", "setup_id"]
+                updates = [f"{key} = excluded.{key}" for key in keys] + ["missing = excluded.missing"]
+                if "boot_id" in keys:
+                    # A rebooted device may have come back with another player, detect it again
+                    updates.append("player = CASE WHEN boot_id IS excluded.boot_id THEN player END")
+                cursor.executemany(
+                    f"INSERT INTO devices ({', '.join(columns)}) VALUES ({', '.join('?' for _ in columns)}) "
+                    f"ON CONFLICT(mac) DO UPDATE SET {', '.join(updates)}",
+                    [(info.get("mac"), *(info[key] for key in keys), False, iprange, setup_id) for info in rows]
+                )
+
+            cursor.executemany('UPDATE devices SET missing = ? WHERE mac = ?', [(True, mac) for mac in missing_macs])
+            cursor.executemany(
+                'UPDATE devices SET missing = ?, last_connection = ? WHERE mac = ?',
+                [(False, datetime.now().isoformat(), mac) for mac in seen_macs]
+            )
+
+            self.record_telemetry(cursor, infos)
+
+        print(f"Saved {len(infos)} devices.")
+
+    def record_telemetry(self, cursor, infos):
+        """
+        Append a telemetry sample for every device in infos to the history and
+        fold it into the 1 minute and 1 hour rollups, using the given cursor so
+        it is part of the caller's transaction.
+        """
+        macs = [info["mac"] for info in infos if info.get("mac")]
+        if not macs:
+            return
+        cursor.execute(
+            f"SELECT mac, id FROM devices WHERE mac IN ({', '.join('?' for _ in macs)})", macs
+        )
+        ids = dict(cursor.fetchall())
+
+        now = int(time.time())
+        samples = []
+        for info in infos:
+            device_id = ids.get(info.get("mac"))
+            if device_id is None:
+                continue
+            samples.append((
+                device_id,
+                now,
+                info.get("temperature"),
+                info.get("lag"),
+                info.get("storage_free"),
+                info.get("lag_max", info.get("lag")),
+            ))
+        if not samples:
+            return
+
+        cursor.executemany(
+            "INSERT OR REPLACE INTO telemetry (device_id, ts, temperature, lag, storage_free) VALUES (?, ?, ?, ?, ?)",
+            [sample[:5] for sample in samples]
+        )
+        for table, size in (("telemetry_1m", 60), ("telemetry_1h", 3600)):
+            cursor.executemany(f'''
+                INSERT INTO {table} (device_id, bucket, temperature_samples, temperature_sum, temperature_max,
+                                     lag_samples, lag_sum, lag_max, storage_free)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT(device_id, bucket) DO UPDATE SET
+                    temperature_samples = temperature_samples + excluded.temperature_samples,
+                    temperature_sum = temperature_sum + excluded.temperature_sum,
+                    temperature_max = max(coalesce(temperature_max, excluded.temperature_max),
+                                          coalesce(excluded.temperature_max, temperature_max)),
+                    lag_samples = lag_samples + excluded.lag_samples,
+                    lag_sum = lag_sum + excluded.lag_sum,
+                    lag_max = max(coalesce(lag_max, excluded.lag_max), coalesce(excluded.lag_max, lag_max)),
+                    storage_free = min(coalesce(storage_free, excluded.storage_free),
+                                       coalesce(excluded.storage_free, storage_free))
+            ''', [
+                (device_id, ts - ts % size,
+                 temperature is not None, temperature or 0, temperature,
+                 lag is not None, lag or 0, lag_max,
+                 storage_free)
+                for device_id, ts, temperature, lag, storage_free, lag_max in samples
+            ])
+
+        # Drop what is past retention, at most once per prune interval for each device
+        monotonic = time.monotonic()
+        for device_id, *_ in samples:
+            if monotonic - self.telemetry_pruned.get(device_id, -self.telemetry_prune_interval) < self.telemetry_prune_interval:
+                continue
+            self.telemetry_pruned[device_id] = monotonic
+            cursor.execute("DELETE FROM telemetry WHERE device_id = ? AND ts < ?",
+                           (device_id, now - self.telemetry_retention["raw"]))
+            cursor.execute("DELETE FROM telemetry_1m WHERE device_id = ? AND bucket < ?",
+                           (device_id, now - self.telemetry_retention["1m"]))
+            cursor.execute("DELETE FROM telemetry_1h WHERE device_id = ? AND bucket < ?",
+                           (device_id, now - self.telemetry_retention["1h"]))
+
+    def get_telemetry(self, mac=None, iprange=None, start=None, end=None, resolution=None):
+        """
+        Retrieve the telemetry history of a device (by MAC) or of every device in
+        a setup (by iprange) between start and end (unix timestamps, default the
+        last hour), as a list of dictionaries sorted by device and time.
 
-        conn.commit()
-        conn.close()
+        resolution is "raw", "1m" or "1h"; by default the finest one that still
+        covers the window and keeps the number of points reasonable is used.
+        """
+        end = end or time.time()
+        start = start or end - 3600
+        window = end - start
+        oldest = time.time() - start
+
+        if resolution is None:
+            if window <= 6 * 3600 and oldest <= self.telemetry_retention["raw"]:
+                resolution = "raw"
+            elif window <= 7 * 24 * 3600 and oldest <= self.telemetry_retention["1m"]:
+                resolution = "1m"
+            else:
+                resolution = "1h"
+
+        if resolution == "raw":
+            select = '''
+                SELECT devices.mac, t.ts, t.temperature, t.temperature AS temperature_max,
+                       t.lag, t.lag AS lag_max, t.storage_free
+                FROM telemetry AS t
+            '''
+            column = "ts"
+        elif resolution in ("1m", "1h"):
+            select = f'''
+                SELECT devices.mac, t.bucket AS ts,
+                       t.temperature_sum / nullif(t.temperature_samples, 0) AS temperature, t.temperature_max,
+                       t.lag_sum / nullif(t.lag_samples, 0) AS lag, t.lag_max, t.storage_free
+                FROM telemetry_{resolution} AS t
+            '''
+            column = "bucket"
+        else:
+            raise ValueError(f"Unknown telemetry resolution: {resolution}")
+
+        sql = select + " JOIN devices ON devices.id = t.device_id"
+        params = []
+        if mac:
+            sql += " WHERE devices.mac = ?"
+            params.append(mac)
+        elif iprange:
+            sql += " JOIN setup ON setup.id = devices.setup_id WHERE setup.iprange = ?"
+            params.append(iprange)
+        else:
+            sql += " WHERE 1"
+        sql += f" AND t.{column} BETWEEN ? AND ? ORDER BY devices.mac, t.{column}"
+        params += [int(start), int(end)]
+
+        return self.db.fetchall(sql, params)
+
+    def parse_number(self, value):
+        """Return the leading number in a formatted metric like "52.1'C" or "0.42 ms", or None."""
+        if isinstance(value, (int, float)):
+            return float(value)
+        match = re.search(r"-?\d+(\.\d+)?", value) if isinstance(value, str) else None
+        return float(match.group()) if match else None
+
+    def parse_storage_text(self, value):
+        """Return (total, free) bytes from a storage string like "T:29G / R:12G"."""
+        if not isinstance(value, str):
+            return None, None
+        total = re.search(r"T:([\d.]+)([KMGTP]?)", value)
+        free = re.search(r"R:([\d.]+)([KMGTP]?)", value)
+        units = {"": 1, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4, "P": 1024 ** 5}
+        return (
+            int(float(total.group(1)) * units[total.group(2)]) if total else None,
+            int(float(free.group(1)) * units[free.group(2)]) if free else None,
+        )
 
     def update_device_info(self, ip, info):
         """Update the collected device info in the database."""
-        conn = sqlite3.connect(self.db_file)
-        cursor = conn.cursor()
-        cursor.execute('''
-            UPDATE devices SET model = ?, temperature = ?, ram = ?, storage = ?, lag = ?, last_connection = ?
+        self.db.execute('''
+            UPDATE devices SET model = ?, temperature = ?, ram = ?, storage_total = ?, storage_free = ?,
+                               lag = ?, lag_error = ?, lag_min = ?, lag_max = ?, lag_jitter = ?, lag_loss = ?,
+                               last_connection = ?
             WHERE ip = ?
-        ''', (info["model"], temperature, ram, storage, lag, datetime.now().isoformat(), ip))
-        conn.commit()
-        conn.close()
+        ''', (info["model"], info["temperature"], info["ram"], info["storage_total"], info["storage_free"],
+              info["lag"], info["lag_error"], info.get("lag_min"), info.get("lag_max"), info.get("lag_jitter"),
+              info.get("lag_loss"), datetime.now().isoformat(), ip))
 
     def update_device_name_and_master(self, ip, name, master):
         """Update only the name and master status of the device in the database."""
-        conn = sqlite3.connect(self.db_file)
-        cursor = conn.cursor()
-        cursor.execute('''
+        self.db.execute('''
             UPDATE devices 
             SET name = ?, master = ? 
             WHERE ip = ?
         ''', (name, master, ip))
-        conn.commit()
-        conn.close()
-
 
     def get_setups(self):
         """Retrieve setup."""
-        conn = sqlite3.connect(self.db_file)
-        cursor = conn.cursor()
-        cursor.execute('''
-            SELECT *
+        return self.db.fetchall('''
+            SELECT id, name, friendlyurl, iprange, creation_date, last_update
             FROM setup
-            
         ''')
-        setups = cursor.fetchall()
-        conn.close()
-        
-        # Format the device data
-        return [
-            {
-                "id": d[0],
-                "name": d[1],
-                "friendlyurl": d[2],
-                "iprange": d[3],
-                "creation_date": d[4],
-                "last_update": d[5],
-                
-            }
-            for d in setups
-        ]
+
+    def get_setups_with_devices(self):
+        """
+        Retrieve every setup with its devices under "devices", sorted, using a
+        fixed number of queries however many setups there are. Cached until
+        something is written to the database.
+        """
+        def load():
+            setups = self.get_setups()
+            by_id = {setup["id"]: setup for setup in setups}
+            for setup in setups:
+                setup["devices"] = []
+
+            for device in self.db.fetchall("SELECT * FROM devices WHERE setup_id IS NOT NULL ORDER BY setup_id, sort"):
+                setup = by_id.get(device["setup_id"])
+                if setup:
+                    setup["devices"].append(device)
+            return setups
+
+        return self.db.cached("setups_with_devices", load)
 
     def get_setup_by_friendlyurl(self,friendlyurl):
         """Retrieve setup."""
-        conn = sqlite3.connect(self.db_file)
-        cursor = conn.cursor()
-        cursor.execute('SELECT * FROM setup WHERE friendlyurl = ?', (friendlyurl,)) 
-        d = cursor.fetchone()
-        conn.close()
-        
-        # Format the device data
-        return {
-                "id": d[0],
-                "name": d[1],
-                "friendlyurl": d[2],
-                "iprange": d[3],
-                "creation_date": d[4],
-                "last_update": d[5] 
-            }
-      
-
+        return self.db.fetchone(
+            'SELECT id, name, friendlyurl, iprange, creation_date, last_update FROM setup WHERE friendlyurl = ?',
+            (friendlyurl,)
+        )
 
     def get_device_by_mac(self,mac):
-        conn = sqlite3.connect(self.db_file)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
-        cursor.execute('SELECT * FROM devices WHERE mac = ?', (mac,)) 
-        device = cursor.fetchone()
-        conn.close()
-        return dict(device)
+        return self.db.fetchone('SELECT * FROM devices WHERE mac = ?', (mac,))
 
     def get_master_ip(self, ip):
-        conn = sqlite3.connect(self.db_file)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
-        
-        # Query to find a master device with a matching IP
-        cursor.execute("SELECT ip FROM devices WHERE master = 1 AND ip LIKE ?", (ip[:ip.rfind('.') + 1] + '%',))
-        device = cursor.fetchone()
-        conn.close()
-        
-        return device['ip'] if device else None
+        """Return the IP of the master device of the setup ip belongs to."""
+        masters, device_setups, ranges = self.get_setup_masters()
+
+        # Known device: go through its setup
+        setup_id = device_setups.get(ip)
+        if setup_id is None:
+            # Device not stored yet (first scan): find the setup whose range contains ip
+            try:
+                address = ipaddress.ip_address(ip)
+            except ValueError:
+                return None
+            setup_id = next((setup_id for network, setup_id in ranges if address in network), None)
+        return masters.get(setup_id)
+
+    def get_setup_masters(self):
+        """
+        Return the master IP of every setup, the setup of every known device IP
+        and the parsed setup ranges, read once and cached until the database
+        changes so probing a whole setup doesn't query it for every host.
+        """
+        def load():
+            masters = {
+                device["setup_id"]: device["ip"]
+                for device in self.db.fetchall("SELECT setup_id, ip FROM devices WHERE master = 1 AND setup_id IS NOT NULL")
+            }
+            device_setups = {
+                device["ip"]: device["setup_id"]
+                for device in self.db.fetchall("SELECT ip, setup_id FROM devices WHERE ip IS NOT NULL")
+            }
+            ranges = []
+            for setup in self.db.fetchall("SELECT id, iprange FROM setup"):
+                try:
+                    ranges.append((ipaddress.ip_network(setup["iprange"], strict=False), setup["id"]))
+                except (TypeError, ValueError):
+                    continue
+            return masters, device_setups, ranges
 
- 
+        return self.db.cached("setup_masters", load, ttl=60)
 
     def get_all_devices_in_iprange(self,iprange):
         """Retrieve all devices from the database and return as a list of dictionaries."""
-        conn = sqlite3.connect(self.db_file)
-        conn.row_factory = sqlite3.Row  # Enables dictionary-like access
-        cursor = conn.cursor()
-
-        cursor.execute("SELECT * FROM devices WHERE iprange = ? ORDER BY sort", (iprange,))
-        devices = cursor.fetchall()
-        conn.close()
-        
-        # Convert rows to dictionaries
-        return [dict(device) for device in devices]
+        return self.db.fetchall('''
+            SELECT devices.*
+            FROM setup
+            JOIN devices ON devices.setup_id = setup.id
+            WHERE setup.iprange = ?
+            ORDER BY devices.sort
+        ''', (iprange,))
 
     def get_all_devices_with_setup_name(self,name):
         """Retrieve all devices from the database and return as a list of dictionaries."""
-        conn = sqlite3.connect(self.db_file)
-        conn.row_factory = sqlite3.Row  # Enables dictionary-like access
-        cursor = conn.cursor()
-
         # First get the iprange of the setup
-        cursor.execute("SELECT * FROM setup WHERE name = ?", (name,))
-        setup = cursor.fetchone()
-        print("setup",dict(setup))
+        setup = self.db.fetchone("SELECT * FROM setup WHERE name = ?", (name,))
+        print("setup",setup)
+
+        return self.get_all_devices_in_iprange(setup["iprange"])
 
-        cursor.execute("SELECT * FROM devices WHERE iprange = ? ORDER BY sort", (setup["iprange"],))
-        devices = cursor.fetchall()
-        conn.close()
-        
-        # Convert rows to dictionaries
-        return [dict(device) for device in devices]
- 
     def get_ping_lag(self, target_ip):
         """Ping the master device to measure lag."""
         try:
@@ -328,9 +1687,18 @@ class PiVideoManager:
         except Exception:
             return "N/A"
 
-    def scan_ip_range(self, ip_range, max_threads=50):
+    def scan_ip_range(self, ip_range, max_threads=50, job=None, incremental=False):
         """Scans the given IP range, updates preexisting devices in the database,
-        and identifies missing devices by their MAC addresses."""
+        and identifies missing devices by their MAC addresses.
+
+        An incremental scan first confirms known devices at their last IP (see
+        confirm_devices) and leaves their telemetry to the poller; discovery
+        and collection only run on the addresses left. Either way, a known
+        device the scan didn't find is only flagged missing if it still
+        doesn't answer a confirmation probe over a fresh connection.
+
+        When a ScanJob is given its progress is reported there and the scan
+        stops early if the job gets cancelled."""
 
         # Retrieve current devices in the given IP range from the database
         db_devices = self.get_all_devices_in_iprange(ip_range)
@@ -339,206 +1707,604 @@ class PiVideoManager:
         db_mac_set = {device['mac'] for device in db_devices}  # Set of MAC addresses in the DB
 
         scanned_macs = set()  # Track discovered MACs during the scan
-
-        def ping_ip(ip):
-            """Helper function to ping an IP and return status."""
-            ping_cmd = ["ping", "-c", "1", "-W", "1"] if platform.system().lower() != "windows" else ["ping", "-n", "1", "-w", "1000"]
-            command = ping_cmd + [ip]
-            result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-            
-            if result.returncode == 0:
-                print(f"Device found at: {ip}")
-                client = self.connect_to_device(ip)
-                if client:
-                    print(f"Client connected at {ip}")
-                    
-                    # Collect device information including MAC address
-                    info = self.collect_device_info(ip, client)
-                    #print("info of found device",info)
-                    # Add the MAC address to the scanned list
-                    if 'mac' in info:
-                        scanned_macs.add(info['mac'])
-                    
-                    self.save_device(info, ip_range)
-                    client.close()
+        collected = []  # Device info waiting to be saved
+        confirmed = []  # Known devices confirmed at their last IP, nothing new to save
+        mode = "incremental" if incremental else "full"
+        # Every host of the range pings the same master, resolve it once
+        master_ip = next((device['ip'] for device in db_devices if device['master'] and device['ip']), "")
+        known = {device['ip']: device for device in db_devices if device['ip']}
+
+        def collect_ip(ip):
+            """Helper function to connect to a discovered host and store its info."""
+            if job and job.cancelled():
+                return
+            with self.device_connection(ip) as client:
+                info = self.collect_device_info(ip, client, master_ip, known.get(ip)) if client else None
+            # A host that didn't answer the probe in time can't be told apart from another device
+            if info and info["mac"]:
+                print(f"Client connected at {ip}")
+
+                # Collect device information including MAC address
+                #print("info of found device",info)
+                # Add the MAC address to the scanned list
+                if 'mac' in info:
+                    scanned_macs.add(info['mac'])
+
+                self.connections.bind_mac(ip, info.get('mac'))
+                # Written all at once when the scan is over
+                collected.append(info)
+                if job:
+                    job.progress(found=1)
+            if job:
+                job.progress(collected=1)
 
         try:
             network = ipaddress.ip_network(ip_range, strict=False)
             ip_list = [str(ip) for ip in network.hosts() if ip.packed[-1] not in {1, 245, 255}]
-            print(f"Scanning {len(ip_list)} IPs, using {max_threads} threads...")
-
-            # Use ThreadPoolExecutor for parallel processing
-            with concurrent.futures.ThreadPoolExecutor(max_threads) as executor:
-                executor.map(ping_ip, ip_list)
+            print(f"Scanning {len(ip_list)} IPs...")
+            if job:
+                job.set(total=len(ip_list))
+
+            if incremental:
+                in_range = set(ip_list)
+                with SCAN_STAGE_SECONDS.time(stage="confirm"):
+                    confirmed = self.confirm_devices([d for d in db_devices if d['ip'] in in_range], job=job)
+                scanned_macs.update(device['mac'] for device in confirmed)
+                if job:
+                    job.progress(found=len(confirmed))
+                confirmed_ips = {device['ip'] for device in confirmed}
+                ip_list = [ip for ip in ip_list if ip not in confirmed_ips]
+                print(f"Confirmed {len(confirmed)} known devices, discovering {len(ip_list)} IPs...")
+
+            # Cheap sweep first, SSH telemetry only on hosts that answer on the SSH port
+            with SCAN_STAGE_SECONDS.time(stage="discover"):
+                candidates = self.discover_hosts(ip_list, job=job)
+            print(f"Found {len(candidates)} hosts with SSH open, collecting info {max_threads} at a time...")
+            if job:
+                job.set(candidates=len(candidates))
+            # A new setup may be larger than any known one, keep every connection the scan opens
+            self.size_connection_pool(len(candidates) + len(confirmed))
+
+            with SCAN_STAGE_SECONDS.time(stage="collect"):
+                self.run_on_devices(candidates, collect_ip, concurrency=max_threads)
+
+            seen_macs = [device['mac'] for device in confirmed]
+            # A cancelled scan didn't see the whole range, so nothing can be called missing
+            if job and job.cancelled():
+                with SCAN_STAGE_SECONDS.time(stage="save"):
+                    self.save_devices(collected, ip_range, seen_macs=seen_macs)
+                SCANS.inc(mode=mode, outcome="cancelled")
+                return False
 
             # After scanning, identify missing devices by their MAC addresses
+            unseen = [device for device in db_devices if device['mac'] not in scanned_macs]
+            if unseen:
+                # Second chance for devices that were slow or dropped a pooled connection
+                with SCAN_STAGE_SECONDS.time(stage="confirm_missing"):
+                    answered = self.confirm_devices(unseen, fresh=True)
+                seen_macs += [device['mac'] for device in answered]
+                scanned_macs.update(device['mac'] for device in answered)
             missing_devices = db_mac_set - scanned_macs
 
             if missing_devices:
                 print(f"Devices missing from the scan (MACs): {missing_devices}")
-                self.handle_missing_devices(missing_devices)
+            # Found and missing devices are written in a single transaction
+            with SCAN_STAGE_SECONDS.time(stage="save"):
+                self.save_devices(collected, ip_range, missing_macs=missing_devices, seen_macs=seen_macs)
+            self.size_connection_pool()
+            if job:
+                job.set(missing=len(missing_devices))
+            SCANS.inc(mode=mode, outcome="done")
+            return True
 
         except ValueError:
             print("Invalid IP range format. Please use CIDR notation (e.g., 192.168.1.0/24).")
+            if job:
+                job.set(error="Invalid IP range format")
+            SCANS.inc(mode=mode, outcome="invalid")
+            return False
+
+    def start_scan(self, ip_range, incremental=True):
+        """
+        Starts scanning ip_range in a background thread and returns the job id.
+        If that range is already being scanned, the running job's id is returned.
+        Scans are incremental unless a full one is asked for (see scan_ip_range).
+        """
+        with self.scan_lock:
+            running = self.get_running_scan_job(ip_range)
+            if running:
+                return running["id"]
+
+            job = ScanJob(self, ip_range)
+            job.set(status="running")
+
+        def run():
+            try:
+                completed = self.scan_ip_range(ip_range, job=job, incremental=incremental)
+                if job.error:
+                    status = "failed"
+                elif completed:
+                    status = "done"
+                else:
+                    status = "cancelled"
+            except Exception as e:
+                print(f"Scan of {ip_range} failed: {e}")
+                job.error = str(e)
+                status = "failed"
+            job.set(status=status, finished=time.time())
+
+        threading.Thread(target=run, daemon=True).start()
+        return job.id
+
+    def save_scan_job(self, job):
+        """Store the current progress of a scan job."""
+        with job.lock:
+            values = (job.ip_range, job.status, job.total, job.probed, job.candidates, job.collected,
+                      job.found, job.missing, job.eta(), job.error, job.started, job.finished,
+                      time.time(), job.id)
+        self.db.execute('''
+            INSERT INTO scan_jobs (iprange, status, total, probed, candidates, collected, found,
+                                   missing, eta, error, started, finished, updated, id)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(id) DO UPDATE SET
+                status = excluded.status, total = excluded.total, probed = excluded.probed,
+                candidates = excluded.candidates, collected = excluded.collected,
+                found = excluded.found, missing = excluded.missing, eta = excluded.eta,
+                error = excluded.error, finished = excluded.finished, updated = excluded.updated
+        ''', values)
+
+    def get_scan_job(self, job_id):
+        """Retrieve the progress of a scan job as a dictionary."""
+        return self.db.fetchone('SELECT * FROM scan_jobs WHERE id = ?', (job_id,))
+
+    def get_running_scan_job(self, ip_range, stale_after=60):
+        """Retrieve the scan currently running on ip_range, ignoring jobs whose process went away."""
+        return self.db.fetchone(
+            "SELECT * FROM scan_jobs WHERE iprange = ? AND status = 'running' AND updated > ?",
+            (ip_range, time.time() - stale_after)
+        )
+
+    def cancel_scan(self, job_id):
+        """Ask a running scan to stop. Returns False if there is no such running job."""
+        updated = self.db.execute("UPDATE scan_jobs SET cancel_requested = 1 WHERE id = ? AND status = 'running'", (job_id,))
+        return updated > 0
+
+    def discover_hosts(self, ip_list, use_arp=True, job=None):
+        """
+        Sweeps the given IPs with non-blocking TCP connects to the SSH port from
+        a single event loop and returns the ones that accepted, in input order.
+
+        Hosts the kernel neighbour table already knows about but that did not
+        answer within discovery_timeout get a second, longer attempt, so a busy
+        Pi is not missed.
+        """
+        ip_list = list(ip_list)
+        open_hosts, timed_out = asyncio.run(self.sweep_ssh_port(ip_list, self.discovery_timeout, job))
+
+        if use_arp and timed_out:
+            neighbours = self.get_arp_neighbours() & timed_out
+            if neighbours:
+                retried, _ = asyncio.run(self.sweep_ssh_port(neighbours, self.discovery_timeout * 4))
+                open_hosts |= retried
+
+        return [ip for ip in ip_list if ip in open_hosts]
+
+    async def sweep_ssh_port(self, ip_list, timeout, job=None):
+        """Returns (hosts that accepted, hosts that timed out) for a TCP connect to the SSH port."""
+        semaphore = asyncio.Semaphore(self.discovery_concurrency)
+        open_hosts = set()
+        timed_out = set()
+
+        async def probe(ip):
+            async with semaphore:
+                if job and job.cancelled():
+                    return
+                try:
+                    reader, writer = await asyncio.wait_for(asyncio.open_connection(ip, self.ssh_port), timeout)
+                except asyncio.TimeoutError:
+                    timed_out.add(ip)
+                    return
+                except OSError:
+                    return
+                finally:
+                    if job:
+                        job.progress(probed=1)
+                open_hosts.add(ip)
+                writer.close()
+                try:
+                    await writer.wait_closed()
+                except OSError:
+                    pass
+
+        await asyncio.gather(*(probe(ip) for ip in ip_list))
+        return open_hosts, timed_out
+
+    def get_arp_neighbours(self):
+        """Returns the IPs with a complete entry in the kernel ARP table (Linux only)."""
+        return set(self.get_arp_table())
+
+    def get_arp_table(self):
+        """Returns the complete entries of the kernel ARP table as IP -> MAC (Linux only)."""
+        table = {}
+        try:
+            with open("/proc/net/arp") as f:
+                next(f)  # header
+                for line in f:
+                    parts = line.split()
+                    # flags 0x2 = complete entry
+                    if len(parts) >= 4 and parts[2] == "0x2" and parts[3] != "00:00:00:00:00:00":
+                        table[parts[0]] = parts[3].lower()
+        except (OSError, StopIteration):
+            pass
+        return table
+
+    def confirm_devices(self, devices, fresh=False, job=None):
+        """
+        Returns the known devices still at their last IP: the SSH port has to
+        accept and the MAC to match, read from the ARP table when the device
+        shares our network, otherwise with one short command over SSH. With
+        fresh, pooled connections are dropped first and slow hosts get longer.
+        """
+        by_ip = {device['ip']: device for device in devices if device['ip'] and device['mac']}
+        if not by_ip:
+            return []
+        if fresh:
+            for ip in by_ip:
+                self.connections.discard(ip)
+            open_hosts, _ = asyncio.run(self.sweep_ssh_port(list(by_ip), self.discovery_timeout * 4))
+        else:
+            open_hosts = self.discover_hosts(list(by_ip), job=job)
+
+        arp = self.get_arp_table()
+        confirmed = [by_ip[ip] for ip in open_hosts if arp.get(ip) == by_ip[ip]['mac'].lower()]
+        unsure = [ip for ip in open_hosts if arp.get(ip) != by_ip[ip]['mac'].lower()]
+        if unsure:
+            macs = self.run_on_devices(unsure, self.read_mac)
+            confirmed += [by_ip[ip] for ip, mac in macs.results.items() if mac == by_ip[ip]['mac'].lower()]
+        return confirmed
+
+    def read_mac(self, ip):
+        """MAC address of a device read over SSH, None if it couldn't be read."""
+        result = self.run_remote_command(ip, "cat /sys/class/net/eth0/address", timeout=10, kind="read_mac")
+        return result.stdout.strip().lower() if result else None
 
     def delete_setup(self, ip_range):
         """Deletes the setup and all devices that have the same iprange"""
         
-        conn = sqlite3.connect(self.db_file)
-        cursor = conn.cursor()
-        # Delete devices with the given iprange
-        cursor.execute('DELETE FROM devices WHERE iprange = ?', (ip_range,))
-        # Delete setup with the given iprange
-        cursor.execute('DELETE FROM setup WHERE iprange = ?', (ip_range,))
-        # Optionally, delete users associated with this setup
-        cursor.execute('DELETE FROM users WHERE setup = ?', (ip_range,))
-        conn.commit()
-        conn.close()
+        with self.db.transaction() as cursor:
+            # Delete devices with the given iprange
+            cursor.execute('DELETE FROM devices WHERE iprange = ? OR setup_id IN (SELECT id FROM setup WHERE iprange = ?)', (ip_range, ip_range))
+            # Delete setup with the given iprange
+            cursor.execute('DELETE FROM setup WHERE iprange = ?', (ip_range,))
+            # Optionally, delete users associated with this setup
+            cursor.execute('DELETE FROM users WHERE setup = ?', (ip_range,))
         
         print("DELETED setup with iprange",ip_range)
-        
+
     def handle_missing_devices(self,devices):
         """It gets a list of mac adresses to flag as missing in the db"""
-        conn = sqlite3.connect(self.db_file)
-        cursor = conn.cursor()
-        for mac in devices:
-          
-            cursor.execute('UPDATE devices SET missing = ? WHERE mac = ?', (True, mac))
-        conn.commit()
-        conn.close()
-
-    def collect_device_info(self,ip,client):
-        """Retrieve and store information for all connected devices."""
-        
+        self.db.executemany('UPDATE devices SET missing = ? WHERE mac = ?', [(True, mac) for mac in devices])
+
+    def collect_device_info(self,ip,client,master_ip=None,known=None):
+        """Retrieve and store information for all connected devices.
+
+        All metrics come from a single probe; the per-metric getters are only
+        used for values the probe could not provide. Metrics are numbers
+        (celsius, MB, bytes, milliseconds), None when unknown. known is the
+        stored row of the device expected at ip, whose model, MAC and RAM are
+        reused as long as the device wasn't rebooted or replaced since. client
+        is the device's pooled connection, every command on it has probe_timeout
+        seconds to answer.
+        """
+        facts = known if known and known.get("boot_id") and known.get("ip") == ip else None
+        info = self.run_probe(ip, master_ip, facts)
+        if info is None:
+            # Unreachable or wedged, the getters would only wait for it again
+            info = {}
+        else:
+            if facts and info.get("boot_id") == facts["boot_id"]:
+                for key in ("model", "mac", "ram"):
+                    info.setdefault(key, facts[key])
+
+            if info.get("model") is None:
+                info["model"] = self.get_raspi_model(ip)
+            if info.get("mac") is None:
+                info["mac"] = self.get_mac_address(ip)
+            if info.get("ram") is None:
+                info["ram"] = self.get_ram_size(ip)
+            if info.get("temperature") is None:
+                info["temperature"] = self.get_temperature(ip)
+            if info.get("storage_total") is None:
+                info["storage_total"], info["storage_free"] = self.get_storage(ip)
+            if info.get("lag") is None and info.get("lag_error") is None:
+                info.update(self.get_lag(ip,master_ip))
+
         info = {
                 "ip": ip,
-                "model": self.get_raspi_model(client),
-                "mac": self.get_mac_address(client),
-                "ram": self.get_ram_size(client),
-                "lag": self.get_lag(client,ip),
-                "storage": self.get_storage(client),
-                "temperature": self.get_temperature(client),
+                "model": info.get("model"),
+                "mac": info.get("mac"),
+                "ram": info.get("ram"),
+                "lag": info.get("lag"),
+                "lag_error": info.get("lag_error"),
+                "lag_min": info.get("lag_min"),
+                "lag_max": info.get("lag_max"),
+                "lag_jitter": info.get("lag_jitter"),
+                "lag_loss": info.get("lag_loss"),
+                "storage_total": info.get("storage_total"),
+                "storage_free": info.get("storage_free"),
+                "temperature": info.get("temperature"),
+                "boot_id": info.get("boot_id"),
                 "last_connection":datetime.now().isoformat()
             }
         
         #self.update_device_info(ip,info)
         print("Device information collected.")
         return info
-    
+
+    def run_probe(self, ip, master_ip=None, facts=None):
+        """
+        Run the composite probe on a device and return the parsed metrics, or
+        None if it didn't complete within probe_timeout.
+        With the stored facts of the device, the facts part of the probe only
+        runs if the device's boot id isn't the one they were read in. master_ip
+        is looked up when None, "" means the setup has no master.
+        """
+        if master_ip is None:
+            master_ip = self.get_master_ip(ip)
+        command = self.metrics_probe_command + f"echo \"boot_id=$(cat {self.boot_id_file} 2>/dev/null)\"; "
+        if facts:
+            boot_id = re.sub(r"[^0-9a-f-]", "", facts["boot_id"])
+            command += f"if [ \"$(cat {self.boot_id_file} 2>/dev/null)\" != '{boot_id}' ]; then {self.facts_probe_command} fi; "
+        else:
+            command += self.facts_probe_command
+        if master_ip:
+            command += f"echo \"lag=$({self.lag_command(master_ip)})\""
+        result = self.run_remote_command(ip, command, timeout=self.probe_timeout, kind="probe")
+        if result.error:
+            print(f"Probe failed on {ip}: {result.error}")
+            return None
+        return self.parse_probe_output(result.stdout, master_ip)
+
+    def parse_probe_output(self, output, master_ip=None):
+        """
+        Parses the key=value output of the probe into typed metrics, the same
+        values the per-metric getters return. Metrics that came back empty are
+        left out.
+        """
+        raw = {}
+        for line in output.splitlines():
+            key, sep, value = line.partition("=")
+            if sep and value.strip():
+                raw[key.strip()] = value.strip()
+
+        info = {}
+        if "model" in raw:
+            info["model"] = raw["model"]
+        if "mac" in raw:
+            info["mac"] = raw["mac"]
+        if raw.get("ram", "").isdigit():
+            info["ram"] = int(raw["ram"])
+        if "=" in raw.get("temperature", ""):
+            info["temperature"] = self.parse_number(raw["temperature"].split("=")[1])
+        parts = raw.get("storage", "").split()
+        if len(parts) >= 4 and parts[1].isdigit() and parts[3].isdigit():
+            info["storage_total"] = int(parts[1])
+            info["storage_free"] = int(parts[3])
+        if "boot_id" in raw:
+            info["boot_id"] = raw["boot_id"]
+
+        if not master_ip:
+            info.update(self.lag_statistics(None))
+        else:
+            info.update(self.lag_statistics(raw.get("lag", "")))
+        return info
+
+    def lag_command(self, master_ip):
+        """Shell command pinging the master lag_samples times, printing the round trip times in ms."""
+        return (
+            f"ping -n -c {self.lag_samples} -i {self.lag_sample_interval} -W 1 {master_ip} 2>/dev/null"
+            " | grep -o 'time=[0-9.]*' | cut -d= -f2 | tr '\\n' ' '"
+        )
+
+    def lag_statistics(self, output):
+        """
+        Turn the round trip times printed by lag_command into lag statistics in
+        ms: average (the lag), min, max, jitter (mean difference between
+        consecutive samples) and loss (fraction of pings without a reply).
+        output is None when the setup has no master.
+        """
+        stats = {"lag": None, "lag_error": None, "lag_min": None, "lag_max": None,
+                 "lag_jitter": None, "lag_loss": None}
+        if output is None:
+            stats["lag_error"] = self.LAG_NO_MASTER
+            return stats
+
+        samples = [value for value in map(self.parse_number, output.split()) if value is not None]
+        stats["lag_loss"] = round(max(0, self.lag_samples - len(samples)) / self.lag_samples, 2)
+        if not samples:
+            stats["lag_error"] = self.LAG_NO_RESPONSE
+            return stats
+
+        stats["lag"] = round(sum(samples) / len(samples), 2)
+        stats["lag_min"] = round(min(samples), 2)
+        stats["lag_max"] = round(max(samples), 2)
+        if len(samples) > 1:
+            stats["lag_jitter"] = round(
+                sum(abs(b - a) for a, b in zip(samples, samples[1:])) / (len(samples) - 1), 2
+            )
+        return stats
+
     def get_device_by_ip(self, ip):
-        client = self.connect_to_device(ip)
-        return self.collect_device_info(ip,client)
+        with self.device_connection(ip) as client:
+            return self.collect_device_info(ip,client)
     
-    def update_client(self,ip,mac):
-        client = self.connect_to_device(ip)
-        if client:
-            info = self.collect_device_info(ip,client)
+    def update_client(self,ip,mac,master_ip=None):
+        with self.device_connection(ip) as client:
+            info = self.collect_device_info(ip,client,master_ip,self.get_device_by_mac(mac)) if client else None
+        if info and info["mac"]:
+            self.connections.bind_mac(ip, info.get("mac"))
             self.save_device(info)
             #now get the whole data from db
             info_extended = self.get_device_by_mac(mac)
             print("info_extended",info_extended)
-            client.close()
         else:
             #client is missing, update and return DB values
             self.handle_missing_devices([mac])
             info_extended = self.get_device_by_mac(mac)
         return info_extended
 
-    def sort_devices(self,devices_order):
-        for device in devices_order:
-            mac = device["mac"]
-            sort = device["order"]
-            self.update_device_order(mac,sort)
+    def start_poller(self):
+        """Start refreshing devices in the background (see TelemetryPoller)."""
+        self.poller.start()
 
-    def get_mac_address(self, client):
-        """Retrieve the MAC address of the Raspberry Pi."""
-        try:
-            stdin, stdout, stderr = client.exec_command("cat /sys/class/net/eth0/address")
-            return stdout.read().decode().strip() or "Unknown MAC"
-        except Exception as e:
-            return f"Error: {e}"
+    def request_poll(self, mac):
+        """Ask the poller, in whichever process it runs, to refresh a device soon."""
+        self.db.execute(
+            "INSERT OR REPLACE INTO poll_requests (mac, requested) VALUES (?, ?)", (mac, time.time())
+        )
 
-    def get_temperature(self, client):
-        """Retrieve the CPU temperature from the Raspberry Pi."""
-        try:
-            stdin, stdout, stderr = client.exec_command("vcgencmd measure_temp")
-            output = stdout.read().decode().strip()
-            return output.split('=')[1] if output else "Unknown"
-        except Exception as e:
-            return f"Error: {e}"
-        
-    def get_storage(self, client):
-        """Retrieve the used and remaining storage from the Raspberry Pi."""
-        try:
-            # Execute the `df` command to check disk usage on the root filesystem
-            stdin, stdout, stderr = client.exec_command("df -h / | tail -n 1")
-            output = stdout.read().decode().strip()
-
-            if output:
-                parts = output.split()
-                total_storage = parts[1]  # Total size of the filesystem
-                used_storage = parts[2]   # Used space
-                available_storage = parts[3]  # Available space
-                return "T:"+total_storage+" / R:"+available_storage
-                """
-                return {
-                    "total": total_storage,
-                    "used": used_storage,
-                    "remaining": available_storage
-                }
-                """
+    def pop_poll_requests(self):
+        """Return and clear the MACs waiting for a refresh."""
+        # Called every tick, only take the write lock when there is something to clear
+        if not self.db.fetchone("SELECT 1 FROM poll_requests LIMIT 1"):
+            return set()
+        with self.db.transaction() as cursor:
+            return {row[0] for row in cursor.execute("DELETE FROM poll_requests RETURNING mac").fetchall()}
+
+    def metrics(self):
+        """Every metric of this process in the Prometheus text format, with fresh fleet gauges."""
+        self.collect_fleet_metrics()
+        return REGISTRY.render()
+
+    def collect_fleet_metrics(self):
+        """Set the fleet gauges from the stored device state: device counts, temperature and lag."""
+        setups = {setup["id"]: setup["name"] for setup in self.get_setups()}
+        counts = {(name, state): 0 for name in setups.values() for state in ("online", "missing", "rebooting")}
+        temperatures, lags, losses = [], [], []
+        for device in self.db.fetchall("SELECT * FROM devices WHERE setup_id IS NOT NULL"):
+            setup = setups.get(device["setup_id"], "")
+            if device["reboot_started"] is not None:
+                state = "rebooting"
+            elif device["missing"]:
+                state = "missing"
             else:
-                return {"error": "No output received"}
-        except Exception as e:
-            return {"error": str(e)}
+                state = "online"
+            counts[(setup, state)] = counts.get((setup, state), 0) + 1
+            if state != "online":
+                continue  # Stored values are stale
+            labels = {"setup": setup, "device": device["name"] or "", "ip": device["ip"] or "", "mac": device["mac"]}
+            for samples, value in ((temperatures, device["temperature"]), (lags, device["lag"]),
+                                   (losses, device["lag_loss"])):
+                value = self.parse_number(value)
+                if value is not None:
+                    samples.append((labels, value))
+
+        DEVICES.replace([({"setup": setup, "state": state}, count) for (setup, state), count in counts.items()])
+        DEVICE_TEMPERATURE.replace(temperatures)
+        DEVICE_LAG.replace(lags)
+        DEVICE_LAG_LOSS.replace(losses)
+
+    def get_device_state(self, mac):
+        """Latest known state of a device, as stored by the last scan or poll."""
+        return self.get_device_by_mac(mac)
+
+    def sort_devices(self,devices_order):
+        """Store a new order for many devices at once, in a single transaction."""
+        self.db.executemany(
+            'UPDATE devices SET sort = ? WHERE mac = ?',
+            [(device["order"], device["mac"]) for device in devices_order]
+        )
 
+    def run_probe_command(self, ip, command):
+        """Run one of the per-metric getters' commands, within probe_timeout."""
+        return self.run_remote_command(ip, command, timeout=self.probe_timeout, kind="probe")
 
-    def get_raspi_model(self, client):
+    def get_temperature(self, ip):
+        """Retrieve the CPU temperature from the Raspberry Pi, in celsius."""
+        result = self.run_probe_command(ip, "vcgencmd measure_temp")
+        if result.error:
+            print(f"Error reading temperature: {result.error}")
+            return None
+        output = result.stdout.strip()
+        return self.parse_number(output.split('=')[1]) if "=" in output else None
+
+    def get_storage(self, ip):
+        """Retrieve the total and available storage of the root filesystem, in bytes."""
+        # Execute the `df` command to check disk usage on the root filesystem
+        result = self.run_probe_command(ip, "df -B1 / | tail -n 1")
+        if result.error:
+            print(f"Error reading storage: {result.error}")
+            return None, None
+        parts = result.stdout.strip().split()
+        if len(parts) >= 4 and parts[1].isdigit() and parts[3].isdigit():
+            return int(parts[1]), int(parts[3])  # Total size, available space
+        return None, None
+
+    def get_raspi_model(self, ip):
         """Retrieve the Raspberry Pi model."""
-        try:
-            stdin, stdout, stderr = client.exec_command("cat /proc/device-tree/model")
-            return stdout.read().decode().strip() or "Unknown model"
-        except Exception as e:
-            return f"Error: {e}"
+        result = self.run_probe_command(ip, "cat /proc/device-tree/model")
+        if result.error:
+            return f"Error: {result.error}"
+        return result.stdout.strip().strip("\x00") or "Unknown model"
 
-    def get_ram_size(self, client):
+    def get_ram_size(self, ip):
         """Retrieve the total RAM size in MB."""
-        try:
-            stdin, stdout, stderr = client.exec_command("free -m | awk '/^Mem:/ {print $2}'")
-            return f"{stdout.read().decode().strip()} MB" if stdout else "Unknown RAM"
-        except Exception as e:
-            return f"Error: {e}"
-
-    def get_mac_address(self, client):
-        """Retrieve the MAC address of the Raspberry Pi."""
-        try:
-            stdin, stdout, stderr = client.exec_command("cat /sys/class/net/eth0/address")
-            return stdout.read().decode().strip() or "Unknown MAC"
-        except Exception as e:
-            return f"Error: {e}"
+        result = self.run_probe_command(ip, "free -m | awk '/^Mem:/ {print $2}'")
+        if result.error:
+            print(f"Error reading RAM: {result.error}")
+            return None
+        output = result.stdout.strip()
+        return int(output) if output.isdigit() else None
+
+    def get_mac_address(self, ip):
+        """Retrieve the MAC address of the Raspberry Pi, None if it can't be read."""
+        result = self.run_probe_command(ip, "cat /sys/class/net/eth0/address")
+        if not result:
+            # Saved devices are keyed by MAC, a placeholder would merge every board without one
+            print(f"Error reading MAC address: {result.error or result.stderr.strip() or f'exit status {result.exit_status}'}")
+            return None
+        return result.stdout.strip() or None
     
-    def get_lag(self, client,ip):
-        """Retrieve the lag using ping to the master player."""
+    def get_lag(self, ip,master_ip=None):
+        """Measure the lag to the master player with a ping burst, as lag statistics in ms."""
+        if master_ip is None:
+            master_ip = self.get_master_ip(ip)
+        if not master_ip:
+            return self.lag_statistics(None)
+        result = self.run_probe_command(ip, self.lag_command(master_ip))
+        if result.error:
+            print(f"Error measuring lag: {result.error}")
+            return self.lag_statistics("")
+        return self.lag_statistics(result.stdout)
+
+    def connect_to_device(self, ip, borrow=False):
+        """
+        Return a pooled SSH connection to a device, connecting only if needed.
+        A borrowed connection isn't evicted until self.connections.release(ip).
+        """
+        start = time.monotonic()
+        pooled = ip in self.connections  # A dead pooled connection still counts as pooled
+        client = self.connections.get(ip, borrow=borrow)
+        outcome = "failed" if client is None else "pooled" if pooled else "connected"
+        SSH_CONNECT_SECONDS.observe(time.monotonic() - start, outcome=outcome)
+        return client
+
+    @contextmanager
+    def device_connection(self, ip):
+        """Borrow the pooled connection to a device for the block, None if it can't connect."""
+        client = self.connect_to_device(ip, borrow=True)
         try:
-            # Send a single ping request with a 1-second timeout
-            stdin, stdout, stderr = client.exec_command(f"ping -c 1 -W 1 {self.get_master_ip(ip)}")
-            output = stdout.read().decode().strip()
-
-            # Extract the ping time from the output
-            if "time=" in output:
-                lag = output.split("time=")[-1].split(" ")[0]
-                return f"{round(float(lag),2)} ms"
-            else:
-                return "Ping failed or no response"
-        except Exception as e:
-            return f"no master detected {e}"#f"Error: {e}"
+            yield client
+        finally:
+            if client is not None:
+                self.connections.release(ip)
 
-    def connect_to_device(self, ip):
-        """Establish an SSH connection to a device."""
+    def open_connection(self, ip):
+        """Establish a new SSH connection to a device."""
         try:
             client = paramiko.SSHClient()
             client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-            client.connect(ip, username=self.username, password=self.password, timeout=5)
+            client.connect(ip, port=self.ssh_port, username=self.username, password=self.password, timeout=5)
             return client
         except Exception as e:
             print(f"Failed to connect to {ip}: {e}")
@@ -546,261 +2312,665 @@ class PiVideoManager:
 
     def update_last_connection(self, mac):
         """Update the last connection time for a device."""
-        conn = sqlite3.connect(self.db_file)
-        cursor = conn.cursor()
-        cursor.execute('UPDATE devices SET last_connection = ? WHERE mac = ?', (datetime.now().isoformat(), mac))
-        conn.commit()
-        conn.close()
-    
+        self.db.execute('UPDATE devices SET last_connection = ? WHERE mac = ?', (datetime.now().isoformat(), mac))
+
     def update_device_order(self, mac,sort):
         """Update sort for a device."""
-        conn = sqlite3.connect(self.db_file)
-        cursor = conn.cursor()
-        cursor.execute('UPDATE devices SET sort = ? WHERE mac = ?', (sort, mac))
-        conn.commit()
-        conn.close()
+        self.db.execute('UPDATE devices SET sort = ? WHERE mac = ?', (sort, mac))
 
     def set_master_device(self, ip):
         """Set a specific device as the master."""
-        conn = sqlite3.connect(self.db_file)
-        cursor = conn.cursor()
-        cursor.execute('UPDATE devices SET master = FALSE')
-        cursor.execute('UPDATE devices SET master = TRUE WHERE ip = ?', (ip,))
-        conn.commit()
-        conn.close()
+        with self.db.transaction() as cursor:
+            cursor.execute('UPDATE devices SET master = FALSE')
+            cursor.execute('UPDATE devices SET master = TRUE WHERE ip = ?', (ip,))
         print(f"Device {ip} set as master.")
 
     def show_txt_message_on_screen(self, ip, msg):
         """
-        Shows the provided message on the screen of all connected devices using ffmpeg and omxplayer.
+        Shows the provided message on the screen of a device with omxplayer.
+
+        The clip is rendered on the manager and copied over SFTP only when the
+        device doesn't have it yet; when ffmpeg isn't available here the device
+        renders it itself. The player is stopped and the clip started in the
+        same remote command (pkill matches process names, so the shell running
+        it is spared).
         """
         print("Executing show message on",ip,"msg:",msg)
-        client = self.connect_to_device(ip)
-        self.kill_omxplayer(ip)
-        # Construct the ffmpeg command
-        escaped_msg = msg.replace(':', r'\:').replace('\n', r'\\ ')
-
-        seconds = 5
-        #command = (
-        #    f'ffmpeg -y -f lavfi -i "color=c=black:s=1280x720,drawtext=fontfile=/usr/share/fonts/FreeSans.ttf:fontsize=48:text=\'{escaped_msg}\':fontcolor=white:x=(w-text_w)/2:y=(h-text_h)/2\" -t 1 -c:v libx264 -pix_fmt yuv420p msg.mp4 && omxplayer msg.mp4 --layer 2 --loop {seconds}'
-        #)
-        command = (
-            f'ffmpeg -y -f lavfi -i color=black:s=320x240 \
-        -vf "drawtext=text=\'{escaped_msg}\':fontcolor=white:fontsize=24:x=(w-text_w)/2:y=(h-text_h)/2" \
-        -t 5 -r 1 -c:v libx264 -preset ultrafast -crf 35 -pix_fmt yuv420p msg.mp4 && omxplayer -b --no-osd msg.mp4 --layer 3'
-        )
-        print(command)
-        # Execute the command on the device
         try:
-            stdin, stdout, stderr = client.exec_command(command)
-            
-            # Wait for the command to complete
-            while not stdout.channel.exit_status_ready():
-                time.sleep(1)
+            clip = self.render_message(msg)
+            if clip is None:
+                escaped_msg = msg.replace(':', r'\:').replace('\n', r'\\ ').replace("'", "")
+                command = (
+                    f'sudo pkill omxplayer; ffmpeg -y -f lavfi -i {self.message_filter} '
+                    f'-vf "drawtext=text=\'{escaped_msg}\':{self.message_drawtext}" '
+                    f'-t {self.message_seconds} -r 1 -c:v libx264 -preset ultrafast -crf 35 -pix_fmt yuv420p msg.mp4 '
+                    f'&& (nohup omxplayer -b --no-osd msg.mp4 --layer 3 > /dev/null 2>&1 &)'
+                )
+                result = self.run_remote_command(ip, command, timeout=60, kind="message")
+            else:
+                remote = f"{self.message_remote_dir}/{os.path.basename(clip)}"
+                command = (
+                    f"test -f {remote} || exit 3; sudo pkill omxplayer; "
+                    f"(nohup omxplayer -b --no-osd {remote} --layer 3 > /dev/null 2>&1 &)"
+                )
+                result = self.run_remote_command(ip, command, kind="message")
+                if result.exit_status == 3:
+                    with self.device_connection(ip) as client:
+                        self.push_message(client, clip, remote)
+                    result = self.run_remote_command(ip, command, kind="message")
 
-            exit_status = stdout.channel.recv_exit_status()  # Blocks until command is done
-            
-            if exit_status == 0:
+            if result:
                 print("Message displayed successfully.")
-            else:
-                error_msg = stderr.read().decode()
-                print(f"Error showing message: {error_msg}")
-            return True
+                return True
+            print(f"Error showing message: {result.error or result.stderr}")
+            return False
 
         except Exception as e:
             print(f"Error showing message: {e}")
-    
-    def reboot_setup(self,setupname):
-        devices = self.get_all_devices_with_setup_name(setupname)
-        
-        # Define a helper function for threading
-        def reboot_device(ip):
-            #self.playback_control(ip, command)
-            self.reboot_device(ip)
+            self.connections.discard(ip)
+            return False
+
+    def render_message(self, msg):
+        """
+        Render a message clip on the manager and return its path, named after
+        the hash of the message and render settings so it is only encoded once.
+        Returns None if it can't be rendered here (no ffmpeg).
+        """
+        settings = f"{self.message_filter}|{self.message_drawtext}|{self.message_seconds}"
+        digest = hashlib.sha256(f"{settings}\n{msg}".encode()).hexdigest()[:32]
+        os.makedirs(self.message_cache_dir, exist_ok=True)
+        clip = os.path.join(self.message_cache_dir, f"{digest}.mp4")
+        if os.path.exists(clip):
+            return clip
+
+        # The text goes through a file so it needs no escaping for drawtext. Both
+        # files get names of their own, the same message may be rendered twice at once
+        fd, text_file = tempfile.mkstemp(prefix=f"{digest}-", suffix=".txt", dir=self.message_cache_dir)
+        with os.fdopen(fd, "w") as f:
+            f.write(msg)
+        fd, part = tempfile.mkstemp(prefix=f"{digest}-", suffix=".part", dir=self.message_cache_dir)
+        os.close(fd)
+        command = [
+            "ffmpeg", "-y", "-loglevel", "error", "-f", "lavfi", "-i", self.message_filter,
+            "-vf", f"drawtext=textfile={os.path.basename(text_file)}:{self.message_drawtext}",
+            "-t", str(self.message_seconds), "-r", "1", "-c:v", "libx264", "-preset", "ultrafast",
+            "-crf", "35", "-pix_fmt", "yuv420p", "-f", "mp4", os.path.basename(part),
+        ]
+        try:
+            result = subprocess.run(command, cwd=self.message_cache_dir, stdout=subprocess.PIPE,
+                                    stderr=subprocess.PIPE, text=True, timeout=60)
+            if result.returncode != 0:
+                print(f"Could not render message: {result.stderr}")
+                return None
+            os.replace(part, clip)
+            return clip
+        except (OSError, subprocess.TimeoutExpired) as e:
+            print(f"Could not render message: {e}")
+            return None
+        finally:
+            for path in (text_file, part):
+                if os.path.exists(path):
+                    os.remove(path)
+
+    def push_message(self, client, clip, remote):
+        """Copy a rendered clip to a device, under a temporary name until complete."""
+        sftp = client.open_sftp()
+        try:
+            try:
+                sftp.mkdir(self.message_remote_dir)
+            except IOError:
+                pass  # Already there
+            sftp.put(clip, remote + ".part")
+            sftp.posix_rename(remote + ".part", remote)
+        finally:
+            sftp.close()
 
-        threads = []
+    def reboot_setup(self,setupname,batch_size=None):
+        """Reboot every device of a setup, a batch at a time. Returns the rolling_reboot() FleetResult."""
+        devices = self.get_all_devices_with_setup_name(setupname)
 
-        # Create and start a thread for each device
         for d in devices:
             print("sending reboot signal to device IP",d["ip"])
-            thread = threading.Thread(target=reboot_device, args=(d["ip"],))
-            thread.start()
-            threads.append(thread)
 
-        # Wait for all threads to complete
-        for thread in threads:
-            thread.join()
+        return self.rolling_reboot([d["ip"] for d in devices if d["ip"]], batch_size)
 
-        return True
+    def start_reboot(self, ips, batch_size=None):
+        """Run rolling_reboot() in a background thread, progress shows on the device rows."""
+        threading.Thread(target=self.rolling_reboot, args=(list(ips), batch_size), daemon=True).start()
 
+    def rolling_reboot(self, ips, batch_size=None, ready_timeout=None, stop_on_failure=True):
+        """
+        Reboot devices batch_size at a time, waiting for every device of a
+        batch to be ready before the next batch starts. Returns a FleetResult
+        whose results are each device's seconds from reboot to ready. With
+        stop_on_failure, a device that doesn't come back within ready_timeout
+        stops the rollout so the rest of the setup keeps playing. Devices
+        another rollout is already rebooting are reported as failed and left
+        to it.
+        """
+        batch_size = batch_size or self.reboot_batch_size
+        ready_timeout = ready_timeout or self.reboot_ready_timeout
+        result = FleetResult()
+        start = time.monotonic()
+
+        ips = list(ips)
+        with self.reboot_lock:
+            busy = [ip for ip in ips if ip in self.rebooting]
+            ips = [ip for ip in ips if ip not in self.rebooting]
+            self.rebooting.update(ips)
+        for ip in busy:
+            result.fail(ip, "Already rebooting", 0)
+        try:
+            self.reboot_batches(ips, batch_size, ready_timeout, stop_on_failure, result)
+        finally:
+            with self.reboot_lock:
+                self.rebooting.difference_update(ips)
+
+        result.elapsed = time.monotonic() - start
+        return result
+
+    def reboot_batches(self, ips, batch_size, ready_timeout, stop_on_failure, result):
+        """Reboot ips batch by batch, adding each device's outcome to result."""
+        for index in range(0, len(ips), batch_size):
+            batch = ips[index:index + batch_size]
+            print(f"Rebooting {', '.join(batch)}")
+            outcome = self.run_on_devices(
+                batch, lambda ip: self.reboot_and_wait(ip, ready_timeout),
+                concurrency=batch_size, timeout=ready_timeout + 30,
+            )
+            for ip, seconds in outcome.results.items():
+                print(f"{ip} ready after {seconds:.1f}s")
+                result.add(ip, seconds, outcome.durations[ip])
+            for ip, error in outcome.errors.items():
+                print(f"{ip} did not come back: {error}")
+                result.fail(ip, error, outcome.durations[ip])
+            if stop_on_failure and outcome.errors:
+                for ip in ips[index + batch_size:]:
+                    result.fail(ip, "Not rebooted, a device of an earlier batch didn't come back", 0)
+                break
+
+    def reboot_and_wait(self, ip, ready_timeout=None):
+        """Reboot a device and wait until it's ready. Returns the seconds it took, raises if it doesn't come back."""
+        ready_timeout = ready_timeout or self.reboot_ready_timeout
+        self.set_rebooting(ip, True)
+        try:
+            # The boot id tells the device that comes back apart from the one going down
+            result = self.run_remote_command(ip, f"cat {self.boot_id_file}; sudo reboot", timeout=10, kind="reboot")
+            self.connections.discard(ip)
+            boot_id = result.stdout.strip().split("\n")[0]
+            if not boot_id:
+                raise RuntimeError(result.error or result.stderr or "Reboot failed")
+
+            sent = time.monotonic()
+            while time.monotonic() - sent < ready_timeout:
+                time.sleep(self.reboot_probe_interval)
+                if self.is_ready(ip, boot_id):
+                    seconds = time.monotonic() - sent
+                    self.set_rebooting(ip, False, seconds)
+                    return seconds
+            raise RuntimeError(f"Not ready after {ready_timeout}s")
+        except Exception:
+            self.set_rebooting(ip, False)
+            raise
 
-    def reboot_device(self,ip):
-        client = self.connect_to_device(ip)
-        command = ('sudo reboot')
+    def is_ready(self, ip, old_boot_id):
+        """True once a rebooted device answers on SSH with a new boot id and its player running."""
         try:
-            stdin, stdout, stderr = client.exec_command(command)
-            
-            # Wait for the command to complete
-            while not stdout.channel.exit_status_ready():
-                time.sleep(1)
+            socket.create_connection((ip, self.ssh_port), timeout=1).close()
+        except OSError:
+            return False
+        result = self.run_remote_command(
+            ip, f"cat {self.boot_id_file} && pgrep -f '{self.player_process_pattern}' >/dev/null && echo ready", timeout=10,
+            kind="ready_check",
+        )
+        if result.error:
+            self.connections.discard(ip)
+        lines = result.stdout.split()
+        return len(lines) == 2 and lines[0] != old_boot_id and lines[1] == "ready"
 
-            exit_status = stdout.channel.recv_exit_status()  # Blocks until command is done
-            
-            if exit_status == 0:
-                print("Device reboot message sent.")
-            else:
-                error_msg = stderr.read().decode()
-                print(f"Error trying to reboot: {error_msg}")
-            return True
-        except Exception as e:
-            print(f"Error trying to reboot: {e}")
+    def set_rebooting(self, ip, rebooting, time_to_ready=None):
+        """
+        Mark a device as rebooting or not. With time_to_ready it came back
+        ready: it's no longer missing, and the poller refreshes it now instead
+        of after the back-off it got while the device was down.
+        """
+        with self.db.transaction() as cursor:
+            cursor.execute(
+                "UPDATE devices SET reboot_started = ?, time_to_ready = coalesce(?, time_to_ready) WHERE ip = ?",
+                (time.time() if rebooting else None, time_to_ready, ip)
+            )
+            if time_to_ready is not None:
+                cursor.execute(
+                    "UPDATE devices SET missing = ?, last_connection = ? WHERE ip = ?",
+                    (False, datetime.now().isoformat(), ip)
+                )
+                cursor.execute(
+                    "INSERT OR REPLACE INTO poll_requests (mac, requested) SELECT mac, ? FROM devices WHERE ip = ?",
+                    (time.time(), ip)
+                )
 
-    def kill_omxplayer(self,ip):
-        client = self.connect_to_device(ip)
-        command = ('sudo pkill -f omxplayer')
+    def reboot_device(self,ip):
         try:
-            stdin, stdout, stderr = client.exec_command(command)
-            
-            # Wait for the command to complete
-            while not stdout.channel.exit_status_ready():
-                time.sleep(1)
-
-            exit_status = stdout.channel.recv_exit_status()  # Blocks until command is done
-            
-            if exit_status == 0:
+            # The connection may drop before the exit status makes it back
+            result = self.run_remote_command(ip, 'sudo reboot', timeout=10, kind="reboot")
+            if result.exit_status == 0 or result.error == "connection lost":
                 print("Device reboot message sent.")
-            else:
-                error_msg = stderr.read().decode()
-                print(f"Error trying to reboot: {error_msg}")
+                return True
+            print(f"Error trying to reboot: {result.error or result.stderr}")
+            return False
+        finally:
+            # The device is going down, don't keep its connection in the pool
+            self.connections.discard(ip)
+
+    def kill_omxplayer(self,ip):
+        result = self.run_remote_command(ip, 'sudo pkill -f omxplayer', kind="kill_player")
+        # pkill exits with 1 when there was nothing to stop
+        if result.exit_status in (0, 1):
+            print("Player stopped.")
             return True
-        except Exception as e:
-            print(f"Error trying to reboot: {e}")
+        print(f"Error stopping player: {result.error or result.stderr}")
+        return False
 
     def execute_remote_command(self,ip, command, wait_for_output=True):
-        try:
-            client = self.connect_to_device(ip)
-            
-            stdin, stdout, stderr = client.exec_command(command)
-            
-            if wait_for_output:
-                # Wait for the command to complete
-                while not stdout.channel.exit_status_ready():
-                    time.sleep(1)
-                
-                exit_status = stdout.channel.recv_exit_status()  # Blocks until command is done
-                output = stdout.read().decode()
-                error = stderr.read().decode()
-                
-                if exit_status == 0:
-                    print(f"Command executed successfully on {ip}: {output}")
-                    return True
-                else:
-                    print(f"Error executing command on {ip}: {error}")
-                    return False
-            
+        if not wait_for_output:
+            remote = self.start_remote_command(ip, command)
+            if remote is None:
+                return False
+            remote.done()  # Nobody waits for it
             print(f"Command sent to {ip}, not waiting for output.")
             return True
-            
+
+        result = self.run_remote_command(ip, command, kind="custom")
+        if result:
+            print(f"Command executed successfully on {ip}: {result.stdout}")
+            return True
+        print(f"Error executing command on {ip}: {result.error or result.stderr}")
+        return False
+
+    def start_remote_command(self, ip, command):
+        """
+        Start command on a device over its pooled connection, returns a RemoteCommand or None.
+        The connection stays borrowed until the command is waited for or cancelled.
+        """
+        client = self.connect_to_device(ip, borrow=True)
+        if not client:
+            return None
+        try:
+            channel = client.get_transport().open_session(timeout=5)
+            channel.exec_command(command)
         except Exception as e:
             print(f"Error connecting to {ip}: {e}")
-            return False
-        finally:
-            if client:
-                client.close()
+            self.connections.release(ip)
+            self.connections.discard(ip)
+            return None
+        return RemoteCommand(ip, command, channel, release=lambda: self.connections.release(ip))
+
+    def run_remote_command(self, ip, command, timeout=None, kind="command"):
+        """
+        Run command on a device and wait for it, at most timeout seconds.
+        Returns a RemoteResult. kind names the command in the metrics.
+        """
+        start = time.monotonic()
+        remote = self.start_remote_command(ip, command)
+        if remote is None:
+            result = RemoteResult(ip, command, duration=time.monotonic() - start, error="could not connect")
+        else:
+            result = remote.wait(timeout or self.remote_timeout)
+            if result.error == "connection lost":
+                self.connections.discard(ip)
+        self.record_remote_command(kind, result)
+        return result
+
+    def record_remote_command(self, kind, result):
+        outcome = "error" if result.error else "ok" if result.ok else "failed"
+        REMOTE_COMMAND_SECONDS.observe(result.duration, kind=kind, outcome=outcome)
+
+    def run_on_devices(self, ips, action, concurrency=None, timeout=None):
+        """
+        Runs action(ip) on every device from a single event loop with bounded
+        concurrency and a per-device timeout. Returns a FleetResult.
+        """
+        return asyncio.run(self.fan_out(ips, action, concurrency, timeout))
+
+    async def fan_out(self, ips, action, concurrency=None, timeout=None):
+        concurrency = concurrency or self.fleet_concurrency
+        timeout = timeout or self.device_timeout
+        ips = list(ips)
+
+        loop = asyncio.get_running_loop()
+        result = FleetResult()
+        start = time.monotonic()
+        if not ips:
+            return result
+
+        # paramiko is blocking, so device work runs on the manager's long-lived thread pool
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def run(ip):
+            async with semaphore:
+                device_start = time.monotonic()
+                try:
+                    value = await asyncio.wait_for(loop.run_in_executor(self.executor, action, ip), timeout)
+                    result.add(ip, value, time.monotonic() - device_start)
+                except asyncio.TimeoutError:
+                    result.fail(ip, f"Timed out after {timeout}s", time.monotonic() - device_start)
+                except Exception as e:
+                    result.fail(ip, str(e), time.monotonic() - device_start)
+
+        await asyncio.gather(*(run(ip) for ip in ips))
+
+        result.elapsed = time.monotonic() - start
+        return result
 
     ## Playback functions
-    def playback_control(self, ip, command="pause"):
+    def playback_control(self, ip, command="pause", backend=None):
+        """
+        Pause (toggle), mute or unmute the player of a device, through its
+        playback agent if it runs one, otherwise with a single SSH command
+        built for the player and audio stack it runs. The stack is detected
+        once and kept on the device row; backend can be given by callers that
+        already loaded the row.
+        """
         print("playback_control", ip, command)
-        
-        if command == "pause":
-            # Try omxplayer-sync first
-            omx_cmd = (
-                "sudo -E bash -c 'export DBUS_SESSION_BUS_ADDRESS=$(cat /tmp/omxplayerdbus.${USER:-root}) && "
-                "dbus-send --print-reply=literal --session --dest=org.mpris.MediaPlayer2.omxplayer "
-                "/org/mpris/MediaPlayer2 org.mpris.MediaPlayer2.Player.Action int32:16 >/dev/null'"
-            )
-            self.execute_remote_command(ip, omx_cmd, wait_for_output=True)
-            
-            vlc_cmd = (
-                "VOLUME=$(sudo -u pi pactl get-sink-volume @DEFAULT_SINK@ | grep -o '[0-9]\\+%' | head -n1); "
-                "[ -n \"$VOLUME\" ] && echo \"$VOLUME\" > /home/pi/.last_volume; "
-                "sudo -u pi pactl set-sink-mute @DEFAULT_SINK@ 1"
-            )
-            self.execute_remote_command(ip, vlc_cmd, wait_for_output=True)
-
-        elif command == "mute":
-            # Try omxplayer-sync first
-            omx_cmd = (
-                "sudo -E bash -c 'export DBUS_SESSION_BUS_ADDRESS=$(cat /tmp/omxplayerdbus.${USER:-root}) && "
-                "dbus-send --print-reply=literal --session --dest=org.mpris.MediaPlayer2.omxplayer "
-                "/org/mpris/MediaPlayer2 org.freedesktop.DBus.Properties.Set "
-                "string:\"org.mpris.MediaPlayer2.Player\" string:\"Volume\" variant:double:0.0 >/dev/null'"
-            )
-            self.execute_remote_command(ip, omx_cmd, wait_for_output=True)
-            
-            # Enhanced VLC/ALSA mute
-            vlc_cmd = (
-                "for card in $(aplay -l | grep '^card' | awk '{print $2}' | sed 's/://'); do "
-                "for ctl in $(amixer -c \"$card\" scontrols | awk -F\"'\" '{print $2}'); do "
-                "amixer -c \"$card\" sset \"$ctl\" mute || true; "
-                "done; done"
-            )
-            self.execute_remote_command(ip, vlc_cmd, wait_for_output=True)
-
-        elif command == "unmute":
-            # Try omxplayer-sync first
-            omx_cmd = (
-                "sudo -E bash -c 'export DBUS_SESSION_BUS_ADDRESS=$(cat /tmp/omxplayerdbus.${USER:-root}) && "
-                "dbus-send --print-reply=literal --session --dest=org.mpris.MediaPlayer2.omxplayer "
-                "/org/mpris/MediaPlayer2 org.freedesktop.DBus.Properties.Set "
-                "string:\"org.mpris.MediaPlayer2.Player\" string:\"Volume\" variant:double:1.0 >/dev/null'"
-            )
-            self.execute_remote_command(ip, omx_cmd, wait_for_output=True)
-            
-            # Enhanced VLC/ALSA unmute
-            vlc_cmd = (
-               "for card in $(aplay -l | grep '^card' | awk '{print $2}' | sed 's/://'); do "
-                "for ctl in $(amixer -c \"$card\" scontrols | awk -F\"'\" '{print $2}'); do "
-                "amixer -c \"$card\" sset \"$ctl\" unmute || true; "
-                "done; done"
-            )
-            self.execute_remote_command(ip, vlc_cmd, wait_for_output=True)
-
-        else:
+        if command not in self.omxplayer_commands:
             print(f"Unknown command: {command}")
             return False
 
+        device = self.db.fetchone("SELECT mac FROM devices WHERE ip = ?", (ip,))
+        acks = self.send_to_agents([{"ip": ip, "mac": device["mac"]}] if device else [], command)
+        if ip in acks:
+            if not acks[ip]["ok"]:
+                print(f"Error on playback control on {ip}: {acks[ip]['error'] or 'agent failed'}")
+                return False
+            self.save_playback_state(ip, command)
+            return True
+
+        return self.ssh_playback_control(ip, command, backend)
+
+    def ssh_playback_control(self, ip, command, backend=None):
+        """Run a playback command on a device over SSH, with the command for its backend."""
+        if not backend or not backend.get("player"):
+            backend = self.get_playback_backend(ip)
+        result = self.run_remote_command(ip, self.playback_command(backend, command), kind="playback")
+        if not result and result.error != "could not connect":
+            # The device may have switched players since it was detected
+            detected = self.get_playback_backend(ip, detect=True)
+            if detected != backend:
+                result = self.run_remote_command(ip, self.playback_command(detected, command), kind="playback")
+        if not result:
+            print(f"Error on playback control on {ip}: {result.error or result.stderr}")
+            return False
+
+        self.save_playback_state(ip, command)
         return True
 
+    def playback_command(self, backend, command):
+        """The shell command that runs a playback command on a device with the given backend."""
+        if backend is None:
+            # Unknown device, try every stack in one go until one works
+            return (
+                f"{{ {self.omxplayer_commands[command]}; }} || {{ {self.pulse_commands[command]}; }} || "
+                f"{{ {self.alsa_command(None, command)}; }}"
+            )
+        if backend["player"] == "omxplayer":
+            return self.omxplayer_commands[command]
+        if backend["audio"] == "pulse":
+            return self.pulse_commands[command]
+        # Pausing VLC without PulseAudio mutes it, like with PulseAudio
+        return self.alsa_command(backend["alsa_controls"], "mute" if command == "pause" else command)
+
+    def alsa_command(self, controls, command):
+        """
+        amixer calls muting/unmuting the given card/control pairs, or every
+        control when they're unknown. Fails unless at least one control was set.
+        """
+        action = "unmute" if command == "unmute" else "mute"
+        if controls is None:
+            return ALSA_COMMAND.format(action)
+        if not controls:
+            return "false"
+        calls = "".join(f"amixer -q -c {card} sset '{control}' {action} && status=0; " for card, control in controls)
+        return f"status=1; {calls}[ $status = 0 ]"
+
+    def get_playback_backend(self, ip, detect=False):
+        """
+        Return the player/audio stack of a device as stored on its row,
+        detecting and storing it first if unknown (or if detect is set).
+        Returns None if it can't be found out.
+        """
+        if not detect:
+            device = self.db.fetchone("SELECT player, audio, alsa_controls FROM devices WHERE ip = ?", (ip,))
+            if device and device["player"]:
+                return self.parse_playback_backend(device)
+
+        result = self.run_remote_command(ip, self.backend_probe_command, kind="backend_probe")
+        if result.exit_status is None:
+            return None
+        raw = {"player": None, "audio": None, "alsa": []}
+        for line in result.stdout.splitlines():
+            key, sep, value = line.partition("=")
+            if sep and key == "alsa":
+                raw["alsa"].append(value)
+            elif sep and key in raw:
+                raw[key] = value.strip()
+        if not raw["player"]:
+            return None
+
+        device = {"player": raw["player"], "audio": raw["audio"], "alsa_controls": "\n".join(raw["alsa"])}
+        self.db.execute(
+            "UPDATE devices SET player = ?, audio = ?, alsa_controls = ? WHERE ip = ?",
+            (device["player"], device["audio"], device["alsa_controls"], ip)
+        )
+        print(f"Detected {device['player']} with {device['audio']} audio on {ip}")
+        return self.parse_playback_backend(device)
+
+    def parse_playback_backend(self, device):
+        """Backend dict from the player columns of a device row."""
+        controls = []
+        for line in (device.get("alsa_controls") or "").splitlines():
+            card, sep, control = line.partition("/")
+            if sep and card.isdigit() and control and "'" not in control:
+                controls.append((card, control))
+        return {"player": device["player"], "audio": device["audio"], "alsa_controls": controls}
+
+    def save_playback_state(self, ip, command):
+        """Remember what the last playback command did to a device."""
+        if command == "pause":
+            # The omxplayer action toggles between pause and play
+            self.db.execute("UPDATE devices SET paused = NOT paused WHERE ip = ?", (ip,))
+        elif command in ("mute", "unmute"):
+            self.db.execute("UPDATE devices SET muted = ? WHERE ip = ?", (command == "mute", ip))
+
     
-    def playbackall_control(self, iprange, command="pause"):
+    def playbackall_control(self, iprange, command="pause", synchronized=True):
+        """
+        Run a playback command on every device of a setup. Devices running a
+        playback agent all get it in one multicast packet; the rest over SSH,
+        where synchronized stages the command on every device and triggers it
+        on all of them at the same moment, and the result reports how far
+        apart they acted. The same command sent to the same setup while one is
+        running shares its result, so a double click doesn't toggle twice.
+        """
+        if command not in self.omxplayer_commands:
+            print(f"Unknown command: {command}")
+            return FleetResult()
+        return self.in_flight.run(
+            ("playbackall", iprange, command),
+            lambda: self.run_playbackall(iprange, command, synchronized),
+        )
+
+    def run_playbackall(self, iprange, command, synchronized):
         # Get devices in iprange
         devices = self.get_all_devices_in_iprange(iprange)
-        
-        # Define a helper function for threading
-        def control_device(ip):
-            self.playback_control(ip, command)
-
-        threads = []
+        start = time.monotonic()
+        acks = self.send_to_agents(devices, command)
+        devices = [d for d in devices if d["ip"] not in acks]
+        backends = {d["ip"]: self.parse_playback_backend(d) if d["player"] else None for d in devices}
+
+        if not devices:
+            result = FleetResult()
+        elif synchronized:
+            def prepare(ip):
+                return self.playback_command(backends[ip] or self.get_playback_backend(ip), command)
+
+            result = self.run_synchronized([d["ip"] for d in devices], prepare)
+            for ip in result.ok:
+                self.save_playback_state(ip, command)
+        else:
+            def control_device(ip):
+                return self.ssh_playback_control(ip, command, backends[ip])
 
-        # Create and start a thread for each device
-        for d in devices:
-            thread = threading.Thread(target=control_device, args=(d["ip"],))
-            thread.start()
-            threads.append(thread)
+            result = self.run_on_devices([d["ip"] for d in devices], control_device)
 
-        # Wait for all threads to complete
-        for thread in threads:
-            thread.join()
+        for ip, ack in acks.items():
+            if ack["ok"]:
+                result.add(ip, True, ack["latency"])
+                self.save_playback_state(ip, command)
+            else:
+                result.fail(ip, ack["error"] or "agent failed", ack["latency"])
+        result.elapsed = time.monotonic() - start
+        return result
 
-        return True
+    def send_to_agents(self, devices, command):
+        """
+        Send command to the playback agents of the devices known to run one,
+        returns {ip: ack} for the ones that answered. A device whose agent
+        didn't answer goes over SSH until it answers a hello again.
+        """
+        if self.agents is None:
+            return {}
+        ips = {d["mac"]: d["ip"] for d in devices if d["mac"] in self.agent_macs and d["ip"]}
+        acks = self.agents.send(command, list(ips))
+        for mac in ips:
+            if mac not in acks:
+                self.agent_macs.discard(mac)
+                self.agent_checked[mac] = time.monotonic()
+        return {ips[mac]: ack for mac, ack in acks.items()}
+
+    def discover_agents(self, devices):
+        """
+        Find out which devices run a playback agent with a hello, which agents
+        answer without running anything. Each device is asked at most every
+        agent_recheck_interval seconds.
+        """
+        if self.agents is None:
+            return
+        now = time.monotonic()
+        macs = [
+            d["mac"] for d in devices
+            if d["mac"] and d["mac"] not in self.agent_macs
+            and now - self.agent_checked.get(d["mac"], -self.agent_recheck_interval) >= self.agent_recheck_interval
+        ]
+        if not macs:
+            return
+        for mac in macs:
+            self.agent_checked[mac] = now
+        acks = self.agents.hello(macs)
+        self.agent_macs.update(acks)
+        if acks:
+            print(f"Playback agents found on {len(acks)} devices")
+
+    def run_synchronized(self, ips, prepare, timeout=None):
+        """
+        Run a command on many devices at the same moment, in two phases.
+
+        Prepare: prepare(ip) gives the shell command for each device, which is
+        started on it but holds on reading a trigger from stdin; before that
+        the device answers a ping with its clock, so its offset to ours is
+        estimated from the round trip. Fire: once every device is waiting, the trigger is written
+        to all of them at a shared deadline. Each device reports when it
+        actually ran the command, and the returned FleetResult has the skew of
+        each device (ms after the deadline, corrected for its clock offset).
+        """
+        timeout = timeout or self.device_timeout
+        start = time.monotonic()
+        # Every device is prepared within timeout of the start and the trigger
+        # follows sync_fire_delay later, so devices wait a little longer for it
+        staging_deadline = start + timeout
+        trigger_wait = int(timeout + self.sync_fire_delay) + 2
+        prepared = {}  # ip -> (remote, clock offset) of the devices staged in time
+        staging_lock = threading.Lock()
+        staging_over = threading.Event()
+
+        def stage(ip):
+            if time.monotonic() >= staging_deadline:
+                raise TimeoutError("not prepared in time")
+            command = prepare(ip)
+            remote = self.start_remote_command(
+                ip,
+                f"read -t {int(timeout)} ping && date +%s.%N; "
+                f"read -t {trigger_wait} go || exit 124; date +%s.%N; {command}"
+            )
+            if remote is None:
+                raise ConnectionError("could not connect")
+            # Clock exchange over the open channel, so the round trip is just the network
+            sent = time.time()
+            remote.send(b"ping\n")
+            clock = remote.read_line(max(staging_deadline - time.monotonic(), 0.001))
+            received = time.time()
+            if clock is None:
+                remote.cancel()
+                raise TimeoutError("no answer while preparing")
+            offset = self.parse_number(clock)
+            if offset is not None:
+                # The device read its clock about halfway through the round trip
+                offset -= (sent + received) / 2
+            with staging_lock:
+                if staging_over.is_set():
+                    # Nobody would trigger, cancel or release it
+                    remote.cancel()
+                    raise TimeoutError("not prepared in time")
+                prepared[ip] = (remote, offset)
+            return True
 
+        staged = self.run_on_devices(ips, stage, timeout=timeout)
+        with staging_lock:
+            staging_over.set()
+        for ip in list(prepared):
+            if ip not in staged.results:
+                # Staged just as its fan-out gave up on it
+                prepared.pop(ip)[0].cancel()
+
+        # Fire: every device is waiting, write the trigger to all of them at once
+        fire_at = time.time() + self.sync_fire_delay
+        time.sleep(max(fire_at - time.time(), 0))
+        fired = time.monotonic()
+        for remote, _ in prepared.values():
+            try:
+                remote.send(b"go\n", close=True)
+            except Exception as e:
+                print(f"Could not trigger {remote.ip}: {e}")
+                remote.cancel()
+
+        def finish(ip):
+            remote, offset = prepared[ip]
+            # The command only runs from the trigger, staging time doesn't count against it
+            return remote.wait(timeout, since=fired), offset
+
+        finished = self.run_on_devices(list(prepared), finish, timeout=timeout + self.sync_fire_delay)
+
+        result = FleetResult()
+        for ip, error in {**staged.errors, **finished.errors}.items():
+            result.fail(ip, error, staged.durations.get(ip, 0) + finished.durations.get(ip, 0))
+        for ip, (remote_result, offset) in finished.results.items():
+            self.record_remote_command("synchronized", remote_result)
+            duration = staged.durations[ip] + finished.durations[ip]
+            output = remote_result.stdout.split("\n", 1)
+            fired = self.parse_number(output[0])
+            remote_result.stdout = output[1] if len(output) > 1 else ""
+            if remote_result:
+                result.add(ip, True, duration)
+            else:
+                result.fail(ip, remote_result.error or remote_result.stderr or f"exit status {remote_result.exit_status}", duration)
+            if fired is not None and offset is not None:
+                result.skews[ip] = (fired - offset - fire_at) * 1000
+        result.elapsed = time.monotonic() - start
+        if result.skews:
+            print(f"Synchronized action on {len(result.skews)} devices, spread {result.spread:.1f} ms")
+        return result
 
     ## end playback functions
 
     def close_connections(self):
         """Close all SSH connections."""
-        for name, conn in self.connections.items():
-            conn.close()
-            print(f"Closed connection to {name}")
-        self.connections.clear()
+        self.connections.close_all()
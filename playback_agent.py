@@ -0,0 +1,203 @@
+"""
+Small agent running on each player that takes playback commands (pause,
+mute, unmute) from the manager over UDP multicast, so a whole setup is
+controlled with one packet instead of an SSH session per device.
+
+Messages are JSON signed with HMAC-SHA256 with a key shared with the manager
+(PIVIDEO_AGENT_KEY on the manager). Every valid command addressed to the
+agent's MAC address is answered with a signed ack, as is a hello (which runs
+nothing, it tells the manager the player has an agent), and each command id runs
+only once so the manager can safely send it again when an ack gets lost.
+Commands older than --max-age seconds are ignored as replays, so the clocks
+of manager and players should be in sync (--max-age 0 turns that off).
+
+Only needs the standard library, copy this file to the player and run:
+
+    sudo python3 playback_agent.py --key <key>
+"""
+import argparse
+import hashlib
+import hmac
+import json
+import os
+import socket
+import struct
+import subprocess
+import time
+from collections import OrderedDict
+
+GROUP = "239.255.42.99"
+PORT = 5005
+MAX_AGE = 300
+
+OMXPLAYER_DBUS = (
+    "sudo -E bash -c 'export DBUS_SESSION_BUS_ADDRESS=$(cat /tmp/omxplayerdbus.${{USER:-root}}) && "
+    "dbus-send --print-reply=literal --session --dest=org.mpris.MediaPlayer2.omxplayer "
+    "/org/mpris/MediaPlayer2 {} >/dev/null'"
+)
+OMXPLAYER_COMMANDS = {
+    "pause": OMXPLAYER_DBUS.format("org.mpris.MediaPlayer2.Player.Action int32:16"),
+    "mute": OMXPLAYER_DBUS.format(
+        "org.freedesktop.DBus.Properties.Set "
+        "string:\"org.mpris.MediaPlayer2.Player\" string:\"Volume\" variant:double:0.0"
+    ),
+    "unmute": OMXPLAYER_DBUS.format(
+        "org.freedesktop.DBus.Properties.Set "
+        "string:\"org.mpris.MediaPlayer2.Player\" string:\"Volume\" variant:double:1.0"
+    ),
+}
+PULSE_COMMANDS = {
+    "pause": (
+        "VOLUME=$(sudo -u pi pactl get-sink-volume @DEFAULT_SINK@ | grep -o '[0-9]\\+%' | head -n1); "
+        "[ -n \"$VOLUME\" ] && echo \"$VOLUME\" > /home/pi/.last_volume; "
+        "sudo -u pi pactl set-sink-mute @DEFAULT_SINK@ 1"
+    ),
+    "mute": "sudo -u pi pactl set-sink-mute @DEFAULT_SINK@ 1",
+    "unmute": "sudo -u pi pactl set-sink-mute @DEFAULT_SINK@ 0",
+}
+# Mutes or unmutes every control of every card, fails if none could be set
+ALSA_COMMAND = (
+    "status=1; "
+    "for card in $(aplay -l | grep '^card' | awk '{{print $2}}' | sed 's/://'); do "
+    "for ctl in $(amixer -c \"$card\" scontrols | awk -F\"'\" '{{print $2}}'); do "
+    "amixer -c \"$card\" sset \"$ctl\" {} && status=0; "
+    "done; done; [ $status = 0 ]"
+)
+
+
+def pack_message(message, key):
+    """Serialize and sign a message."""
+    body = json.dumps(message, sort_keys=True, separators=(",", ":"))
+    signature = hmac.new(key, body.encode(), hashlib.sha256).hexdigest()
+    return json.dumps({"body": body, "sig": signature}).encode()
+
+
+def unpack_message(data, key):
+    """Return the message in data, or None if it isn't one or isn't signed with key."""
+    try:
+        packet = json.loads(data)
+        body, signature = packet["body"], str(packet["sig"])
+        expected = hmac.new(key, body.encode(), hashlib.sha256).hexdigest()
+        if not hmac.compare_digest(expected, signature):
+            return None
+        message = json.loads(body)
+    except (ValueError, KeyError, TypeError, AttributeError):
+        return None
+    return message if isinstance(message, dict) else None
+
+
+def run_player_command(command):
+    """Run a playback command on this player: omxplayer-sync first, then PulseAudio, then ALSA."""
+    alsa = ALSA_COMMAND.format("unmute" if command == "unmute" else "mute")
+    for shell in (OMXPLAYER_COMMANDS[command], PULSE_COMMANDS[command], alsa):
+        result = subprocess.run(shell, shell=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        if result.returncode == 0:
+            return True
+    return False
+
+
+def read_mac(interface="eth0"):
+    with open(f"/sys/class/net/{interface}/address") as f:
+        return f.read().strip()
+
+
+class PlaybackAgent:
+    """
+    Listens for signed playback commands on the multicast group and runs the
+    ones addressed to mac with handler(command), which returns True on success.
+    """
+
+    remembered = 256  # Command ids kept to answer retries without running them again
+
+    def __init__(self, key, mac, group=GROUP, port=PORT, interface="0.0.0.0", handler=run_player_command,
+                 max_age=MAX_AGE):
+        self.key = key
+        self.mac = mac
+        self.group = group
+        self.port = port
+        self.interface = interface
+        self.handler = handler
+        self.max_age = max_age
+        self.done = OrderedDict()  # command id -> ack
+        self.sock = None
+
+    def open(self):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if hasattr(socket, "SO_REUSEPORT"):
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self.sock.bind(("", self.port))
+        membership = struct.pack("4s4s", socket.inet_aton(self.group), socket.inet_aton(self.interface))
+        self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, membership)
+
+    def close(self):
+        if self.sock:
+            self.sock.close()
+            self.sock = None
+
+    def handle(self, data):
+        """Ack (packed) for a received datagram, or None if it isn't a valid command for this agent."""
+        message = unpack_message(data, self.key)
+        if not message or message.get("type") not in ("command", "hello"):
+            return None
+        if self.mac not in (message.get("targets") or ()):
+            return None
+        if message["type"] == "hello":
+            return pack_message({"type": "ack", "id": message.get("id"), "mac": self.mac, "ok": True, "error": None},
+                                self.key)
+        if message.get("command") not in OMXPLAYER_COMMANDS:
+            return None
+        command_id = message.get("id")
+        ack = self.done.get(command_id)
+        if ack is None:
+            if self.max_age and abs(time.time() - float(message.get("ts") or 0)) > self.max_age:
+                return None
+            try:
+                ok, error = bool(self.handler(message["command"])), None
+            except Exception as e:
+                ok, error = False, str(e)
+            ack = {"type": "ack", "id": command_id, "mac": self.mac, "ok": ok, "error": error}
+            self.done[command_id] = ack
+            while len(self.done) > self.remembered:
+                self.done.popitem(last=False)
+        return pack_message(ack, self.key)
+
+    def serve_forever(self):
+        if self.sock is None:
+            self.open()
+        print(f"Playback agent for {self.mac} listening on {self.group}:{self.port}")
+        while self.sock:
+            try:
+                data, address = self.sock.recvfrom(65536)
+            except OSError:
+                break
+            reply = self.handle(data)
+            if reply:
+                self.sock.sendto(reply, address)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Playback agent for pivideo_manager")
+    parser.add_argument("--key", default=os.environ.get("PIVIDEO_AGENT_KEY"),
+                        help="key shared with the manager (or PIVIDEO_AGENT_KEY)")
+    parser.add_argument("--group", default=GROUP)
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--interface", default="0.0.0.0", help="address of the interface to listen on")
+    parser.add_argument("--mac", help="MAC address the manager knows this player by (default: eth0)")
+    parser.add_argument("--max-age", type=float, default=MAX_AGE)
+    args = parser.parse_args()
+    if not args.key:
+        parser.error("a key is required")
+
+    agent = PlaybackAgent(args.key.encode(), args.mac or read_mac(), args.group, args.port, args.interface,
+                          max_age=args.max_age)
+    try:
+        agent.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        agent.close()
+
+
+if __name__ == "__main__":
+    main()
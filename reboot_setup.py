@@ -1,5 +1,5 @@
 import sys
-from pivideo_manager import PiVideoManager
+import control_plane
 
 try:
     setupname = sys.argv[1]
@@ -7,6 +7,15 @@ except:
     print("No setupname argument detected")
     sys.exit()
 
+# Optional: how many devices reboot at once
+batch_size = int(sys.argv[2]) if len(sys.argv) > 2 else None
+
 print("Rebooting setup with name: ",setupname)
-manager = PiVideoManager()
-manager.reboot_setup(setupname)
\ No newline at end of file
+# Goes through the control plane so it doesn't clash with the dashboard's own actions
+manager = control_plane.connect()
+result = manager.reboot_setup(setupname, batch_size)
+for ip, seconds in result.results.items():
+    print(f"{ip} ready after {seconds:.1f}s")
+if result.failed:
+    print("Devices that failed to reboot: ",result.errors or result.failed)
+print(f"Done in {result.elapsed:.1f}s")
\ No newline at end of file
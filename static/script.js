@@ -2,23 +2,122 @@ $(document).ready(function () {
 
     let homeurl=$("body").attr("homeurl");
 
-    // Handle scanning network with AJAX
-    $("body").on("click",'.scan-btn',function () {
+    // Patch device rows in place as the manager learns about changes
+    function applyDeviceEvent(event) {
+        var deviceElement = $('.device[data-mac="'+event.mac+'"]');
+
+        if (event.type == "removed") {
+            deviceElement.remove();
+            return;
+        }
+        if (event.type == "added") {
+            if (!deviceElement.length) {
+                $('.setup[setup-id="'+event.setup_id+'"] .devices').append(event.html);
+            }
+            return;
+        }
+        if (!deviceElement.length) {
+            return;
+        }
+        $.each(event.display, function (field, value) {
+            var fieldElement = $('[data-field="'+field+'"]', deviceElement);
+            // Don't overwrite a name that is being edited
+            if (fieldElement.is(":focus")) {
+                return;
+            }
+            fieldElement.text(value);
+        });
+        deviceElement.attr("data-ip", event.display.ip);
+        deviceElement.toggleClass("missing", event.missing);
+        deviceElement.toggleClass("paused", event.paused);
+        deviceElement.toggleClass("muted", event.muted);
+        if (event.rebooting) {
+            deviceElement.addClass("updating rebooting");
+        } else if (deviceElement.hasClass("rebooting")) {
+            console.log("Finished booting.");
+            deviceElement.removeClass("updating rebooting");
+        }
+        var toggler = $('.playback-btn.togglerbtn', deviceElement);
+        if (!toggler.hasClass("updating")) {
+            var icons = $(".togglericon", toggler).css("display", "");
+            icons.eq(0).toggleClass("hidden", event.paused);
+            icons.eq(1).toggleClass("hidden", !event.paused);
+        }
+    }
+
+    // Only the admin dashboard's setups have an id, setup users can't open the stream
+    if ($(".setup[setup-id]").length && window.EventSource) {
+        var deviceEvents = new EventSource(homeurl+'/api/events');
+        deviceEvents.addEventListener("device", function (message) {
+            applyDeviceEvent(JSON.parse(message.data));
+        });
+    }
+
+    // Poll a background scan until it finishes, showing progress on the button
+    function pollScan(jobId, buttonelement, setupElement) {
+        $.ajax({
+            url: homeurl+'/api/scan/'+jobId,
+            type: 'GET',
+            success: function (job) {
+                if (job.status == "running") {
+                    var text = "PROBED " + job.probed + "/" + job.total;
+                    if (job.candidates) {
+                        text = "FOUND " + job.found + " (" + job.collected + "/" + job.candidates + ")";
+                    }
+                    if (job.eta != null) {
+                        text += " ~" + Math.ceil(job.eta) + "s";
+                    }
+                    buttonelement.text(text);
+                    setTimeout(() => pollScan(jobId, buttonelement, setupElement), 1000);
+                    return;
+                }
+                if (job.status == "failed") {
+                    alert("Error scanning network: " + job.error);
+                }
+                // Found devices arrive through the event stream
+                buttonelement.removeAttr("job-id").text("SCAN NETWORK");
+                setupElement.removeClass("updating");
+            },
+            error: function (xhr) {
+                alert("Error scanning network: " + xhr.responseText);
+                setupElement.removeClass("updating");
+            }
+        });
+    }
+
+    // Handle scanning network with AJAX, shift-click for a full rescan of known devices too
+    $("body").on("click",'.scan-btn',function (e) {
+        var buttonelement = $(this);
         var ip_range = $(this).attr('iprange');  // Get the data attribute value
         var setupElement = $(this).closest(".setup");
+
+        // A second click on a running scan cancels it
+        var runningJob = buttonelement.attr("job-id");
+        if (runningJob) {
+            if (confirm("Cancel this scan?")) {
+                $.ajax({
+                    url: homeurl+'/api/scan/'+runningJob+'/cancel',
+                    type: 'POST',
+                    contentType: 'application/json'
+                });
+            }
+            return;
+        }
+
         setupElement.addClass("updating");
         
         $.ajax({
             url: homeurl+'/api/scan',
             type: 'POST',
             contentType: 'application/json',
-            data: JSON.stringify({ ip_range: ip_range }),
+            data: JSON.stringify({ ip_range: ip_range, full: e.shiftKey }),
             success: function (response) {
-                alert(response.message);
-                location.reload();  // Reload to show new devices
+                buttonelement.attr("job-id", response.job_id);
+                pollScan(response.job_id, buttonelement, setupElement);
             },
             error: function (xhr) {
                 alert("Error scanning network: " + xhr.responseText);
+                setupElement.removeClass("updating");
             }
         });
     });
@@ -82,11 +181,12 @@ $(document).ready(function () {
             type: 'GET',
             contentType: 'application/json',
             success: function (response) {
-                
+                // Cleared by the event stream once the device is ready again,
+                // this is only a fallback if the stream isn't there
+                deviceElement.addClass("rebooting");
                 setTimeout(() => {
-                    console.log("Finished booting.");
-                    deviceElement.removeClass("updating");
-                  }, 60*1000);
+                    deviceElement.removeClass("updating rebooting");
+                  }, 5*60*1000);
             },
             error: function (xhr) {
                 alert("Error scanning network: " + xhr.responseText);
@@ -110,7 +210,7 @@ $(document).ready(function () {
             data:JSON.stringify({ ip_range: iprange }),
             success: function (response) {
                     console.log("Finished deleting setup.");
-                    location.reload();
+                    setupElement.remove();
             },
             error: function (xhr) {
                 alert("Error deleting setup: " + xhr.responseText);
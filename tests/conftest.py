@@ -0,0 +1,46 @@
+import os
+import sqlite3
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmark import FakeFleet  # noqa: E402
+from pivideo_manager import PiVideoManager  # noqa: E402
+
+
+def create_users(db_file):
+    """An existing users table skips the interactive admin prompt."""
+    conn = sqlite3.connect(db_file)
+    conn.execute("CREATE TABLE users (id INTEGER PRIMARY KEY AUTOINCREMENT, user TEXT UNIQUE, password TEXT, setup TEXT)")
+    conn.execute("INSERT INTO users (user, password, setup) VALUES ('admin', 'admin', 'admin')")
+    conn.commit()
+    conn.close()
+
+
+@pytest.fixture
+def make_manager(tmp_path):
+    """Builds PiVideoManagers on a database of their own, with class attributes overridden."""
+    managers = []
+
+    def make(**attributes):
+        db_file = str(tmp_path / "test.db")
+        if not os.path.exists(db_file):
+            create_users(db_file)
+        manager_class = type("TestManager", (PiVideoManager,), {"db_file": db_file, "agent_key": None, **attributes})
+        manager = manager_class()
+        managers.append(manager)
+        return manager
+
+    yield make
+    for manager in managers:
+        manager.close_connections()
+        manager.executor.shutdown(wait=False)
+
+
+@pytest.fixture
+def fleet():
+    """Four simulated players answering SSH on loopback addresses (see benchmark.FakeFleet)."""
+    with FakeFleet(4, latency=0.001) as fleet:
+        yield fleet
@@ -0,0 +1,73 @@
+import time
+
+import pytest
+
+from pivideo_manager import SSHConnectionPool
+
+
+class FakeClient:
+    """Stands in for a paramiko.SSHClient, and for its transport."""
+
+    def __init__(self, ip):
+        self.ip = ip
+        self.closed = False
+
+    def get_transport(self):
+        return self
+
+    def is_active(self):
+        return not self.closed
+
+    def send_ignore(self):
+        pass
+
+    def set_keepalive(self, interval):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+@pytest.fixture
+def pool():
+    pool = SSHConnectionPool(FakeClient, max_size=1, idle_timeout=0)
+    yield pool
+    pool.close_all()
+
+
+def test_borrowed_connection_survives_trim(pool):
+    borrowed = pool.get("10.0.0.1", borrow=True)
+    other = pool.get("10.0.0.2")
+
+    # Past max_size, only the connection nobody uses is closed, least recently used or not
+    assert not borrowed.closed and "10.0.0.1" in pool
+    assert other.closed and "10.0.0.2" not in pool
+
+
+def test_pool_grows_while_borrowed_and_shrinks_on_release(pool):
+    first = pool.get("10.0.0.1", borrow=True)
+    second = pool.get("10.0.0.2", borrow=True)
+    assert len(pool) == 2 and not first.closed and not second.closed
+
+    pool.release("10.0.0.1")
+
+    assert first.closed and "10.0.0.1" not in pool
+    assert not second.closed
+
+
+def test_borrowed_connection_survives_idle_eviction(pool):
+    client = pool.get("10.0.0.1", borrow=True)
+    assert pool.get("10.0.0.1", borrow=True) is client
+    time.sleep(0.01)
+
+    pool.evict_idle()
+    assert not client.closed
+
+    # Still borrowed once
+    pool.release("10.0.0.1")
+    pool.evict_idle()
+    assert not client.closed
+
+    pool.release("10.0.0.1")
+    pool.evict_idle()
+    assert client.closed and "10.0.0.1" not in pool
@@ -0,0 +1,56 @@
+import pytest
+
+from pivideo_manager import PiVideoManager
+
+
+@pytest.fixture
+def manager():
+    return PiVideoManager.__new__(PiVideoManager)
+
+
+def test_no_master(manager):
+    stats = manager.lag_statistics(None)
+
+    assert stats["lag_error"] == manager.LAG_NO_MASTER
+    assert stats["lag"] is None and stats["lag_loss"] is None
+
+
+def test_full_burst(manager):
+    stats = manager.lag_statistics("0.40 0.50 0.30 0.60 0.45 ")
+
+    assert stats == {"lag": 0.45, "lag_error": None, "lag_min": 0.3, "lag_max": 0.6,
+                     "lag_jitter": 0.19, "lag_loss": 0.0}
+
+
+def test_lost_pings(manager):
+    stats = manager.lag_statistics("1.2 1.6")
+
+    assert stats["lag"] == 1.4
+    assert stats["lag_loss"] == round(3 / manager.lag_samples, 2)
+    assert stats["lag_jitter"] == 0.4
+
+
+def test_single_reply_has_no_jitter(manager):
+    stats = manager.lag_statistics("2.5")
+
+    assert (stats["lag"], stats["lag_min"], stats["lag_max"]) == (2.5, 2.5, 2.5)
+    assert stats["lag_jitter"] is None
+
+
+@pytest.mark.parametrize("output", ["", "   ", "garbage"])
+def test_no_reply(manager, output):
+    stats = manager.lag_statistics(output)
+
+    assert stats["lag_error"] == manager.LAG_NO_RESPONSE
+    assert stats["lag"] is None
+    assert stats["lag_loss"] == 1.0
+
+
+def test_probe_output(manager):
+    output = "temperature=temp=52.1'C\nboot_id=abc\nlag=0.4 0.6 \n"
+
+    info = manager.parse_probe_output(output, "192.168.5.10")
+    assert (info["temperature"], info["lag"], info["lag_max"]) == (52.1, 0.5, 0.6)
+
+    info = manager.parse_probe_output(output, "")
+    assert info["lag_error"] == manager.LAG_NO_MASTER
@@ -0,0 +1,79 @@
+import pytest
+
+from metrics import Registry
+
+
+@pytest.fixture
+def registry():
+    return Registry()
+
+
+def test_counter(registry):
+    scans = registry.counter("scans_total", "Scans run", ["mode"])
+    scans.inc(mode="full")
+    scans.inc(2, mode="full")
+    scans.inc(mode="incremental")
+
+    assert registry.render() == (
+        "# HELP scans_total Scans run\n"
+        "# TYPE scans_total counter\n"
+        'scans_total{mode="full"} 3\n'
+        'scans_total{mode="incremental"} 1\n'
+    )
+
+
+def test_gauge_replace_drops_old_label_sets(registry):
+    lag = registry.gauge("lag_milliseconds", "Lag", ["device"])
+    lag.set(1.5, device="a")
+    lag.replace([({"device": "b"}, 0.25)])
+
+    assert registry.render().splitlines()[2:] == ['lag_milliseconds{device="b"} 0.25']
+
+
+def test_histogram_buckets_are_cumulative(registry):
+    seconds = registry.histogram("command_seconds", "Commands", buckets=(0.1, 1))
+    for value in (0.05, 0.5, 0.7, 3):
+        seconds.observe(value)
+
+    assert registry.render().splitlines()[2:] == [
+        'command_seconds_bucket{le="0.1"} 1',
+        'command_seconds_bucket{le="1.0"} 3',
+        'command_seconds_bucket{le="+Inf"} 4',
+        "command_seconds_sum 4.25",
+        "command_seconds_count 4",
+    ]
+
+
+def test_label_values_are_escaped(registry):
+    registry.gauge("devices", "Devices", ["setup"]).set(2, setup='Hall "A"\\1\nB')
+
+    assert registry.render().splitlines()[2] == 'devices{setup="Hall \\"A\\"\\\\1\\nB"} 2'
+
+
+def test_labels_must_match(registry):
+    counter = registry.counter("scans_total", "Scans run", ["mode"])
+
+    with pytest.raises(ValueError):
+        counter.inc(outcome="ok")
+
+
+def test_fleet_gauges(make_manager):
+    manager = make_manager()
+    manager.create_setup("Hall", "192.168.5.0/24", "")
+    manager.save_devices([
+        {"mac": "b8:27:eb:00:00:01", "ip": "192.168.5.10", "name": "entrance", "temperature": 52.1, "lag": 0.4,
+         "lag_loss": 0.0},
+        {"mac": "b8:27:eb:00:00:02", "ip": "192.168.5.11", "name": "bar", "temperature": 70.0, "lag": None,
+         "lag_loss": None},
+    ], "192.168.5.0/24", missing_macs=["b8:27:eb:00:00:02"])
+
+    lines = manager.metrics().splitlines()
+
+    assert 'pivideo_devices{setup="Hall",state="online"} 1' in lines
+    assert 'pivideo_devices{setup="Hall",state="missing"} 1' in lines
+    assert 'pivideo_devices{setup="Hall",state="rebooting"} 0' in lines
+    labels = '{setup="Hall",device="entrance",ip="192.168.5.10",mac="b8:27:eb:00:00:01"}'
+    assert f"pivideo_device_temperature_celsius{labels} 52.1" in lines
+    assert f"pivideo_device_lag_milliseconds{labels} 0.4" in lines
+    # Stored values of a missing device are stale
+    assert not any("192.168.5.11" in line for line in lines)
@@ -0,0 +1,102 @@
+import sqlite3
+
+import pytest
+
+from conftest import create_users
+from pivideo_manager import PiVideoManager
+
+# Schema and metric formats written by the first release, before schema versions
+BASELINE_SCHEMA = '''
+    CREATE TABLE devices (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        iprange TEXT,
+        name TEXT UNIQUE,
+        ip TEXT UNIQUE,
+        model TEXT,
+        mac TEXT UNIQUE,
+        temperature TEXT,
+        ram TEXT,
+        storage TEXT,
+        lag TEXT,
+        master BOOLEAN DEFAULT FALSE,
+        missing BOOLEAN DEFAULT FALSE,
+        sort INTEGER DEFAULT 0,
+        last_connection TEXT
+    );
+    CREATE TABLE setup (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT,
+        friendlyurl TEXT,
+        iprange TEXT,
+        creation_date TEXT,
+        last_update TEXT
+    );
+'''
+
+BASELINE_DEVICES = [
+    # mac, ip, temperature, ram, storage, lag, master
+    ("b8:27:eb:00:00:01", "192.168.5.10", "52.1'C", "3794 MB", "T:29G / R:12G", "0.42 ms", True),
+    ("b8:27:eb:00:00:02", "192.168.5.11", "Unknown", "Unknown RAM", "T:14.5G / R:900M", "Ping failed or no response", False),
+    ("b8:27:eb:00:00:03", "192.168.5.12", "Error: timed out", " MB", None, "no master detected timed out", False),
+]
+
+
+@pytest.fixture
+def manager():
+    return PiVideoManager.__new__(PiVideoManager)
+
+
+def test_parse_number(manager):
+    assert manager.parse_number("52.1'C") == 52.1
+    assert manager.parse_number("0.42 ms") == 0.42
+    assert manager.parse_number("-3 C") == -3.0
+    assert manager.parse_number(7) == 7.0
+    assert manager.parse_number("Unknown") is None
+    assert manager.parse_number(None) is None
+
+
+def test_parse_storage_text(manager):
+    assert manager.parse_storage_text("T:29G / R:12G") == (29 * 1024 ** 3, 12 * 1024 ** 3)
+    assert manager.parse_storage_text("T:14.5G / R:900M") == (int(14.5 * 1024 ** 3), 900 * 1024 ** 2)
+    assert manager.parse_storage_text("T:512 / R:") == (512, None)
+    assert manager.parse_storage_text({"error": "No output received"}) == (None, None)
+    assert manager.parse_storage_text(None) == (None, None)
+
+
+def test_baseline_database_is_upgraded(tmp_path, make_manager):
+    db_file = str(tmp_path / "test.db")
+    conn = sqlite3.connect(db_file)
+    conn.executescript(BASELINE_SCHEMA)
+    conn.execute("INSERT INTO setup (name, friendlyurl, iprange) VALUES ('Hall', 'hall', '192.168.5.0/24')")
+    conn.executemany(
+        "INSERT INTO devices (iprange, name, mac, ip, temperature, ram, storage, lag, master) "
+        "VALUES ('192.168.5.0/24', ?, ?, ?, ?, ?, ?, ?, ?)",
+        [(f"pi{index}", *device) for index, device in enumerate(BASELINE_DEVICES)]
+    )
+    conn.commit()
+    conn.close()
+    create_users(db_file)
+
+    manager = make_manager()
+    assert manager.db.fetchone("PRAGMA user_version")["user_version"] == manager.schema_version
+    devices = {device["mac"]: device for device in manager.db.fetchall("SELECT * FROM devices")}
+    setup_id = manager.db.fetchone("SELECT id FROM setup")["id"]
+
+    first = devices["b8:27:eb:00:00:01"]
+    assert first["setup_id"] == setup_id
+    assert (first["temperature"], first["ram"], first["lag"], first["lag_error"]) == (52.1, 3794, 0.42, None)
+    assert (first["storage_total"], first["storage_free"]) == (29 * 1024 ** 3, 12 * 1024 ** 3)
+    assert first["master"] and first["name"] == "pi0"
+
+    second = devices["b8:27:eb:00:00:02"]
+    assert (second["temperature"], second["ram"], second["lag"]) == (None, None, None)
+    assert second["lag_error"] == manager.LAG_NO_RESPONSE
+    assert second["storage_free"] == 900 * 1024 ** 2
+
+    third = devices["b8:27:eb:00:00:03"]
+    assert (third["temperature"], third["storage_total"], third["lag"]) == (None, None, None)
+    assert third["lag_error"] == manager.LAG_NO_MASTER
+
+    # Upgrading again is a no-op
+    manager.upgrade_schema()
+    assert manager.db.fetchone("SELECT count(*) AS devices FROM devices")["devices"] == len(BASELINE_DEVICES)
@@ -0,0 +1,77 @@
+import threading
+import time
+
+import pytest
+
+from pivideo_manager import PlaybackAgentClient
+from playback_agent import GROUP, PlaybackAgent
+
+KEY = b"test key"
+MAC = "b8:27:eb:00:00:01"
+
+
+@pytest.fixture
+def agent():
+    """A playback agent on the loopback interface, recording the commands it runs."""
+    agent = PlaybackAgent(KEY, MAC, port=0, interface="127.0.0.1", handler=lambda command: agent.ran.append(command) or True)
+    agent.ran = []
+    agent.open()
+    agent.port = agent.sock.getsockname()[1]
+    thread = threading.Thread(target=agent.serve_forever, daemon=True)
+    thread.start()
+    yield agent
+    agent.close()
+
+
+def make_client(agent, key=KEY):
+    return PlaybackAgentClient(key, GROUP, agent.port, "127.0.0.1", ack_timeout=0.1, retries=1)
+
+
+def test_command_is_acked_and_run_once(agent):
+    acks = make_client(agent).send("mute", [MAC, "b8:27:eb:00:00:02"])
+
+    assert list(acks) == [MAC]
+    assert acks[MAC]["ok"]
+    assert agent.ran == ["mute"]
+
+
+def test_hello_runs_nothing(agent):
+    acks = make_client(agent).hello([MAC])
+
+    assert list(acks) == [MAC]
+    assert agent.ran == []
+
+
+def test_other_key_is_ignored(agent):
+    assert make_client(agent, key=b"other key").send("pause", [MAC]) == {}
+    assert agent.ran == []
+
+
+def test_manager_uses_agents_it_found(agent, make_manager):
+    manager = make_manager(agent_key=KEY.decode(), agent_port=agent.port, agent_interface="127.0.0.1",
+                           agent_ack_timeout=0.1)
+    manager.db.execute("INSERT INTO devices (mac, ip) VALUES (?, ?)", (MAC, "127.0.0.1"))
+    devices = manager.db.fetchall("SELECT * FROM devices")
+
+    manager.discover_agents(devices)
+    assert manager.agent_macs == {MAC}
+
+    assert manager.playback_control("127.0.0.1", "mute")
+    assert agent.ran == ["mute"]
+    assert manager.get_device_by_mac(MAC)["muted"]
+
+
+def test_devices_without_agent_are_not_waited_for(agent, make_manager):
+    manager = make_manager(agent_key=KEY.decode(), agent_port=agent.port, agent_interface="127.0.0.1")
+    devices = [{"mac": "b8:27:eb:00:00:02", "ip": "127.0.0.2"}]
+
+    start = time.monotonic()
+    assert manager.send_to_agents(devices, "mute") == {}
+    assert time.monotonic() - start < 0.1
+
+
+def test_agents_are_off_without_a_key(make_manager):
+    manager = make_manager()
+
+    assert manager.agents is None
+    assert manager.send_to_agents([{"mac": MAC, "ip": "127.0.0.1"}], "mute") == {}
@@ -0,0 +1,17 @@
+def test_device_ready_after_reboot_is_no_longer_missing(fleet, make_manager):
+    fleet.boot_time = 0.2
+    manager = make_manager(ssh_port=fleet.port, reboot_probe_interval=0.1)
+    iprange = str(fleet.network)
+    manager.create_setup("Hall", iprange, "")
+    manager.scan_ip_range(iprange)
+    ip = list(fleet.devices)[0]
+    mac = fleet.devices[ip].mac
+    # The poller found it down while it rebooted
+    manager.db.execute("UPDATE devices SET missing = 1 WHERE ip = ?", (ip,))
+
+    assert manager.reboot_and_wait(ip, ready_timeout=10) > 0
+
+    device = manager.get_device_by_mac(mac)
+    assert not device["missing"]
+    assert device["reboot_started"] is None and device["time_to_ready"] > 0
+    assert manager.pop_poll_requests() == {mac}
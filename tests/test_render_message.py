@@ -0,0 +1,42 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+FAKE_FFMPEG = """#!/bin/sh
+# Writes its output file (the last argument) after a while, like an encode
+sleep 0.2
+for last; do :; done
+echo clip > "$last"
+"""
+
+
+@pytest.fixture
+def ffmpeg(tmp_path, monkeypatch):
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    path = bin_dir / "ffmpeg"
+    path.write_text(FAKE_FFMPEG)
+    path.chmod(0o755)
+    monkeypatch.setenv("PATH", f"{bin_dir}{os.pathsep}{os.environ['PATH']}")
+
+
+def test_same_message_rendered_at_once(ffmpeg, tmp_path, make_manager):
+    cache = tmp_path / "message_cache"
+    manager = make_manager(message_cache_dir=str(cache))
+
+    with ThreadPoolExecutor(8) as pool:
+        clips = list(pool.map(lambda _: manager.render_message("Hello"), range(8)))
+
+    assert len(set(clips)) == 1 and clips[0] is not None
+    assert os.listdir(cache) == [os.path.basename(clips[0])]
+    # Cached from now on
+    assert manager.render_message("Hello") == clips[0]
+
+
+def test_without_ffmpeg(tmp_path, monkeypatch, make_manager):
+    monkeypatch.setenv("PATH", str(tmp_path))
+    manager = make_manager(message_cache_dir=str(tmp_path / "message_cache"))
+
+    assert manager.render_message("Hello") is None
+    assert os.listdir(tmp_path / "message_cache") == []
@@ -0,0 +1,19 @@
+import time
+
+
+def test_hung_device_doesnt_fail_the_others(fleet, make_manager):
+    manager = make_manager(ssh_port=fleet.port, device_timeout=2)
+    ips = list(fleet.devices)
+    hung = ips[0]
+    fleet.devices[hung].stalled = True
+
+    result = manager.run_synchronized(ips, lambda ip: "true")
+
+    assert set(result.ok) == set(ips[1:])
+    assert set(result.skews) == set(ips[1:])
+    assert list(result.errors) == [hung]
+    # The hung device's staging gives up on its own, then no connection stays borrowed
+    deadline = time.monotonic() + manager.device_timeout
+    while manager.connections.borrowed and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert manager.connections.borrowed == {}
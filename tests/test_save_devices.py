@@ -0,0 +1,84 @@
+import pytest
+
+IPRANGE = "192.168.5.0/24"
+FIRST = "b8:27:eb:00:00:01"
+SECOND = "b8:27:eb:00:00:02"
+
+
+def info(mac, ip, **fields):
+    return {"mac": mac, "ip": ip, "model": "Raspberry Pi 4 Model B Rev 1.4", "temperature": 50.0, **fields}
+
+
+@pytest.fixture
+def manager(make_manager):
+    manager = make_manager()
+    manager.create_setup("Hall", IPRANGE, "")
+    return manager
+
+
+def device(manager, mac):
+    return manager.get_device_by_mac(mac)
+
+
+def test_new_devices_join_the_setup(manager):
+    manager.save_devices([info(FIRST, "192.168.5.10"), info(SECOND, "192.168.5.11")], IPRANGE)
+
+    setup_id = manager.db.fetchone("SELECT id FROM setup WHERE iprange = ?", (IPRANGE,))["id"]
+    assert device(manager, FIRST)["setup_id"] == setup_id
+    assert device(manager, SECOND)["ip"] == "192.168.5.11"
+    assert manager.db.fetchone("SELECT count(*) AS devices FROM devices")["devices"] == 2
+
+
+def test_known_device_is_updated_in_place(manager):
+    manager.save_devices([info(FIRST, "192.168.5.10")], IPRANGE)
+    first = device(manager, FIRST)
+    manager.db.execute("UPDATE devices SET name = 'entrance', sort = 3, missing = 1 WHERE mac = ?", (FIRST,))
+
+    manager.save_devices([info(FIRST, "192.168.5.10", temperature=61.5)], IPRANGE)
+
+    updated = device(manager, FIRST)
+    assert updated["id"] == first["id"]
+    assert updated["temperature"] == 61.5
+    assert not updated["missing"]
+    # Fields that weren't collected are kept
+    assert (updated["name"], updated["sort"]) == ("entrance", 3)
+
+
+def test_device_taking_over_an_ip_frees_it(manager):
+    manager.save_devices([info(FIRST, "192.168.5.10")], IPRANGE)
+
+    manager.save_devices([info(SECOND, "192.168.5.10")], IPRANGE)
+
+    assert device(manager, FIRST)["ip"] is None
+    assert device(manager, SECOND)["ip"] == "192.168.5.10"
+
+
+def test_devices_swapping_ips(manager):
+    manager.save_devices([info(FIRST, "192.168.5.10"), info(SECOND, "192.168.5.11")], IPRANGE)
+
+    manager.save_devices([info(FIRST, "192.168.5.11"), info(SECOND, "192.168.5.10")], IPRANGE)
+
+    assert device(manager, FIRST)["ip"] == "192.168.5.11"
+    assert device(manager, SECOND)["ip"] == "192.168.5.10"
+
+
+def test_missing_and_seen_devices(manager):
+    manager.save_devices([info(FIRST, "192.168.5.10"), info(SECOND, "192.168.5.11")], IPRANGE)
+
+    manager.save_devices([], IPRANGE, missing_macs=[FIRST])
+    assert device(manager, FIRST)["missing"]
+
+    manager.save_devices([], IPRANGE, seen_macs=[FIRST])
+    assert not device(manager, FIRST)["missing"]
+    assert device(manager, FIRST)["last_connection"]
+
+
+def test_reboot_forgets_the_player(manager):
+    manager.save_devices([info(FIRST, "192.168.5.10", boot_id="boot-1")], IPRANGE)
+    manager.db.execute("UPDATE devices SET player = 'omxplayer' WHERE mac = ?", (FIRST,))
+
+    manager.save_devices([info(FIRST, "192.168.5.10", boot_id="boot-1")], IPRANGE)
+    assert device(manager, FIRST)["player"] == "omxplayer"
+
+    manager.save_devices([info(FIRST, "192.168.5.10", boot_id="boot-2")], IPRANGE)
+    assert device(manager, FIRST)["player"] is None
@@ -0,0 +1,22 @@
+def test_boards_without_a_mac_are_not_saved(fleet, make_manager):
+    manager = make_manager(ssh_port=fleet.port)
+    iprange = str(fleet.network)
+    manager.create_setup("Hall", iprange, "")
+    ips = list(fleet.devices)
+    for ip in ips[:2]:
+        fleet.devices[ip].mac = None  # No eth0
+
+    manager.scan_ip_range(iprange)
+
+    devices = manager.get_all_devices_in_iprange(iprange)
+    assert sorted(device["ip"] for device in devices) == sorted(ips[2:])
+    assert all(device["mac"] == fleet.devices[device["ip"]].mac for device in devices)
+
+
+def test_get_mac_address(fleet, make_manager):
+    manager = make_manager(ssh_port=fleet.port)
+    with_mac, without_mac = list(fleet.devices)[:2]
+    fleet.devices[without_mac].mac = None
+
+    assert manager.get_mac_address(with_mac) == fleet.devices[with_mac].mac
+    assert manager.get_mac_address(without_mac) is None